@@ -1,16 +1,127 @@
+import json
+import time
+import itertools
+import datetime
+
 import psycopg2
 
 
+def copy_escape(s: str):
+    return s.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def array_literal(values):
+    items = []
+    for v in values:
+        if v is None:
+            items.append("NULL")
+        elif isinstance(v, (list, tuple)):
+            items.append(array_literal(v))
+        elif isinstance(v, bool):
+            items.append("t" if v else "f")
+        else:
+            items.append('"' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"')
+    return "{" + ",".join(items) + "}"
+
+
+def copy_value(v):
+    # Encode a python value in the text format of COPY.
+    # Lists/tuples are postgres arrays (e.g., rtts), dicts are json.
+    # jsonb columns holding a json list (e.g., sanitized_hops) must be passed as json.dumps strings.
+    if v is None:
+        return "\\N"
+    if isinstance(v, bool):
+        return "t" if v else "f"
+    if isinstance(v, (list, tuple)):
+        return copy_escape(array_literal(v))
+    if isinstance(v, dict):
+        return copy_escape(json.dumps(v))
+    if isinstance(v, (datetime.datetime, datetime.date)):
+        return v.isoformat()
+    return copy_escape(str(v))
+
+
+class CopyReader:
+    # File-like object for cursor.copy_expert, encodes rows lazily instead of building the whole buffer
+    def __init__(self, rows):
+        self.__rows = iter(rows)
+        self.__buf = ""
+        self.n_rows = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.__buf) < size:
+            row = next(self.__rows, None)
+            if row is None:
+                break
+            self.__buf += "\t".join(copy_value(v) for v in row) + "\n"
+            self.n_rows += 1
+        if size < 0:
+            size = len(self.__buf)
+        res, self.__buf = self.__buf[:size], self.__buf[size:]
+        return res
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def split_table_cols(table: str):
+    # "sanitized_tr_20240901 (msm_id,prb_id)" -> ("sanitized_tr_20240901", "msm_id,prb_id")
+    p = table.find("(")
+    if p == -1:
+        return table.strip(), None
+    return table[:p].strip(), table[p + 1:table.rfind(")")].strip()
+
+
 class Database:
     def __init__(self, params: str = "dbname=cira user=lsh password=danyang-03.postgres.lsh"):
+        self.__params = params
         self.__conn = psycopg2.connect(params)
+        self.__n_cursors = 0
+
+    def clone(self):
+        # A new connection with the same parameters, e.g., for a writer thread
+        return Database(self.__params)
+
+    def close(self):
+        self.__conn.close()
+
+    def commit(self):
+        self.__conn.commit()
+
+    def rollback(self):
+        self.__conn.rollback()
 
     def query_raw(self, sql):
         with self.__conn.cursor() as cur:
             cur.execute(sql)
             return cur.fetchall()
 
-    def execute_raw(self, sqls: list):
+    def iter_query_raw(self, sql, itersize: int = 2000, batched: bool = False, withhold: bool = False):
+        # Named (server-side) cursor, rows are transferred `itersize` at a time. The cursor ends with
+        # the transaction, so write the results on another connection (clone()) while the rows are
+        # consumed. withhold=True keeps it alive across commits of this connection instead, but
+        # Postgres then materializes the rest of the result at the first commit.
+        self.__n_cursors += 1
+        name = f"iter_query_{self.__n_cursors}"
+        with self.__conn.cursor(name=name, withhold=withhold) as cur:
+            cur.itersize = itersize
+            cur.execute(sql)
+            while True:
+                rows = cur.fetchmany(itersize)
+                if len(rows) == 0:
+                    break
+                if batched:
+                    yield rows
+                else:
+                    yield from rows
+        self.__conn.commit()
+
+    def iter_query(self, table: str, cols: str = "*", where: str = "true", additional="",
+                   itersize: int = 2000, batched: bool = False, withhold: bool = False):
+        sql = f"SELECT {cols} FROM {table} WHERE {where} {additional}"
+        return self.iter_query_raw(sql, itersize, batched, withhold)
+
+    def execute_raw(self, sqls: list, commit: bool = True):
         with self.__conn.cursor() as cur:
             for sql in sqls:
                 if type(sql) == tuple or type(sql) == list:
@@ -18,7 +129,8 @@ class Database:
                     cur.execute(cmd, params)
                 else:
                     cur.execute(sql)
-        self.__conn.commit()
+        if commit:
+            self.__conn.commit()
 
     def query(self, table: str, cols: str = "*", where: str = "true", additional=""):
         sql = f"SELECT {cols} FROM {table} WHERE {where} {additional}"
@@ -30,15 +142,93 @@ class Database:
             cur.executemany(sql, rows)
         self.__conn.commit()
 
-    def insert(self, table: str, rows: list):
+    def bulk_update(self, table: str, key_cols: list, set_cols: list, rows, chunk_size: int = None):
+        # Each row is key values followed by set values. The rows are COPY-ed into a temporary table
+        # and applied by a single UPDATE ... FROM join per chunk, committing after each chunk.
+        cols = list(key_cols) + list(set_cols)
+        stage = "update_stage_" + table.replace(".", "_")
+        sets = ", ".join(f"{col}=s.{col}" for col in set_cols)
+        conds = " and ".join(f"t.{col}=s.{col}" for col in key_cols)
+        rows = iter(rows)
+        start = time.time()
+        n_rows = 0
+        try:
+            with self.__conn.cursor() as cur:
+                cur.execute(f"CREATE TEMP TABLE {stage} ON COMMIT DELETE ROWS AS " +
+                            f"SELECT {','.join(cols)} FROM {table} WITH NO DATA")
+                while True:
+                    chunk = rows if chunk_size is None else itertools.islice(rows, chunk_size)
+                    reader = CopyReader(chunk)
+                    cur.copy_expert(f"COPY {stage} FROM STDIN", reader)
+                    if reader.n_rows == 0:
+                        break
+                    cur.execute(f"UPDATE {table} AS t SET {sets} FROM {stage} AS s WHERE {conds}")
+                    self.__conn.commit()
+                    n_rows += reader.n_rows
+                    if chunk_size is None:
+                        break
+        except Exception:
+            self.__conn.rollback()
+            raise
+        finally:
+            self.execute_raw([f"DROP TABLE IF EXISTS {stage}"])
+        end = time.time()
+        print("update %d rows of %s in %.2fs (%.0f rows/s)" %
+              (n_rows, table, end - start, n_rows / max(end - start, 1e-6)))
+        return n_rows
+
+    def insert(self, table: str, rows: list, copy: bool = False, commit: bool = True):
+        # commit=False leaves the rows in the open transaction, e.g., to commit them with other writes
         if len(rows) == 0:
             return
 
-        placeholders = '(' + ','.join(["%s"] * len(rows[0])) + ')'
-        sql = f"INSERT INTO {table} VALUES {placeholders} ON CONFLICT DO NOTHING"
+        start = time.time()
+        if copy:
+            self.copy_insert(table, rows, commit)
+        else:
+            placeholders = '(' + ','.join(["%s"] * len(rows[0])) + ')'
+            sql = f"INSERT INTO {table} VALUES {placeholders} ON CONFLICT DO NOTHING"
+            with self.__conn.cursor() as cur:
+                cur.executemany(sql, rows)
+            if commit:
+                self.__conn.commit()
+        end = time.time()
+        print("insert %d rows into %s by %s in %.2fs (%.0f rows/s)" %
+              (len(rows), split_table_cols(table)[0], "copy" if copy else "executemany",
+               end - start, len(rows) / max(end - start, 1e-6)))
+
+    def copy_insert(self, table: str, rows, commit: bool = True):
+        # COPY rows into a temporary staging table, then merge with the same ON CONFLICT DO NOTHING semantics
+        name, cols = split_table_cols(table)
+        cols = "*" if cols is None else cols
+        stage = "copy_stage_" + name.replace(".", "_")
         with self.__conn.cursor() as cur:
-            cur.executemany(sql, rows)
-        self.__conn.commit()
+            # The stage is dropped at commit, or by hand when more rows follow in the same transaction
+            cur.execute(f"DROP TABLE IF EXISTS {stage}")
+            cur.execute(f"CREATE TEMP TABLE {stage} ON COMMIT DROP AS SELECT {cols} FROM {name} WITH NO DATA")
+            reader = CopyReader(rows)
+            cur.copy_expert(f"COPY {stage} FROM STDIN", reader)
+            cur.execute(f"INSERT INTO {table} SELECT * FROM {stage} ON CONFLICT DO NOTHING")
+        if commit:
+            self.__conn.commit()
+        return reader.n_rows
+
+    def get_watermark(self, stage: str, cloud: str, table_tag: str):
+        # Input rows of the stage up to the watermark are processed, None if the stage never completed
+        with self.__conn.cursor() as cur:
+            cur.execute("SELECT watermark FROM stage_watermark WHERE stage=%s and cloud=%s and table_tag=%s",
+                        (stage, cloud, table_tag))
+            row = cur.fetchone()
+        return None if row is None else row[0]
+
+    def set_watermark(self, stage: str, cloud: str, table_tag: str, watermark):
+        # Never moves backwards
+        if watermark is None:
+            return
+        self.execute_raw([("INSERT INTO stage_watermark (stage, cloud, table_tag, watermark) VALUES (%s, %s, %s, %s) " +
+                           "ON CONFLICT (stage, cloud, table_tag) DO UPDATE SET " +
+                           "watermark=GREATEST(stage_watermark.watermark, excluded.watermark), updated_at=now()",
+                           (stage, cloud, table_tag, watermark))])
 
     def delete(self, table: str, where: str):
         sql = f"DELETE FROM {table} WHERE {where}"
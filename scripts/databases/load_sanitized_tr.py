@@ -1,36 +1,56 @@
 import sys
 import json
-import database
+import itertools
 import ipaddress
-import utils
 import argparse
 from datetime import datetime
-from utils import geodist
-from geolocate import ip_asn_org
-
-parser = argparse.ArgumentParser()
-parser.add_argument('-c', '--cloud', metavar='cloud',
-                    type=str, help="AWS, Azure, Google")
-parser.add_argument('-s', '--start_time', metavar='start_time',
-                    type=str, help="eg. 2024-04-07 10:00:00-04:00", required=True)
-parser.add_argument('-t', '--table_tag', metavar='table_tag',
-                    type=str, help="20240304 or 20240901", required=True)
-parser.add_argument('-l', '--locate_pop_done', action='store_true')
-args = parser.parse_args()
-print(' '.join(sys.argv), args)
+
+# Importing this module has no side effects: utils (database) and IpAsnOrg are loaded when first
+# used, and the CLI is main().
+
+
+def get_watermark(stage, cloud, table_tag, incremental=True):
+    if not incremental:
+        return None
+    import utils
+    return utils.db.get_watermark(stage, cloud, table_tag)
+
+
+def time_bound(col, start_time, watermark=None, op=">="):
+    # SQL condition on the timestamp column `col`: by `op` after start_time, and from the watermark on
+    conds = []
+    if start_time is not None:
+        conds.append(f"{col}{op}'{start_time}'")
+    if watermark is not None:
+        conds.append(f"{col}>='{watermark}'")
+    return " and ".join(conds) if len(conds) > 0 else "true"
+
+
+def new_watermark(table, col, where, incremental=True):
+    # Taken before a stage runs and set after it completes, so that a failed run is redone
+    if not incremental:
+        return None
+    import utils
+    return utils.db.query(table, f"max({col})", where)[0][0]
+
 
 # We put this function here instead of utils to align the sanitization with the table in db,
 # because in the future we may change sanitization
 
 
-def sanitize_tr_hops_20240304(traceroute):  # ripe atlas format:
+def sanitize_tr_hops_20240304(traceroute, get_hop_rtts=None):  # ripe atlas format:
+    # get_hop_rtts: hop -> [(ip, rtts)], utils.get_hop_rtts by default. Library callers pass it to
+    # sanitize without importing utils, which connects to the database.
+    if get_hop_rtts is None:
+        import utils
+        get_hop_rtts = utils.get_hop_rtts
     if "result" not in traceroute:
         return []
     hops = []
     ip_rtts = {}
     for i, hop in enumerate(traceroute["result"]):
         # hop_rtts is already sorted by the number of IP appearances in a hop
-        hop_rtts = utils.get_hop_rtts(hop)
+        hop_rtts = get_hop_rtts(hop)
         for (ip, rtts) in hop_rtts:
             if ip not in ip_rtts:
                 ip_rtts[ip] = []
@@ -49,38 +69,82 @@ def sanitize_tr_hops_20240304(traceroute):  # ripe atlas format:
     return hops
 
 
-def load(clouds, table_tag, start_time):
-    ipasn = ip_asn_org.IpAsnOrg(dirt=f"{utils.data_dir}")
+def lookup_asns(ipasn, ips):
+    # One vectorized lookup for all distinct IPs of a batch
+    ips = list(ips)
+    asns, _ = ipasn.lookup_many(ips)
+    return {ip: asn for ip, asn in zip(ips, asns.tolist()) if asn != -1}
+
+
+def add_hop_asns(ip_asn, src_ip, sanitized_hops):
+    # Set hop["asn"] and return the number of ASes on the path including the source
+    asns = set()
+    src_asn = ip_asn.get(src_ip)
+    if src_asn is not None:
+        asns.add(src_asn)
+    for hop in sanitized_hops:
+        hop["asn"] = ip_asn.get(hop["ip"])
+        if hop["asn"] is not None:
+            asns.add(hop["asn"])
+    return len(asns)
+
+
+def load_batch(traceroutes, cloud, ipasn):
+    traces = []
+    ips = set()
+    for msm_id, prb_id, timestamp, result, region, service, target, ip_from in traceroutes:
+        sanitized_hops = sanitize_tr_hops_20240304(result)
+        traces.append((msm_id, prb_id, timestamp, sanitized_hops, region, service, target, ip_from))
+        ips.add(ip_from)
+        ips.update(hop["ip"] for hop in sanitized_hops)
+    ip_asn = lookup_asns(ipasn, ips)
+
+    rows = []
+    for msm_id, prb_id, timestamp, sanitized_hops, region, service, target, ip_from in traces:
+        reach_dst = False
+        if len(sanitized_hops) > 0 and target == sanitized_hops[-1]["ip"]:
+            reach_dst = True
+
+        asn_len = add_hop_asns(ip_asn, ip_from, sanitized_hops)
+        rows.append([msm_id, prb_id, timestamp, json.dumps(sanitized_hops),
+                     reach_dst, cloud, region, service, asn_len])
+    return rows
+
+
+def default_ipasn(use_shm=False):
+    import utils
+    from geolocate import ip_asn_org
+    return ip_asn_org.IpAsnOrg(dirt=f"{utils.data_dir}", use_shm=use_shm)
+
+
+def load(clouds, table_tag, start_time, incremental=False, copy=True, ipasn=None, use_shm=False):
+    # ipasn: IpAsnOrg, built from utils.data_dir by default
+    import utils
+    if ipasn is None:
+        ipasn = default_ipasn(use_shm)
 
+    reader = utils.db.clone()  # the traceroutes are streamed while the results are inserted
     for cloud in clouds:
-        traceroutes = utils.db.query(
+        bound = time_bound("rc.timestamp", start_time, get_watermark("load", cloud, table_tag, incremental), ">")
+        where = f"rc.msm_id=rm.msm_id and rc.msm_type='TRACEROUTE' and rc.cloud='{cloud}' and {bound}"
+        if incremental:
+            where += f" and NOT EXISTS (SELECT 1 FROM sanitized_tr_{table_tag} AS st " + \
+                "WHERE st.msm_id=rc.msm_id and st.prb_id=rc.prb_id)"
+        watermark = new_watermark("ripe_cloud as rc, ripe_measure_meta as rm", "rc.timestamp", where, incremental)
+        batches = reader.iter_query(
             "ripe_cloud as rc, ripe_measure_meta as rm",
             "rc.msm_id,rc.prb_id,rc.timestamp,rc.result,btrim(rc.region),btrim(rc.service),rm.target,rc.ip_from",
-            f"rc.msm_id=rm.msm_id and rc.msm_type='TRACEROUTE' and rc.cloud='{cloud}' and rc.timestamp>'{start_time}'")
-        rows = []
-        for msm_id, prb_id, timestamp, result, region, service, target, ip_from in traceroutes:
-            sanitized_hops = sanitize_tr_hops_20240304(result)
-            reach_dst = False
-            if len(sanitized_hops) > 0 and target == sanitized_hops[-1]["ip"]:
-                reach_dst = True
-
-            asns = set()
-            prb_asn = ipasn.lookup(ip_from)
-            if prb_asn is not None:
-                asns.add(prb_asn["asn"])
-            for hop in sanitized_hops:
-                asn = ipasn.lookup(hop["ip"])
-                if asn is not None:
-                    asns.add(asn["asn"])
-                    hop["asn"] = asn["asn"]
-                else:
-                    hop["asn"] = None
-
-            rows.append([msm_id, prb_id, timestamp, json.dumps(sanitized_hops),
-                         reach_dst, cloud, region, service, len(asns)])
-        print(cloud, len(rows))
-        utils.db.insert(
-            f"sanitized_tr_{table_tag} (msm_id,prb_id,timestamp,sanitized_hops,reach_dst,cloud,region,service,asn_len)", rows)
+            where, batched=True)
+        n_rows = 0
+        for traceroutes in batches:
+            rows = load_batch(traceroutes, cloud, ipasn)
+            n_rows += len(rows)
+            utils.db.insert(
+                f"sanitized_tr_{table_tag} (msm_id,prb_id,timestamp,sanitized_hops,reach_dst,cloud,region,service,asn_len)", rows,
+                copy=copy)
+        print(cloud, n_rows)
+        utils.db.set_watermark("load", cloud, table_tag, watermark)
+    reader.close()
 
     # # reach_dst is set by SQL
     # set_reach_dst = f'''
@@ -102,16 +166,17 @@ def load(clouds, table_tag, start_time):
     # utils.db.execute_raw([set_reach_dst])
 
 
-def get_dns_ping_rtts(cloud, start_time):
+def get_dns_ping_rtts(cloud, start_time, epochs=None):
     # length(rm.tag)=34 refers to tag 'ping Azure VMs to compare with DNS'
     # rows = utils.db.query("ripe_cloud as rc,ripe_measure_meta as rm",
     #                       "rc.msm_id, prb_id, rc.cloud, btrim(rc.region), btrim(rc.service), launch_time, rc.msm_type, result",
     #                       "rc.msm_id = rm.msm_id and (rc.msm_type = 'DNS' or rc.msm_type = 'PING')" +
     #                       f" and (length(rm.tag) = 0 or length(rm.tag) = 34) and rc.cloud='{cloud}'")
+    import utils
     rows = utils.db.query("ripe_cloud as rc,ripe_measure_meta as rm",
                           "rc.msm_id, prb_id, rc.cloud, btrim(rc.region), btrim(rc.service), start_time, rc.msm_type, result",
                           "rc.msm_id = rm.msm_id and (rc.msm_type = 'DNS' or rc.msm_type = 'PING')" +
-                          f" and length(rm.tag) = 0 and rc.cloud='{cloud}' and start_time>='{start_time}'")
+                          f" and length(rm.tag) = 0 and rc.cloud='{cloud}' and {time_bound('start_time', start_time)}")
     ping_rtts = {}
     dns_rtts = {}
     for msm_id, prb_id, cloud, region, service, start_time, msm_type, result in rows:
@@ -120,6 +185,8 @@ def get_dns_ping_rtts(cloud, start_time):
         # if msm_type == 'DNS' and cloud == 'AWS':
         #     epoch = '24092400'
         # epoch = utils.get_epoch_label(start_time)
+        if epochs is not None and epoch not in epochs:
+            continue  # only the epochs of the traces being updated
         trace = (prb_id, (cloud, region, service), epoch)
         if msm_type == 'PING':
             utils.dict_init(ping_rtts, [trace], [])
@@ -141,18 +208,24 @@ def get_dns_ping_rtts(cloud, start_time):
     # '''
 
 
-def update_rtts(clouds, table_tag, start_time):
+def update_rtts(clouds, table_tag, start_time, incremental=False):
+    import utils
     for cloud in clouds:
-        ping_rtts, dns_rtts = get_dns_ping_rtts(cloud, start_time)
-        print(cloud, len(ping_rtts), len(dns_rtts))
+        watermark = get_watermark("update_rtts", cloud, table_tag, incremental)
 
         # utils.db.execute_raw(
         #     [f"UPDATE {table} SET ping_rtts=NULL, dns_rtts=NULL, tr_rtts=NULL " +
         #      f"WHERE cloud='{cloud}' and timestamp>={start_time}"])
+        where = f"st.msm_id=rm.msm_id and st.cloud='{cloud}' and {time_bound('rm.start_time', start_time, watermark)}"
+        watermark = new_watermark(f"sanitized_tr_{table_tag} as st,ripe_measure_meta as rm", "rm.start_time", where, incremental)
         rows = utils.db.query(f"sanitized_tr_{table_tag} as st,ripe_measure_meta as rm",
                               "st.msm_id,st.prb_id,st.cloud,btrim(st.region),btrim(st.service),rm.start_time, sanitized_hops -> -1 -> 'rtts', reach_dst",
-                              f"st.msm_id=rm.msm_id and st.cloud='{cloud}' and rm.start_time>='{start_time}'")
-        sqls = []
+                              where)
+        # pings and DNS are matched to the traces by epoch, whenever their own measurements started
+        epochs = set(utils.get_epoch_label(row[5]) for row in rows)
+        ping_rtts, dns_rtts = get_dns_ping_rtts(cloud, start_time, epochs)
+        print(cloud, len(ping_rtts), len(dns_rtts))
+        params = []
         for msm_id, prb_id, _, region, service, start_time, tr_rtts, reach_dst in rows:
             epoch = utils.get_epoch_label(start_time)
             trace = (prb_id, (cloud, region, service), epoch)
@@ -169,29 +242,34 @@ def update_rtts(clouds, table_tag, start_time):
                 if rtt_list is not None:
                     rtt_list.sort()  # simplify future minimum operation in sql
 
-            sql = f"UPDATE sanitized_tr_{table_tag} SET ping_rtts=%s, dns_rtts=%s, tr_rtts=%s" + \
-                f" WHERE msm_id={msm_id} and prb_id={prb_id}"
-            sqls.append((sql, rtts))
+            params.append([msm_id, prb_id] + rtts)
 
-        print(cloud, len(sqls))
-        utils.db.execute_raw(sqls)
+        print(cloud, len(params))
+        utils.db.bulk_update(f"sanitized_tr_{table_tag}", ["msm_id", "prb_id"],
+                             ["ping_rtts", "dns_rtts", "tr_rtts"], params, chunk_size=100000)
+        utils.db.set_watermark("update_rtts", cloud, table_tag, watermark)
 
 
-def update_ingressASN(cloud, table_tag):
+def update_ingressASN(cloud, table_tag, incremental=False):
+    import utils
+    watermark = get_watermark("update_ingressASN", cloud, table_tag, incremental)
+    new = new_watermark(f"sanitized_tr_{table_tag}", "timestamp",
+                        f"cloud='{cloud}' and {time_bound('timestamp', None, watermark)}", incremental)
     utils.db.execute_raw(
-        [f"UPDATE sanitized_tr_{table_tag} SET ingress_asn=NULL WHERE cloud='{cloud}'"])
+        [f"UPDATE sanitized_tr_{table_tag} SET ingress_asn=NULL WHERE cloud='{cloud}' and {time_bound('timestamp', None, watermark)}"])
     sql = f'''
     update sanitized_tr_{table_tag} as st
     set ingress_asn=tb.pen_asn
     from tr_borders_{table_tag} as tb
             left join ip_geo_{table_tag} on tb.pop = ip_geo_{table_tag}.ip
-    where st.cloud='{cloud}'
+    where st.cloud='{cloud}' and {time_bound('st.timestamp', None, watermark)}
     and st.msm_id = tb.msm_id
     and st.prb_id = tb.prb_id
     and ((ip_geo_{table_tag}.geo_method != 'local' and (not separated or colocated))
         or (ip_geo_{table_tag}.geo_method = 'local' and colocated))
     '''
     utils.db.execute_raw([sql])
+    utils.db.set_watermark("update_ingressASN", cloud, table_tag, new)
     # # Need to run load_ip_geo.py, and set reach_dst and create tr_as_path_2024xxxx in table.sql
     # for cloud in ["AWS", "Azure", "Google"]:
     #     print(cloud)
@@ -223,12 +301,100 @@ def update_ingressASN(cloud, table_tag):
     #     utils.db.execute_raw(sqls)
 
 
-def update_dist(cloud, table_tag):
+def tr_dist_metrics(prb_coord, vm_coord, pop_coord, e2e_rtts, pop_rtts, dist=None):
+    # (dist_e2e, dist_pop, eff_in, eff_ex, eff_e2e) of a traceroute in, distances in km and
+    # efficiencies in km/ms. pop_coord is None if the pop is not located, dist is utils.geodist.geodist by default
+    if dist is None:
+        import utils
+        dist = utils.geodist.geodist
+
+    dist_e2e = None
+    eff_e2e = None
+    if prb_coord is not None and vm_coord is not None:
+        dist_e2e = dist(prb_coord, vm_coord)
+        if e2e_rtts is not None and len(e2e_rtts) > 0:
+            rtt_e2e = min(e2e_rtts)
+            if rtt_e2e != 0:
+                eff_e2e = dist_e2e / rtt_e2e
+
+    dist_ex = None
+    eff_ex = None
+    if prb_coord is not None and pop_coord is not None:
+        dist_ex = dist(prb_coord, pop_coord)
+        rtt_ex = min(pop_rtts)
+        if rtt_ex != 0:  # TODO: Need to consider the colocation
+            eff_ex = dist_ex / rtt_ex
+
+    dist_in = None
+    eff_in = None
+    if pop_coord is not None and vm_coord is not None:
+        dist_in = dist(pop_coord, vm_coord)
+        if e2e_rtts is not None and len(e2e_rtts) > 0:
+            rtt_in = min(e2e_rtts) - min(pop_rtts)
+            if rtt_in != 0:  # TODO: Need to consider the fluctuation and negative values
+                eff_in = dist_in / rtt_in
+
+    dist_pop = None
+    if dist_ex is not None and dist_in is not None:
+        dist_pop = dist_ex + dist_in
+    return dist_e2e, dist_pop, eff_in, eff_ex, eff_e2e
+
+
+def trout_dist_metrics(prb_coord, vm_coord, pop_coord, rtts, reach_dst, pop_rtts, dist=None):
+    # Same as tr_dist_metrics for a traceroute out, rtts are the ones of the last hop
+    if dist is None:
+        import utils
+        dist = utils.geodist.geodist
+
+    dist_e2e = None
+    eff_e2e = None
+    if prb_coord is not None and vm_coord is not None:
+        dist_e2e = dist(prb_coord, vm_coord)
+        if reach_dst:
+            rtt_e2e = min(rtts)
+            if rtt_e2e != 0:
+                eff_e2e = dist_e2e / rtt_e2e
+
+    dist_ex = None
+    eff_ex = None
+    if prb_coord is not None and pop_coord is not None:
+        dist_ex = dist(pop_coord, prb_coord)
+        if reach_dst:
+            rtt_ex = min(rtts) - min(pop_rtts)
+            if rtt_ex != 0:  # TODO: Need to consider the colocation
+                eff_ex = dist_ex / rtt_ex
+
+    dist_in = None
+    eff_in = None
+    if pop_coord is not None and vm_coord is not None:
+        dist_in = dist(vm_coord, pop_coord)
+        rtt_in = min(pop_rtts)
+        if rtt_in != 0:  # TODO: Need to consider the fluctuation and negative values
+            eff_in = dist_in / rtt_in
+
+    dist_pop = None
+    if dist_ex is not None and dist_in is not None:
+        dist_pop = dist_ex + dist_in
+    return dist_e2e, dist_pop, eff_in, eff_ex, eff_e2e
+
+
+def get_probe_loc(table_tag):
+    import utils
+    return utils.get_probes_coordinates("probe20240801" if table_tag == "20240901" else "probe20231130")
+
+
+def update_dist(cloud, table_tag, incremental=False, probe_loc=None, cloud_region_loc=None):
+    # probe_loc: prb_id -> coordinates, cloud_region_loc: cloud -> region -> coordinates, queried by default
+    import utils
+    if probe_loc is None:
+        probe_loc = get_probe_loc(table_tag)
+    if cloud_region_loc is None:
+        cloud_region_loc = utils.get_cloud_region_loc()
+    watermark = get_watermark("update_dist", cloud, table_tag, incremental)
+    new = new_watermark(f"sanitized_tr_{table_tag}", "timestamp",
+                        f"cloud='{cloud}' and {time_bound('timestamp', None, watermark)}", incremental)
     utils.db.execute_raw(
-        [f"UPDATE sanitized_tr_{table_tag} SET dist_e2e_km=NULL, dist_pop_km=NULL, in_efficiency=NULL, ex_efficiency=NULL, all_efficiency=NULL WHERE cloud='{cloud}'"])
-    probe_loc = utils.get_probes_coordinates(
-        "probe20240801" if table_tag == "20240901" else "probe20231130")
-    cloud_region_loc = utils.get_cloud_region_loc()
+        [f"UPDATE sanitized_tr_{table_tag} SET dist_e2e_km=NULL, dist_pop_km=NULL, in_efficiency=NULL, ex_efficiency=NULL, all_efficiency=NULL WHERE cloud='{cloud}' and {time_bound('timestamp', None, watermark)}"])
     rtt_col = 'tr_rtts'
     if cloud == 'AWS':
         rtt_col = 'dns_rtts'
@@ -236,55 +402,30 @@ def update_dist(cloud, table_tag):
         f" sanitized_tr_{table_tag} as st left join (tr_borders_{table_tag} join ip_geo_{table_tag} on tr_borders_{table_tag}.pop = ip_geo_{table_tag}.ip) as tb" +
         " on st.msm_id = tb.msm_id and st.prb_id = tb.prb_id",
         f"st.msm_id, st.prb_id, {rtt_col}, tb.pop_rtts, tb.lat, tb.lng, st.cloud, btrim(st.region)",
-        f"cloud='{cloud}'")
+        f"cloud='{cloud}' and {time_bound('st.timestamp', None, watermark)}")
     print(len(trs))
 
-    sqls = []
+    params = []
     for msm_id, prb_id, e2e_rtts, pop_rtts, pop_lat, pop_lng, cloud, region in trs:
         prb_coord = probe_loc.get(prb_id)
         vm_coord = utils.dict_get(cloud_region_loc, [cloud, region])
 
-        dist_e2e = None
-        eff_e2e = None
-        if prb_coord is not None and vm_coord is not None:
-            dist_e2e = geodist.geodist(prb_coord, vm_coord)
-            if e2e_rtts is not None and len(e2e_rtts) > 0:
-                rtt_e2e = min(e2e_rtts)
-                if rtt_e2e != 0:
-                    eff_e2e = dist_e2e / rtt_e2e
-
-        dist_ex = None
-        eff_ex = None
-        if prb_coord is not None and pop_lat is not None:
-            dist_ex = geodist.geodist(prb_coord, (pop_lat, pop_lng))
-            rtt_ex = min(pop_rtts)
-            if rtt_ex != 0:  # TODO: Need to consider the colocation
-                eff_ex = dist_ex / rtt_ex
-
-        dist_in = None
-        eff_in = None
-        if pop_lat is not None and vm_coord is not None:
-            dist_in = geodist.geodist((pop_lat, pop_lng), vm_coord)
-            if e2e_rtts is not None and len(e2e_rtts) > 0:
-                rtt_in = min(e2e_rtts) - min(pop_rtts)
-                if rtt_in != 0:  # TODO: Need to consider the fluctuation and negative values
-                    eff_in = dist_in / rtt_in
-
-        dist_pop = None
-        if dist_ex is not None and dist_in is not None:
-            dist_pop = dist_ex + dist_in
+        pop_coord = None if pop_lat is None else (pop_lat, pop_lng)
+        dist_e2e, dist_pop, eff_in, eff_ex, eff_e2e = tr_dist_metrics(prb_coord, vm_coord, pop_coord,
+                                                                      e2e_rtts, pop_rtts)
+        params.append((msm_id, prb_id, dist_e2e, dist_pop, eff_in, eff_ex, eff_e2e))
 
-        sqls.append((f"UPDATE sanitized_tr_{table_tag}" +
-                    " SET dist_e2e_km=%s, dist_pop_km=%s, in_efficiency=%s, ex_efficiency=%s, all_efficiency=%s" +
-                     f" WHERE msm_id={msm_id} and prb_id={prb_id}", (dist_e2e, dist_pop, eff_in, eff_ex, eff_e2e)))
-
-    print(cloud, len(sqls))
-    utils.db.execute_raw(sqls)
+    print(cloud, len(params))
+    utils.db.bulk_update(f"sanitized_tr_{table_tag}", ["msm_id", "prb_id"],
+                         ["dist_e2e_km", "dist_pop_km", "in_efficiency", "ex_efficiency", "all_efficiency"],
+                         params, chunk_size=100000)
+    utils.db.set_watermark("update_dist", cloud, table_tag, new)
 
 
 class Encoder:
     def __init__(self, tag):
         # start with a large constant to partition raw_id and trout_id to avoid errors in the future
+        import utils
         self.tag = tag
         self.__total_tid = 1100000000
         self.__id_encoder = {}
@@ -304,6 +445,7 @@ class Encoder:
                 self.__total_tid = max(self.__total_tid, trout_id)
 
     def __encode(cloud, region, service, dst_ip, dt: datetime):
+        import utils
         dt_str = utils.get_epoch_label(dt)
         key = "%s_%s_%s_%s_%s" % (cloud, region, service, dst_ip, dt_str)
         return key
@@ -324,157 +466,169 @@ class Encoder:
         return trout_id
 
     def save_trout_id(self):
+        import utils
         print("# of added ids:", len(self.__updated_ids))
         if len(self.__updated_ids) > 0:
             utils.db.update(f"traceroute_out_{self.tag}", "trout_id",
                             "trout_raw_id", self.__updated_ids)
 
 
-def load_out(cloud, table_tag, start_time):
-    ipasn = ip_asn_org.IpAsnOrg(dirt=f"{utils.data_dir}")
+def sanitize_trout(results):
+    import utils
+    hops = {}
+    for raw_id, result in results:
+        if "hops" not in result:
+            continue
+        for data in result["hops"]:
+            icmp_type = data["icmp_type"]
+            icmp_code = data["icmp_code"]
+            if (icmp_type, icmp_code) not in [(3, 1), (3, 3), (3, 10), (11, 0)]:
+                continue
+            ttl = data["probe_ttl"]
+            hop = {  # convert the ripe format
+                "ttl": data["reply_ttl"],
+                "from": data["addr"],
+                "rtt": data["rtt"],
+                "size": data["reply_size"]
+            }
+            if "icmpext" in data:
+                hop["icmpext"] = data["icmpext"]
+            utils.dict_init(hops, [ttl], {"hop": ttl, "result": []})
+            hops[ttl]["result"].append(hop)
+
+    if len(hops) > 0:
+        # convert the ripe format
+        for ttl in range(1, max(hops.keys()) + 1):  # make hop.id to be hop.ttl-1
+            utils.dict_init(hops, [ttl], {"hop": ttl, "result": []})
+        hops = sorted(list(hops.values()), key=lambda x: x["hop"])
+    else:
+        hops = []
+
+    return sanitize_tr_hops_20240304({"result": hops})
 
-    encoder = Encoder(table_tag)
-    rows = utils.db.query(f"traceroute_out_{table_tag}",
-                          "trout_raw_id, trout_id, result",
-                          f"cloud='{cloud}' and timestamp>='{start_time}'")
-    trouts = {}
-    for raw_id, trout_id, result in rows:
-        tid = encoder.get_trout_id(raw_id)
-        if trout_id is not None and tid != trout_id:
-            print("CRITICAL ERROR, tr_out_id diffs (%d, %d) for trout_raw_id (%d)" %
-                  (out_id, tid, raw_id))
-            exit()
-        utils.dict_init(trouts, [tid], [])
-        trouts[tid].append((raw_id, result))
-    encoder.save_trout_id()
+
+def load_out_batch(trouts, encoder, ipasn):
+    sanitized = []
+    ips = set()
+    for tid, results in trouts:
+        sanitized_hops = sanitize_trout(results)
+        sanitized.append((tid, results[0][0], sanitized_hops))
+        ips.add(encoder.trouts_raw[results[0][0]][5])  # src_ip_pub
+        ips.update(hop["ip"] for hop in sanitized_hops)
+    ip_asn = lookup_asns(ipasn, ips)
 
     records = []
-    for tid, results in trouts.items():
-        hops = {}
-        _, prb_id, cloud, region, service, src_ip_pub, dst_ip, timestamp = encoder.trouts_raw[
-            results[0][0]]
-        # print(cloud, tid, len(results))
-        for raw_id, result in results:
-            if "hops" not in result:
-                continue
-            for data in result["hops"]:
-                icmp_type = data["icmp_type"]
-                icmp_code = data["icmp_code"]
-                if (icmp_type, icmp_code) not in [(3, 1), (3, 3), (3, 10), (11, 0)]:
-                    continue
-                ttl = data["probe_ttl"]
-                hop = {  # convert the ripe format
-                    "ttl": data["reply_ttl"],
-                    "from": data["addr"],
-                    "rtt": data["rtt"],
-                    "size": data["reply_size"]
-                }
-                if "icmpext" in data:
-                    hop["icmpext"] = data["icmpext"]
-                utils.dict_init(hops, [ttl], {"hop": ttl, "result": []})
-                hops[ttl]["result"].append(hop)
-
-        if len(hops) > 0:
-            # convert the ripe format
-            for ttl in range(1, max(hops.keys()) + 1):  # make hop.id to be hop.ttl-1
-                utils.dict_init(hops, [ttl], {"hop": ttl, "result": []})
-            hops = sorted(list(hops.values()), key=lambda x: x["hop"])
-        else:
-            hops = []
-
-        sanitized_hops = sanitize_tr_hops_20240304({"result": hops})
-
-        asns = set()
-        prb_asn = ipasn.lookup(src_ip_pub)
-        if prb_asn is not None:
-            asns.add(prb_asn["asn"])
-        for hop in sanitized_hops:
-            asn = ipasn.lookup(hop["ip"])
-            if asn is not None:
-                asns.add(asn["asn"])
-                hop["asn"] = asn["asn"]
-            else:
-                hop["asn"] = None
+    for tid, raw_id, sanitized_hops in sanitized:
+        _, prb_id, cloud, region, service, src_ip_pub, dst_ip, timestamp = encoder.trouts_raw[raw_id]
+        asn_len = add_hop_asns(ip_asn, src_ip_pub, sanitized_hops)
         reach_dst = False
         if len(sanitized_hops) > 0:
             reach_dst = (sanitized_hops[-1]["ip"] == dst_ip)
         record = [tid, timestamp, cloud, region, service, src_ip_pub, dst_ip, prb_id, json.dumps(sanitized_hops),
-                  reach_dst, None, None, None, None, None, None, len(asns)]
+                  reach_dst, None, None, None, None, None, None, asn_len]
         records.append(record)
-    print(len(records))
-    utils.db.insert(f"sanitized_trout_{table_tag}", records)
+    return records
+
 
+def load_out(cloud, table_tag, start_time, incremental=False, copy=True, ipasn=None, use_shm=False):
+    import utils
+    if ipasn is None:
+        ipasn = default_ipasn(use_shm)
+
+    encoder = Encoder(table_tag)
+    where = f"cloud='{cloud}' and {time_bound('timestamp', start_time, get_watermark('load_out', cloud, table_tag, incremental))}"
+    rows = utils.db.query(f"traceroute_out_{table_tag}",
+                          "trout_raw_id, trout_id", where)
+    for raw_id, trout_id in rows:
+        tid = encoder.get_trout_id(raw_id)
+        if trout_id is not None and tid != trout_id:
+            print("CRITICAL ERROR, tr_out_id diffs (%d, %d) for trout_raw_id (%d)" %
+                  (trout_id, tid, raw_id))
+            exit()
+    encoder.save_trout_id()
 
-def update_egressASN(cloud, table_tag):
+    if incremental:
+        where += f" and NOT EXISTS (SELECT 1 FROM sanitized_trout_{table_tag} AS st " + \
+            f"WHERE st.trout_id=traceroute_out_{table_tag}.trout_id)"
+    watermark = new_watermark(f"traceroute_out_{table_tag}", "timestamp", where, incremental)
+    # trout_id is saved now, so the results can be streamed grouped by trout_id
+    # streamed on another connection while the records are inserted
+    reader = utils.db.clone()
+    rows = reader.iter_query(f"traceroute_out_{table_tag}",
+                             "trout_id, trout_raw_id, result", where,
+                             "order by trout_id, trout_raw_id")
+    n_records = 0
+    trouts = []
+    for tid, results in itertools.groupby(rows, key=lambda x: x[0]):
+        trouts.append((tid, [(raw_id, result) for _, raw_id, result in results]))
+        if len(trouts) >= 2000:
+            records = load_out_batch(trouts, encoder, ipasn)
+            n_records += len(records)
+            utils.db.insert(f"sanitized_trout_{table_tag}", records, copy=copy)
+            trouts = []
+    records = load_out_batch(trouts, encoder, ipasn)
+    n_records += len(records)
+    utils.db.insert(f"sanitized_trout_{table_tag}", records, copy=copy)
+    reader.close()
+    print(n_records)
+    utils.db.set_watermark("load_out", cloud, table_tag, watermark)
+
+
+def update_egressASN(cloud, table_tag, incremental=False):
     # Set by sql
+    import utils
+    watermark = get_watermark("update_egressASN", cloud, table_tag, incremental)
+    new = new_watermark(f"sanitized_trout_{table_tag}", "timestamp",
+                        f"cloud='{cloud}' and {time_bound('timestamp', None, watermark)}", incremental)
     sql = f'''
     update sanitized_trout_{table_tag} as st
     set egress_asn=tb.pen_asn
     from trout_borders_{table_tag} as tb
-    where cloud='{cloud}' and st.trout_id = tb.trout_id
+    where cloud='{cloud}' and {time_bound('st.timestamp', None, watermark)} and st.trout_id = tb.trout_id
         and (not separated or colocated)
     '''
     utils.db.execute_raw([sql])
-
-
-def update_dist_out(cloud, table_tag):
+    utils.db.set_watermark("update_egressASN", cloud, table_tag, new)
+
+
+def update_dist_out(cloud, table_tag, incremental=False, probe_loc=None, cloud_region_loc=None):
+    import utils
+    if probe_loc is None:
+        probe_loc = get_probe_loc(table_tag)
+    if cloud_region_loc is None:
+        cloud_region_loc = utils.get_cloud_region_loc()
+    watermark = get_watermark("update_dist_out", cloud, table_tag, incremental)
+    new = new_watermark(f"sanitized_trout_{table_tag}", "timestamp",
+                        f"cloud='{cloud}' and {time_bound('timestamp', None, watermark)}", incremental)
     utils.db.execute_raw(
-        [f"UPDATE sanitized_trout_{table_tag} SET dist_e2e_km=NULL, dist_pop_km=NULL, in_efficiency=NULL, ex_efficiency=NULL, all_efficiency=NULL WHERE cloud='{cloud}'"])
-    probe_loc = utils.get_probes_coordinates(
-        "probe20240801" if table_tag == "20240901" else "probe20231130")
-    cloud_region_loc = utils.get_cloud_region_loc()
+        [f"UPDATE sanitized_trout_{table_tag} SET dist_e2e_km=NULL, dist_pop_km=NULL, in_efficiency=NULL, ex_efficiency=NULL, all_efficiency=NULL WHERE cloud='{cloud}' and {time_bound('timestamp', None, watermark)}"])
     trs = utils.db.query(  # use left join instead of join
         f" sanitized_trout_{table_tag} as st left join (trout_borders_{table_tag} join ip_geo_{table_tag} on trout_borders_{table_tag}.pop = ip_geo_{table_tag}.ip) as tb" +
         " on st.trout_id = tb.trout_id",
         "st.trout_id, st.prb_id, sanitized_hops->-1->'rtts', reach_dst, tb.pop_rtts, tb.lat, tb.lng, st.cloud, btrim(st.region)",
-        f"cloud='{cloud}'")
+        f"cloud='{cloud}' and {time_bound('st.timestamp', None, watermark)}")
     print(len(trs))
 
-    sqls = []
+    params = []
     for trout_id, prb_id, rtts, reach_dst, pop_rtts, pop_lat, pop_lng, cloud, region in trs:
         prb_coord = probe_loc.get(prb_id)
         vm_coord = utils.dict_get(cloud_region_loc, [cloud, region])
 
-        dist_e2e = None
-        eff_e2e = None
-        if prb_coord is not None and vm_coord is not None:
-            dist_e2e = geodist.geodist(prb_coord, vm_coord)
-            if reach_dst:
-                rtt_e2e = min(rtts)
-                if rtt_e2e != 0:
-                    eff_e2e = dist_e2e / rtt_e2e
-
-        dist_ex = None
-        eff_ex = None
-        if prb_coord is not None and pop_lat is not None:
-            dist_ex = geodist.geodist((pop_lat, pop_lng), prb_coord)
-            if reach_dst:
-                rtt_ex = min(rtts) - min(pop_rtts)
-                if rtt_ex != 0:  # TODO: Need to consider the colocation
-                    eff_ex = dist_ex / rtt_ex
-
-        dist_in = None
-        eff_in = None
-        if pop_lat is not None and vm_coord is not None:
-            dist_in = geodist.geodist(vm_coord, (pop_lat, pop_lng))
-            rtt_in = min(pop_rtts)
-            if rtt_in != 0:  # TODO: Need to consider the fluctuation and negative values
-                eff_in = dist_in / rtt_in
-
-        dist_pop = None
-        if dist_ex is not None and dist_in is not None:
-            dist_pop = dist_ex + dist_in
-
-        sqls.append((f"UPDATE sanitized_trout_{table_tag}" +
-                    " SET dist_e2e_km=%s, dist_pop_km=%s, in_efficiency=%s, ex_efficiency=%s, all_efficiency=%s" +
-                     f" WHERE trout_id={trout_id}", (dist_e2e, dist_pop, eff_in, eff_ex, eff_e2e)))
+        pop_coord = None if pop_lat is None else (pop_lat, pop_lng)
+        dist_e2e, dist_pop, eff_in, eff_ex, eff_e2e = trout_dist_metrics(prb_coord, vm_coord, pop_coord,
+                                                                         rtts, reach_dst, pop_rtts)
+        params.append((trout_id, dist_e2e, dist_pop, eff_in, eff_ex, eff_e2e))
 
-    print(len(sqls))
-    utils.db.execute_raw(sqls)
+    print(len(params))
+    utils.db.bulk_update(f"sanitized_trout_{table_tag}", ["trout_id"],
+                         ["dist_e2e_km", "dist_pop_km", "in_efficiency", "ex_efficiency", "all_efficiency"],
+                         params, chunk_size=100000)
+    utils.db.set_watermark("update_dist_out", cloud, table_tag, new)
 
 
 def load_tr_pop():
-    sqls = []
+    import utils
+    params = []
     for cloud in ["AWS", "Azure", "Google"]:
         traceroutes = utils.db.query(
             "ripe_tr_pop", "msm_id,prb_id,dst_ip,result", f"cloud='{cloud}'")
@@ -483,12 +637,13 @@ def load_tr_pop():
             reach_dst = False
             if len(sanitized_hops) > 0:
                 reach_dst = (sanitized_hops[-1]["ip"] == dst_ip)
-            sqls.append(("UPDATE ripe_tr_pop SET sanitized_hops=%s, reach_dst=%s" +
-                        f" WHERE msm_id={msm_id} and prb_id={prb_id}", (json.dumps(sanitized_hops), reach_dst)))
-    utils.db.execute_raw(sqls)
+            params.append((msm_id, prb_id, json.dumps(sanitized_hops), reach_dst))
+    utils.db.bulk_update("ripe_tr_pop", ["msm_id", "prb_id"],
+                         ["sanitized_hops", "reach_dst"], params, chunk_size=100000)
 
 
 def add_asn_to_sanitized_tr():
+    import utils
     ip_asn = {}
     # Use old asn info
     for ip, asn in utils.db.query("ip_geo_20240304", "ip,asn", "asn is not null"):
@@ -496,7 +651,7 @@ def add_asn_to_sanitized_tr():
 
     rows = utils.db.query("sanitized_tr_20240304",
                           "msm_id,prb_id,sanitized_hops")
-    sqls = []
+    params = []
     for msm_id, prb_id, sanitized_hops in rows:
         for hop in sanitized_hops:
             asn = ip_asn.get(hop["ip"])
@@ -504,10 +659,10 @@ def add_asn_to_sanitized_tr():
                 hop["asn"] = asn
             else:
                 hop["asn"] = None
-        sqls.append((f"UPDATE sanitized_tr_20240304 SET sanitized_hops=%s WHERE msm_id=%s and prb_id=%s",
-                    (json.dumps(sanitized_hops), msm_id, prb_id)))
-    print(len(sqls))
-    utils.db.execute_raw(sqls)
+        params.append((msm_id, prb_id, json.dumps(sanitized_hops)))
+    print(len(params))
+    utils.db.bulk_update("sanitized_tr_20240304", ["msm_id", "prb_id"],
+                         ["sanitized_hops"], params, chunk_size=100000)
 
     rows = utils.db.query("sanitized_trout_20240304",
                           "trout_id,sanitized_hops")
@@ -519,24 +674,48 @@ def add_asn_to_sanitized_tr():
                 hop["asn"] = asn
             else:
                 hop["asn"] = None
-        params.append((json.dumps(sanitized_hops), trout_id))
+        params.append((trout_id, json.dumps(sanitized_hops)))
     print(len(params))
-    utils.db.update("sanitized_trout_20240304",
-                    "sanitized_hops", "trout_id", params)
-
+    utils.db.bulk_update("sanitized_trout_20240304", ["trout_id"],
+                         ["sanitized_hops"], params, chunk_size=100000)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cloud', metavar='cloud',
+                        type=str, help="AWS, Azure, Google")
+    parser.add_argument('-s', '--start_time', metavar='start_time',
+                        type=str, help="eg. 2024-04-07 10:00:00-04:00, optional with --incremental")
+    parser.add_argument('-t', '--table_tag', metavar='table_tag',
+                        type=str, help="20240304 or 20240901", required=True)
+    parser.add_argument('-l', '--locate_pop_done', action='store_true')
+    parser.add_argument('--no_copy', action='store_true',
+                        help="insert rows by executemany instead of COPY")
+    parser.add_argument('--shm', action='store_true',
+                        help="attach the IpAsnOrg tables published by `python -m geolocate.shm publish`")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only process the rows after the stage watermarks and not processed yet")
+    args = parser.parse_args()
+    if args.start_time is None and not args.incremental:
+        parser.error("the following arguments are required: -s/--start_time")
+    print(' '.join(sys.argv), args)
 
-if __name__ == "__main__":
     # update_rtts([args.cloud], args.table_tag, args.start_time)
     # update_dist(args.cloud, args.table_tag)
     if not args.locate_pop_done:
-        load([args.cloud], args.table_tag, args.start_time)
-        update_rtts([args.cloud], args.table_tag, args.start_time)
-        load_out(args.cloud, args.table_tag, args.start_time)
+        ipasn = default_ipasn(args.shm)
+        load([args.cloud], args.table_tag, args.start_time, args.incremental, not args.no_copy, ipasn)
+        update_rtts([args.cloud], args.table_tag, args.start_time, args.incremental)
+        load_out(args.cloud, args.table_tag, args.start_time, args.incremental, not args.no_copy, ipasn)
     else:
-        update_ingressASN(args.cloud, args.table_tag)
-        update_dist(args.cloud, args.table_tag)
-        update_egressASN(args.cloud, args.table_tag)
-        update_dist_out(args.cloud, args.table_tag)
+        probe_loc = get_probe_loc(args.table_tag)
+        update_ingressASN(args.cloud, args.table_tag, args.incremental)
+        update_dist(args.cloud, args.table_tag, args.incremental, probe_loc)
+        update_egressASN(args.cloud, args.table_tag, args.incremental)
+        update_dist_out(args.cloud, args.table_tag, args.incremental, probe_loc)
     # load_tr_pop()
     # add_asn_to_sanitized_tr()
-    pass
+
+
+if __name__ == "__main__":
+    main()
@@ -284,3 +284,26 @@ CREATE TABLE ripe_ping_pop_20240901
     FOREIGN KEY (prb_id) REFERENCES probe20240801 (prb_id)
 );
 create index ripe_ping_pop_20240901_prb_id_dst_ip on ripe_ping_pop_20240901 (prb_id, dst_ip);
+
+
+-- Position of the streaming locate_pop.py runs, committed with each chunk of border rows
+CREATE TABLE locate_pop_progress
+(
+    job        text primary key,        -- output table, cloud, start time and watermark, e.g., tr_borders_20240901:AWS:2024-09-01:None
+    position   jsonb       NOT NULL,    -- key of the last trace of the last committed chunk
+    n_rows     bigint      NOT NULL,    -- border rows written by the job
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+
+-- Per stage, cloud and table tag: the input rows up to the watermark (by timestamp) are processed.
+-- Used by the --incremental runs of load_sanitized_tr.py and locate_pop.py
+CREATE TABLE stage_watermark
+(
+    stage      text        NOT NULL, -- e.g., load, load_out, update_rtts, locate_pop_tr_borders, update_dist
+    cloud      cloud       NOT NULL,
+    table_tag  text        NOT NULL,
+    watermark  timestamptz NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (stage, cloud, table_tag)
+);
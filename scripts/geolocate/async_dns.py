@@ -1,101 +1,327 @@
-#!/usr/bin/python
 #
-# Created by Peter Krumins (peter@catonmat.net, @pkrumins on twitter)
-# www.catonmat.net -- good coders code, great coders reuse
+# Asynchronous reverse DNS (PTR) resolution with asyncio.
 #
-# Asynchronous DNS Resolution in Python.
-#
-# Read more about how this code works in my post:
-# www.catonmat.net/blog/asynchronous-dns-resolution
+# Replaces the adns-based resolver that polled adns.completed() in a sleep loop
+# (originally by Peter Krumins, www.catonmat.net/blog/asynchronous-dns-resolution).
+# Queries are plain UDP DNS messages, so there is no dependency on adns.
 #
 
-import adns, time
-from datetime import datetime
+import random
 import socket
+import struct
+import asyncio
+import ipaddress
+from datetime import datetime
+
+TYPE_CNAME = 5
+TYPE_PTR = 12
+CLASS_IN = 1
+RCODE_NXDOMAIN = 3
+
+
+def reverse_name(ip):
+    return ipaddress.ip_address(ip).reverse_pointer
+
+
+def default_nameserver():
+    try:
+        with open("/etc/resolv.conf", "r") as fin:
+            for line in fin:
+                items = line.split()
+                if len(items) >= 2 and items[0] == "nameserver":
+                    return items[1]
+    except OSError:
+        pass
+    return "8.8.8.8"
+
+
+def encode_name(name):
+    data = b""
+    for label in name.rstrip(".").split("."):
+        label = label.encode("ascii")
+        data += bytes([len(label)]) + label
+    return data + b"\0"
+
+
+def build_query(qid, name, qtype=TYPE_PTR):
+    header = struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0)  # recursion desired
+    return header + encode_name(name) + struct.pack("!HH", qtype, CLASS_IN)
+
+
+def decode_name(data, offset):
+    # Returns (name, offset after the name), follows compression pointers
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        n = data[offset]
+        if n & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((n & 0x3F) << 8) | data[offset + 1]
+            jumps += 1
+            if jumps > 64:
+                raise ValueError("DNS name compression loop")
+            continue
+        offset += 1
+        if n == 0:
+            break
+        labels.append(data[offset:offset + n].decode("ascii", errors="replace"))
+        offset += n
+    return ".".join(labels), (end if end is not None else offset)
+
+
+def parse_response(data):
+    # Returns (qid, rcode, (name, type) of the first question or None, {name: [(type, value)]} of the answer section)
+    qid, flags, qdcount, ancount, _, _ = struct.unpack_from("!HHHHHH", data, 0)
+    offset = 12
+    question = None
+    for _ in range(qdcount):
+        name, offset = decode_name(data, offset)
+        if question is None:
+            question = (name.lower(), struct.unpack_from("!H", data, offset)[0])
+        offset += 4
+    answers = {}
+    for _ in range(ancount):
+        name, offset = decode_name(data, offset)
+        rtype, _, _, rdlength = struct.unpack_from("!HHIH", data, offset)
+        offset += 10
+        if rtype in (TYPE_PTR, TYPE_CNAME):
+            value, _ = decode_name(data, offset)
+            answers.setdefault(name.lower(), []).append((rtype, value))
+        offset += rdlength
+    return qid, flags & 0xF, question, answers
+
+
+class DNSProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.pending = {}  # qid -> (future, (name, type) of the question)
+        self.mismatched = 0  # replies with a pending qid but another question, e.g., spoofed
+
+    def datagram_received(self, data, addr):
+        try:
+            qid, rcode, question, answers = parse_response(data)
+        except (ValueError, IndexError, struct.error):
+            return
+        if qid not in self.pending:
+            return
+        fut, query = self.pending[qid]
+        if question != query:  # keep waiting for the reply to our question
+            self.mismatched += 1
+            return
+        del self.pending[qid]
+        if not fut.done():
+            fut.set_result((rcode, answers))
+
+    def error_received(self, exc):
+        for fut, _ in self.pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
+        self.pending.clear()
 
 
 class AsyncResolver(object):
 
-    def __init__(self, IPs, intensity=100):
+    def __init__(self, IPs, intensity=100, nameserver=None, port=53,
+                 timeout=2.0, retries=3, backoff=0.2, max_cname=8):
         """
-        hosts: a list of hosts to resolve
-        intensity: how many hosts to resolve at once
+        IPs: a list of IP addresses to resolve
+        intensity: how many queries are in flight at once
+        timeout: deadline of a single query attempt in seconds
+        retries: attempts after the first one, with exponential backoff and jitter
         """
-        hosts = []
+        self.ips = list(IPs)
         self.intensity = intensity
-        self.adns = adns.init()
-
-        # process IP addresses into rDNS hosts
-        for IP in IPs:
-            bytes = IP.split(".")
-            bytes.reverse()
-            revIP = ".".join(bytes)
-            d = dict()
-            d["ip"] = IP
-            d["host"] = revIP + ".in-addr.arpa"
-            hosts.append(d)
-        self.hosts = hosts
-
-    def resolve(self):
-        """ Resolves hosts and returns a dictionary of { 'host': 'ip' }. """
-        resolved_hosts = []
-        active_queries = {}
-        ip_queue = self.hosts[:]
+        self.nameserver = nameserver if nameserver is not None else default_nameserver()
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_cname = max_cname
 
-        def collect_results():
+    async def __query(self, transport, protocol, name):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            qid = random.randrange(1 << 16)
+            while qid in protocol.pending:
+                qid = random.randrange(1 << 16)
+            fut = loop.create_future()
+            protocol.pending[qid] = (fut, (name.rstrip(".").lower(), TYPE_PTR))
+            transport.sendto(build_query(qid, name))
             try:
-                for query in self.adns.completed():
-                    answer = query.check()
-                    ip = active_queries[query]
-                    del active_queries[query]
-                    if answer[0] == 0:
-                        host = answer[3][0].decode("utf-8")
-                        d = dict()
-                        d["ip"] = ip["ip"]
-                        d["host"] = host
-                        d["timestamp"] = str(datetime.utcnow())
-                        resolved_hosts.append(d)
-                    elif answer[0] == 101:  # CNAME
-                        try:
-                            query = self.adns.submit(answer[1], adns.rr.PTR)
-                            active_queries[query] = ip
-                        # CNAME response has no data, so IP could not be resolved
-                        except:
-                            d = dict()
-                            d["ip"] = ip["ip"]
-                            d["host"] = None
-                            d["timestamp"] = str(datetime.utcnow())
-                            resolved_hosts.append(d)
-                    else:
-                        d = dict()
-                        d["ip"] = ip["ip"]
-                        d["host"] = None
-                        d["timestamp"] = str(datetime.utcnow())
-                        resolved_hosts.append(d)
-            except:
-                pass
-
-        def finished_resolving():
-            return len(resolved_hosts) == len(self.hosts)
-
-        while not finished_resolving():
-            while ip_queue and len(active_queries) < self.intensity:
-                ip = ip_queue.pop()
-                query = self.adns.submit(ip["host"], adns.rr.PTR)
-                active_queries[query] = ip
-            time.sleep(0.01)
-            collect_results()
-
-        return resolved_hosts
+                return await asyncio.wait_for(fut, self.timeout)
+            except (asyncio.TimeoutError, OSError):
+                protocol.pending.pop(qid, None)
+                if attempt < self.retries:
+                    await asyncio.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+        return None
+
+    async def __resolve_one(self, transport, protocol, ip):
+        host = None
+        error = None  # why an answer is missing other than NXDOMAIN or no PTR record, e.g., timeout
+        try:
+            name = reverse_name(ip)
+        except ValueError:
+            name = None
+        for _ in range(self.max_cname + 1):  # follow CNAMEs, e.g., RFC 2317 classless delegation
+            if name is None:
+                break
+            res = await self.__query(transport, protocol, name)
+            if res is None:
+                error = "timeout"
+                break
+            rcode, answers = res
+            if rcode != 0:
+                if rcode != RCODE_NXDOMAIN:
+                    error = "rcode %d" % rcode  # e.g., 2 for SERVFAIL, 5 for REFUSED
+                break
+            records = answers.get(name.lower(), [])
+            ptrs = [value for rtype, value in records if rtype == TYPE_PTR]
+            if len(ptrs) > 0:
+                host = ptrs[0]
+                break
+            cnames = [value for rtype, value in records if rtype == TYPE_CNAME]
+            if len(cnames) == 0:
+                break
+            name = cnames[0]
+            ptrs = [value for rtype, value in answers.get(name.lower(), []) if rtype == TYPE_PTR]
+            if len(ptrs) > 0:  # the server already chased the CNAME
+                host = ptrs[0]
+                break
+        return {"ip": ip, "host": host, "error": error, "timestamp": str(datetime.utcnow())}
+
+    async def resolve_iter(self):
+        """
+        Async generator of {"ip", "host", "error", "timestamp"}, in completion order. host is None
+        without PTR record or on failure, error is None unless the failure may be transient.
+        """
+        loop = asyncio.get_running_loop()
+        family = socket.AF_INET6 if ":" in self.nameserver else socket.AF_INET
+        transport, protocol = await loop.create_datagram_endpoint(
+            DNSProtocol, remote_addr=(self.nameserver, self.port), family=family)
+        # `intensity` workers share one iterator of IPs, so the number of queries in flight stays bounded
+        # and a finished query is replaced right away. The queue bounds results not yet consumed.
+        ips = iter(self.ips)
+        results = asyncio.Queue(maxsize=self.intensity * 2)
+
+        async def worker():
+            for ip in ips:
+                try:
+                    res = await self.__resolve_one(transport, protocol, ip)
+                except Exception as e:
+                    res = {"ip": ip, "host": None, "error": type(e).__name__, "timestamp": str(datetime.utcnow())}
+                await results.put(res)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(self.intensity, len(self.ips)))]
+        try:
+            for _ in range(len(self.ips)):
+                yield await results.get()
+        finally:
+            for fut in workers:
+                fut.cancel()
+            transport.close()
+
+    async def resolve_async(self):
+        return [res async for res in self.resolve_iter()]
+
+    def resolve(self):
+        """ Resolves all IPs and returns a list of {"ip", "host", "error", "timestamp"}. """
+        return asyncio.run(self.resolve_async())
 
 
 if __name__ == "__main__":
-    host_format = "www.host%d.com"
-    number_of_hosts = 20000
+    import sys
+    import time
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--local":
+        # Stand-in DNS server on localhost that answers every PTR query with a fake host name,
+        # except for the last octets below
+        #   9: NXDOMAIN, 8: SERVFAIL, 7: no reply, 6: no reply to the first query,
+        #   5: x.in-addr.arpa -> x.in-addr.arpa.cname1 -> x.in-addr.arpa.cname2 (CNAME chain as in RFC 2317),
+        #   4: reply to another question before the reply,
+        #   3: only replies to another question
+        class StandInServer(asyncio.DatagramProtocol):
+            def __init__(self):
+                self.queries = {}  # name -> number of queries
+
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def reply(self, addr, qid, question, rcode=0, answers=b"", n_answers=0):
+                self.transport.sendto(struct.pack("!HHHHHH", qid, 0x8180 | rcode, 1, n_answers, 0, 0) +
+                                      question + answers, addr)
+
+            def datagram_received(self, data, addr):
+                qid = struct.unpack_from("!H", data, 0)[0]
+                name, offset = decode_name(data, 12)
+                question = data[12:offset + 4]
+                self.queries[name] = self.queries.get(name, 0) + 1
+                octet = name.split(".")[0]
+                if octet == "9":
+                    return self.reply(addr, qid, question, rcode=3)
+                if octet == "8":
+                    return self.reply(addr, qid, question, rcode=2)
+                if octet == "7" or (octet == "6" and self.queries[name] == 1):
+                    return
+                if octet == "5" and name.endswith(".in-addr.arpa"):
+                    rdata = encode_name(name + ".cname1")
+                    answer = b"\xc0\x0c" + struct.pack("!HHIH", TYPE_CNAME, CLASS_IN, 60, len(rdata)) + rdata
+                    return self.reply(addr, qid, question, answers=answer, n_answers=1)
+                if name.endswith(".cname1"):
+                    rdata = encode_name(name[:-len(".cname1")] + ".cname2")
+                    answer = b"\xc0\x0c" + struct.pack("!HHIH", TYPE_CNAME, CLASS_IN, 60, len(rdata)) + rdata
+                    return self.reply(addr, qid, question, answers=answer, n_answers=1)
+                if octet in ("3", "4"):
+                    other = encode_name("1.0.0.10.in-addr.arpa") + struct.pack("!HH", TYPE_PTR, CLASS_IN)
+                    rdata = encode_name("spoofed.example.net")
+                    answer = b"\xc0\x0c" + struct.pack("!HHIH", TYPE_PTR, CLASS_IN, 60, len(rdata)) + rdata
+                    self.reply(addr, qid, other, answers=answer, n_answers=1)
+                    if octet == "3":
+                        return
+                rdata = encode_name("host-" + name.split(".in-addr")[0].replace(".", "-") + ".example.net")
+                answer = b"\xc0\x0c" + struct.pack("!HHIH", TYPE_PTR, CLASS_IN, 60, len(rdata)) + rdata
+                self.reply(addr, qid, question, answers=answer, n_answers=1)
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            transport, server = await loop.create_datagram_endpoint(StandInServer, local_addr=("127.0.0.1", 0))
+            port = transport.get_extra_info("sockname")[1]
+
+            resolver = AsyncResolver(["10.0.0.%d" % i for i in range(1, 10)], nameserver="127.0.0.1", port=port,
+                                     timeout=0.2, retries=2, backoff=0.01)
+            res = {r["ip"]: r for r in await resolver.resolve_async()}
+            expected = {
+                1: ("host-1-0-0-10.example.net", None),
+                3: (None, "timeout"),  # the reply to another question is not taken
+                4: ("host-4-0-0-10.example.net", None),
+                5: ("host-5-0-0-10.example.net", None),  # PTR of the end of the CNAME chain
+                6: ("host-6-0-0-10.example.net", None),  # retried
+                7: (None, "timeout"),
+                8: (None, "rcode 2"),  # SERVFAIL may be transient
+                9: (None, None),  # NXDOMAIN is an answer
+            }
+            for octet, (host, error) in expected.items():
+                r = res["10.0.0.%d" % octet]
+                assert (r["host"], r["error"]) == (host, error), (octet, r)
+            assert server.queries["7.0.0.10.in-addr.arpa"] == 3  # first attempt and 2 retries
+            assert server.queries["6.0.0.10.in-addr.arpa"] == 2
+            assert server.queries["5.0.0.10.in-addr.arpa.cname1"] == 1
+            assert server.queries["5.0.0.10.in-addr.arpa.cname2"] == 1
+            assert server.queries["3.0.0.10.in-addr.arpa"] == 3
+            print("checks passed")
 
-    hosts = [host_format % i for i in range(number_of_hosts)]
-    hosts = ["4.31.77.189"]
+            ips = ["10.1.%d.%d" % (i // 250, i % 250) for i in range(20000)]
+            ips = [ip for ip in ips if ip.split(".")[-1] not in ("3", "4", "5", "6", "7", "8")]
+            start = time.time()
+            res = await AsyncResolver(ips, intensity=100, nameserver="127.0.0.1", port=port).resolve_async()
+            end = time.time()
+            transport.close()
+            print("%d IPs, %d resolved in %.2fs (%.0f/s)" %
+                  (len(res), sum(r["host"] is not None for r in res), end - start, len(res) / (end - start)))
+            print(sorted(res, key=lambda r: r["ip"])[:2])
 
-    ar = AsyncResolver(hosts, intensity=500)
-    resolved_hosts = ar.resolve()
-    print(resolved_hosts)
+        asyncio.run(main())
+    else:
+        ar = AsyncResolver(["4.31.77.189"], intensity=500)
+        resolved_hosts = ar.resolve()
+        print(resolved_hosts)
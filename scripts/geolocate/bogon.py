@@ -0,0 +1,211 @@
+import bisect
+import ipaddress
+
+from .snapshot import ip_to_int
+
+# Non-global (bogon) address ranges as sorted integer intervals, checked with bisect instead of
+# building ipaddress objects per call. The tables are derived from the ipaddress module of the
+# running interpreter: every network in its special-purpose constants is a breakpoint, and
+# is_global is constant between breakpoints, so it is probed once per interval.
+
+V4_SHARED = ipaddress.IPv4Network("100.64.0.0/10")  # checked separately by IPv4Network.is_global
+V4_MAPPED = 0xFFFF << 32  # ::ffff:0:0/96
+
+
+def constant_networks(constants):
+    nets = []
+    for name in dir(constants):
+        if name.startswith("__"):
+            continue
+        value = getattr(constants, name)
+        for item in (value if isinstance(value, (list, tuple)) else [value]):
+            if isinstance(item, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+                nets.append(item)
+            elif isinstance(item, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+                nets.append(ipaddress.ip_network(item))
+    return nets
+
+
+def breakpoints(nets, max_ip):
+    points = {0}
+    for net in nets:
+        points.add(int(net.network_address))
+        points.add(int(net.broadcast_address) + 1)
+    return sorted(p for p in points if p <= max_ip)
+
+
+def address_table(version):
+    # (starts, is_global of [starts[i], starts[i + 1]))
+    if version == 4:
+        nets = constant_networks(ipaddress.IPv4Address._constants) + [V4_SHARED]
+        points = breakpoints(nets, (1 << 32) - 1)
+        cls = ipaddress.IPv4Address
+    else:
+        nets = constant_networks(ipaddress.IPv6Address._constants)
+        points = set(breakpoints(nets, (1 << 128) - 1))
+        # IPv4-mapped addresses follow the IPv4 table
+        points.update(V4_MAPPED + p for p in V4_STARTS)
+        points.add(V4_MAPPED + (1 << 32))
+        points = sorted(points)
+        cls = ipaddress.IPv6Address
+    starts, flags = [], []
+    for p in points:
+        flag = cls(p).is_global
+        if len(flags) == 0 or flags[-1] != flag:
+            starts.append(p)
+            flags.append(flag)
+    return starts, flags
+
+
+def network_table(version):
+    # (starts, largest broadcast address of the private networks containing [starts[i], starts[i + 1])),
+    # a network is private iff one private network contains both its network and broadcast address
+    cls = ipaddress.IPv4Network if version == 4 else ipaddress.IPv6Network
+    nets = [net for net in cls(0)._constants._private_networks]
+    starts, covers = [], []
+    for p in breakpoints(nets, (1 << cls(0).max_prefixlen) - 1):
+        cover = max([int(net.broadcast_address) for net in nets
+                     if int(net.network_address) <= p <= int(net.broadcast_address)], default=-1)
+        if len(covers) == 0 or covers[-1] != cover:
+            starts.append(p)
+            covers.append(cover)
+    return starts, covers
+
+
+V4_STARTS, V4_GLOBAL = address_table(4)
+V6_STARTS, V6_GLOBAL = address_table(6)
+NET_TABLES = {4: network_table(4), 6: network_table(6)}
+
+
+def is_global(ip):
+    """ Same as ipaddress.ip_address(ip).is_global, raises ValueError for invalid addresses """
+    try:
+        version, n = ip_to_int(ip)
+    except (OSError, TypeError, ValueError):  # e.g., scoped IPv6 or int, let ipaddress decide
+        return ipaddress.ip_address(ip).is_global
+    if version == 4:
+        return V4_GLOBAL[bisect.bisect_right(V4_STARTS, n) - 1]
+    return V6_GLOBAL[bisect.bisect_right(V6_STARTS, n) - 1]
+
+
+def is_global_many(ips):
+    """ [is_global(ip) for ip in ips] """
+    bisect_right = bisect.bisect_right
+    v4_starts, v4_global, v6_starts, v6_global = V4_STARTS, V4_GLOBAL, V6_STARTS, V6_GLOBAL
+    res = []
+    for ip in ips:
+        try:
+            version, n = ip_to_int(ip)
+        except (OSError, TypeError, ValueError):
+            res.append(ipaddress.ip_address(ip).is_global)
+            continue
+        if version == 4:
+            res.append(v4_global[bisect_right(v4_starts, n) - 1])
+        else:
+            res.append(v6_global[bisect_right(v6_starts, n) - 1])
+    return res
+
+
+def network_is_global(prefix):
+    """ Same as ipaddress.ip_network(prefix).is_global (strict), raises ValueError for invalid prefixes """
+    addr, sep, length = prefix.partition("/")
+    try:
+        version, n = ip_to_int(addr)
+    except (OSError, TypeError, ValueError):
+        return ipaddress.ip_network(prefix).is_global
+    bits = 32 if version == 4 else 128
+    if sep == "":
+        length = bits
+    elif length.isascii() and length.isdigit() and int(length) <= bits:
+        length = int(length)
+    else:  # netmask/hostmask forms and invalid lengths
+        return ipaddress.ip_network(prefix).is_global
+    hostmask = (1 << (bits - length)) - 1
+    if n & hostmask != 0:  # host bits set
+        return ipaddress.ip_network(prefix).is_global
+    broadcast = n | hostmask
+
+    starts, covers = NET_TABLES[version]
+    if broadcast <= covers[bisect.bisect_right(starts, n) - 1]:
+        return False
+    if version == 4 and int(V4_SHARED.network_address) <= n and broadcast <= int(V4_SHARED.broadcast_address):
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    # Compare with ipaddress on a randomized corpus, biased towards the special-purpose ranges
+    import random
+    import time
+
+    random.seed(1)
+    special = {4: constant_networks(ipaddress.IPv4Address._constants) + [V4_SHARED],
+               6: constant_networks(ipaddress.IPv6Address._constants) +
+               [ipaddress.IPv6Network("::ffff:0:0/96")]}
+
+    def random_int(version):
+        bits = 32 if version == 4 else 128
+        r = random.random()
+        if r < 0.4:
+            return random.getrandbits(bits)
+        net = random.choice(special[version])
+        start, end = int(net.network_address), int(net.broadcast_address)
+        if r < 0.8:
+            return random.randint(start, end)
+        return min(max(random.choice([start, end]) + random.randint(-2, 2), 0), (1 << bits) - 1)
+
+    def to_str(version, n):
+        s = str(ipaddress.ip_address(n) if version == 4 else ipaddress.IPv6Address(n))
+        r = random.random()
+        if version == 6 and V4_MAPPED <= n < V4_MAPPED + (1 << 32) and r < 0.3:
+            return "::ffff:" + str(ipaddress.IPv4Address(n - V4_MAPPED))
+        if version == 6 and r < 0.05:
+            return s + "%eth0"
+        if version == 6 and r < 0.2:
+            return ipaddress.IPv6Address(n).exploded
+        if r < 0.05:  # invalid: leading zeros, spaces, garbage
+            return random.choice(["0" + s, s + " ", s + ".1", "x" + s])
+        return s
+
+    def outcome(func, arg):
+        try:
+            return func(arg)
+        except ValueError:
+            return "ValueError"
+
+    ips = []
+    for _ in range(500000):
+        version = random.choice([4, 6])
+        ips.append(to_str(version, random_int(version)))
+    bad = [ip for ip in ips if outcome(is_global, ip) != outcome(lambda x: ipaddress.ip_address(x).is_global, ip)]
+    print("addresses: %d tested, %d mismatches %s" % (len(ips), len(bad), bad[:5]))
+    valid = [ip for ip in ips if outcome(is_global, ip) != "ValueError"]
+    assert is_global_many(valid) == [is_global(ip) for ip in valid]
+
+    prefixes = []
+    for _ in range(300000):
+        version = random.choice([4, 6])
+        bits = 32 if version == 4 else 128
+        n = random_int(version)
+        length = random.randint(0, bits) if random.random() < 0.3 else random.randint(bits // 4, bits)
+        if random.random() < 0.9:
+            n &= ~((1 << (bits - length)) - 1)
+        s = to_str(version, n)
+        r = random.random()
+        prefixes.append(s if r < 0.05 else f"{s}/{length:03d}" if r < 0.1 else f"{s}/{length}")
+    bad = [p for p in prefixes
+           if outcome(network_is_global, p) != outcome(lambda x: ipaddress.ip_network(x).is_global, p)]
+    print("networks: %d tested, %d mismatches %s" % (len(prefixes), len(bad), bad[:5]))
+
+    for name, func in [("ipaddress", lambda ips: [ipaddress.ip_address(ip).is_global for ip in ips]),
+                       ("bogon", is_global_many)]:
+        start = time.time()
+        func(valid)
+        end = time.time()
+        print("%-9s %d addresses in %.2fs (%.0f/s)" % (name, len(valid), end - start, len(valid) / (end - start)))
+    for name, func in [("ipaddress", lambda x: ipaddress.ip_network(x).is_global), ("bogon", network_is_global)]:
+        start = time.time()
+        for p in prefixes:
+            outcome(func, p)
+        end = time.time()
+        print("%-9s %d networks in %.2fs (%.0f/s)" % (name, len(prefixes), end - start, len(prefixes) / (end - start)))
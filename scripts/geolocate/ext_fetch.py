@@ -0,0 +1,251 @@
+#
+# Concurrent lookups against the external geolocation APIs (RIPE IPmap, ipinfo).
+#
+# Every service has its own token-bucket rate limit, concurrency cap, timeout and retry policy
+# (exponential backoff with jitter on timeouts, connection errors, 429 and 5xx). Worker threads
+# keep one pooled requests.Session each, so connections are reused across lookups.
+#
+
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        """ rate: requests per second (None for no limit), burst: bucket size """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 1.0)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate is None:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Service:
+    def __init__(self, name, url, params=None, parse=None, rate=10.0, concurrency=8,
+                 timeout=10.0, retries=3, backoff=0.5):
+        """
+        url: format string with {ip}, params: query parameters of every request
+        parse: json body of a 200 response -> result
+        """
+        self.name = name
+        self.url = url
+        self.params = params
+        self.parse = parse if parse is not None else (lambda body: body)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate)
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+
+def ipinfo_details(body):
+    # Same latitude/longitude fields as ipinfo.Handler.getDetails(ip).details
+    if "loc" in body and "latitude" not in body:
+        try:
+            body["latitude"], body["longitude"] = body["loc"].split(",")
+        except ValueError:
+            pass
+    return body
+
+
+def ripe_service(base_url="https://ipmap-api.ripe.net", **kwargs):
+    kwargs.setdefault("rate", 20.0)
+    kwargs.setdefault("concurrency", 8)
+    return Service("ripe", base_url.rstrip("/") + "/v1/locate/{ip}", **kwargs)
+
+
+def ipinfo_service(token=None, base_url="https://ipinfo.io", **kwargs):
+    kwargs.setdefault("rate", 50.0)
+    kwargs.setdefault("concurrency", 16)
+    params = {"token": token} if token is not None else None
+    return Service("ipinfo", base_url.rstrip("/") + "/{ip}", params=params, parse=ipinfo_details, **kwargs)
+
+
+class ExternalFetcher:
+    def __init__(self, services):
+        self.services = {service.name: service for service in services}
+        self.stats = {name: {"requests": 0, "ok": 0, "not_found": 0, "failed": 0, "retries": 0}
+                      for name in self.services}
+        self.__local = threading.local()
+        self.__stats_lock = threading.Lock()
+        self.__failed = set()  # (name, ip) of lookups that failed after all retries, see takeFailed
+
+    def __session(self):
+        session = getattr(self.__local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(self.services), pool_maxsize=4)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.__local.session = session
+        return session
+
+    def __count(self, name, key):
+        with self.__stats_lock:
+            self.stats[name][key] += 1
+
+    def takeFailed(self, name, ip):
+        """ Whether the last None of fetchOne(name, ip) was a failure rather than not found, and forget it """
+        with self.__stats_lock:
+            if (name, ip) in self.__failed:
+                self.__failed.discard((name, ip))
+                return True
+        return False
+
+    def fetchOne(self, name, ip):
+        """ Parsed result of a 200 response, or None (not found, or failed after all retries, see takeFailed) """
+        service = self.services[name]
+        session = self.__session()
+        for attempt in range(service.retries + 1):
+            if attempt > 0:
+                self.__count(name, "retries")
+                time.sleep(service.backoff * (2 ** (attempt - 1)) * (0.5 + random.random()))
+            service.bucket.acquire()
+            self.__count(name, "requests")
+            try:
+                with service.slots:
+                    response = session.get(service.url.format(ip=ip), params=service.params,
+                                           timeout=service.timeout)
+            except requests.RequestException:
+                continue
+            if response.status_code == 200:
+                try:
+                    res = service.parse(response.json())
+                except ValueError:
+                    break
+                self.__count(name, "ok")
+                return res
+            if response.status_code not in RETRY_STATUS:
+                self.__count(name, "not_found")
+                return None
+        self.__count(name, "failed")
+        with self.__stats_lock:
+            self.__failed.add((name, ip))
+        return None
+
+    def fetch(self, name, ips):
+        """ Generator of (ip, result or None) in completion order """
+        ips = list(ips)
+        if len(ips) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.services[name].concurrency, len(ips))) as pool:
+            futures = {pool.submit(self.fetchOne, name, ip): ip for ip in ips}
+            for fut in as_completed(futures):
+                yield futures[fut], fut.result()
+
+
+if __name__ == "__main__":
+    # Checks and benchmark against a stand-in server on localhost that mimics both APIs, with 20ms
+    # of latency. The first request of every 20th IP gets 429 or 503 (retried), x.x.x.8 always
+    # gets 503 (failed) and x.x.x.9 gets 404 (not found).
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    requests_seen = {}  # path -> number of requests
+    requests_lock = threading.Lock()
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(0.02)
+            path = self.path.split("?")[0]
+            ip = path.rsplit("/", 1)[-1]
+            with requests_lock:
+                requests_seen[path] = requests_seen.get(path, 0) + 1
+                n = requests_seen[path]
+            last = int(ip.rsplit(".", 1)[-1])
+            if ip.endswith(".8"):
+                status, body = 503, {}
+            elif last % 20 == 0 and n == 1:
+                status, body = random.choice([429, 503]), {}
+            elif ip.endswith(".9"):
+                status, body = 404, {"error": "not found"}
+            elif path.startswith("/v1/locate/"):
+                status, body = 200, {"locations": [{"cityName": "Amsterdam", "countryCodeAlpha2": "NL",
+                                                    "latitude": 52.37, "longitude": 4.89}]}
+            else:
+                status, body = 200, {"ip": ip, "city": "Tokyo", "country": "JP", "loc": "35.6895,139.6917"}
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:%d" % server.server_address[1]
+
+    def new_fetcher(concurrency, rate=None):
+        return ExternalFetcher([
+            ripe_service(base_url, rate=rate, concurrency=concurrency, backoff=0.01),
+            ipinfo_service("TOKEN", base_url, rate=rate, concurrency=concurrency, backoff=0.01)])
+
+    ips = ["10.0.%d.%d" % (i // 250, i % 250) for i in range(300)]
+
+    # fetch (concurrent) returns the same results as fetchOne (sequential), retries included
+    for name in ["ripe", "ipinfo"]:
+        requests_seen.clear()
+        sequential = new_fetcher(1)
+        expected = {ip: sequential.fetchOne(name, ip) for ip in ips}
+        requests_seen.clear()
+        concurrent = new_fetcher(32)
+        res = dict(concurrent.fetch(name, ips))
+        assert res == expected, name
+        assert all((res[ip] is None) == ip.endswith((".8", ".9")) for ip in ips), name
+        assert concurrent.stats[name]["failed"] == sum(ip.endswith(".8") for ip in ips)
+        assert concurrent.stats[name]["not_found"] == sum(ip.endswith(".9") for ip in ips)
+        assert concurrent.stats[name]["retries"] >= sum(int(ip.rsplit(".", 1)[-1]) % 20 == 0 for ip in ips)
+        assert concurrent.takeFailed(name, "10.0.0.8") and not concurrent.takeFailed(name, "10.0.0.8")
+        assert not concurrent.takeFailed(name, "10.0.0.9")
+    print("fetch agrees with fetchOne")
+
+    for concurrency in [1, 32]:
+        fetcher = new_fetcher(concurrency)
+        for name in ["ripe", "ipinfo"]:
+            requests_seen.clear()
+            start = time.time()
+            res = dict(fetcher.fetch(name, ips))
+            end = time.time()
+            print("%-6s concurrency %2d: %d IPs, %d found in %.2fs (%.0f IPs/s) %s" %
+                  (name, concurrency, len(res), sum(r is not None for r in res.values()),
+                   end - start, len(res) / (end - start), fetcher.stats[name]))
+    print(res[ips[0]])
+
+    # The token bucket caps the request rate: after the burst, at most `rate` requests per second
+    rate = 50.0
+    fetcher = ExternalFetcher([ripe_service(base_url, rate=rate, concurrency=32)])
+    n_ips = 200
+    start = time.time()
+    res = dict(fetcher.fetch("ripe", ips[:n_ips]))
+    elapsed = time.time() - start
+    n_requests = fetcher.stats["ripe"]["requests"]
+    assert elapsed >= (n_requests - fetcher.services["ripe"].bucket.burst) / rate, (n_requests, elapsed)
+    print("ripe   rate limit %.0f/s: %d IPs, %d requests in %.2fs" % (rate, len(res), n_requests, elapsed))
+    server.shutdown()
@@ -0,0 +1,244 @@
+import os
+import sys
+import csv
+import math
+
+# Offline place name <-> coordinate tables consulted before the Google Maps API.
+# Seeded from the gmap_geo/gmap_rgeo caches and the IATA table, saved as a TSV file that
+# does not depend on the redis db version.
+
+
+def parse_geocode(res):
+    try:
+        return res[0]["geometry"]["location"]
+    except Exception:
+        return None
+
+
+def parse_reverse_geocode(res):
+    # (place, country) of a reverse geocoding result, the same fields as GeoLocate.gmapReverseGeocode
+    if len(res) > 0:
+        items = res[0]["address_components"]
+        addr1 = None
+        addr2 = None
+        country = None
+        for item in items:
+            if "administrative_area_level_1" in item["types"]:
+                addr1 = item["long_name"]
+            if "administrative_area_level_2" in item["types"]:
+                addr2 = item["long_name"]
+            if "country" in item["types"]:
+                country = item["short_name"]
+        if country is None:
+            return (None, None)
+        if addr2 is not None:
+            return (addr2, country)
+        return (addr1, country)
+    return (None, None)
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371.0088 * math.asin(min(1.0, math.sqrt(a)))
+
+
+def coord_key(lat, lng):
+    return "%.5f,%.5f" % (lat, lng)
+
+
+class Gazetteer:
+    def __init__(self, cell_deg=0.5):
+        self.cell_deg = cell_deg
+        self.places = {}  # "place,country" (lowercase) -> {"lat", "lng"}
+        self.coords = {}  # "%.5f,%.5f" -> (place, country), exact reverse geocoding results
+        self.points = []  # [(lat, lng, place, country, priority)], 0 for reverse geocoding results
+        self.grid = {}  # grid cell -> indexes of points
+
+    def __len__(self):
+        return len(self.places) + len(self.points)
+
+    def __cell(self, lat, lng):
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def addPlace(self, addr, lat, lng):
+        self.places[addr.lower()] = {"lat": float(lat), "lng": float(lng)}
+
+    def addPoint(self, lat, lng, place, country, priority=0):
+        if priority == 0:
+            self.coords[coord_key(lat, lng)] = (place, country)
+        self.grid.setdefault(self.__cell(lat, lng), []).append(len(self.points))
+        self.points.append((float(lat), float(lng), place, country, priority))
+
+    def geocode(self, addr):
+        return self.places.get(addr.lower())
+
+    def reverse(self, lat, lng, max_km=0.0, max_priority=0):
+        # Exact coordinates with max_km=0, otherwise the nearest point within max_km among the points
+        # of priority <= max_priority, i.e., only reverse geocoding results unless airports (1) are
+        # allowed, which are then only preferred by distance after the reverse geocoding results.
+        if max_km <= 0:
+            return self.coords.get(coord_key(lat, lng))
+        best = None
+        span = int(math.ceil(max_km / (111.0 * self.cell_deg * max(math.cos(math.radians(lat)), 0.01))))
+        lat_span = int(math.ceil(max_km / (111.0 * self.cell_deg)))
+        x, y = self.__cell(lat, lng)
+        n_lng = int(round(360 / self.cell_deg))
+        for i in range(x - lat_span, x + lat_span + 1):
+            for j in range(y - span, y + span + 1):
+                j = (j + n_lng // 2) % n_lng - n_lng // 2  # wrap around the antimeridian
+                for idx in self.grid.get((i, j), []):
+                    p_lat, p_lng, place, country, priority = self.points[idx]
+                    if priority > max_priority:
+                        continue
+                    dist = haversine_km(lat, lng, p_lat, p_lng)
+                    if dist <= max_km and (best is None or (priority, dist) < best[0]):
+                        best = ((priority, dist), (place, country))
+        return None if best is None else best[1]
+
+    def save(self, filename):
+        tmp = f"{filename}.tmp{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as fout:
+            writer = csv.writer(fout, delimiter="\t", lineterminator="\n")
+            for addr, loc in self.places.items():
+                writer.writerow(["place", addr, repr(loc["lat"]), repr(loc["lng"]), "", ""])
+            for lat, lng, place, country, priority in self.points:
+                writer.writerow(["point", priority, repr(lat), repr(lng),
+                                 "" if place is None else place, "" if country is None else country])
+        os.replace(tmp, filename)
+
+    @staticmethod
+    def load(filename):
+        gaz = Gazetteer()
+        with open(filename, "r", encoding="utf-8") as fin:
+            for kind, key, lat, lng, place, country in csv.reader(fin, delimiter="\t"):
+                if kind == "place":
+                    gaz.addPlace(key, float(lat), float(lng))
+                else:
+                    gaz.addPoint(float(lat), float(lng), place if len(place) > 0 else None,
+                                 country if len(country) > 0 else None, int(key))
+        return gaz
+
+
+def cached_reverse(dbv):
+    # (lat, lng, place, country) of the reverse geocoding results cached in a redis db version
+    from .redis_cache import RedisCache
+
+    for coord, res in RedisCache("gmap_rgeo", db=dbv, codec="detect").scan_namespace():
+        place, country = parse_reverse_geocode(res)
+        if country is not None:
+            lat, lng = coord.split(",")
+            yield float(lat), float(lng), place, country
+
+
+def build(dirt, dbv, points=None):
+    # points: (lat, lng, place, country) of reverse geocoding results, all cached ones by default
+    from .redis_cache import RedisCache
+
+    gaz = Gazetteer()
+    for addr, res in RedisCache("gmap_geo", db=dbv, codec="detect").scan_namespace():
+        loc = parse_geocode(res)
+        if loc is not None:
+            gaz.addPlace(addr, loc["lat"], loc["lng"])
+    for lat, lng, place, country in (cached_reverse(dbv) if points is None else points):
+        gaz.addPoint(lat, lng, place, country)
+    # Airports only answer approximate reverse lookups when asked for (max_priority=1, i.e.,
+    # GeoLocate(gazetteer_km=..., gazetteer_airports=True)), where no reverse geocoding result is
+    # close. CLLI coordinates have no names, their reverse geocoding results are already in gmap_rgeo.
+    with open(f"{dirt}/iata-icao.csv", "r", encoding="utf-8") as fin:
+        for row in csv.DictReader(fin):
+            try:
+                gaz.addPoint(float(row["latitude"]), float(row["longitude"]),
+                             row["region_name"], row["country_code"], priority=1)
+            except ValueError:
+                pass
+    return gaz
+
+
+def check(dirt, dbv, max_km, max_priority=0, sample=5):
+    # Offline check of the approximate answers: the gazetteer is built without every other cached
+    # reverse geocoding result, and answers for those coordinates are compared with the cached API
+    # answers. Prints and returns the counts.
+    points = list(cached_reverse(dbv))
+    held_out = points[1::2]
+    gaz = build(dirt, dbv, points[0::2])
+    counts = {"held_out": len(held_out), "answered": 0, "same": 0, "same_country": 0}
+    diffs = []
+    for lat, lng, place, country in held_out:
+        res = gaz.reverse(lat, lng, max_km, max_priority)
+        if res is None:
+            continue
+        counts["answered"] += 1
+        if res == (place, country):
+            counts["same"] += 1
+        elif res[1] == country:
+            counts["same_country"] += 1
+        if res != (place, country) and len(diffs) < sample:
+            diffs.append(((lat, lng), (place, country), res))
+    print("max_km=%s max_priority=%d:" % (max_km, max_priority), counts)
+    for coord, api, near in diffs:
+        print("  %s api=%s gazetteer=%s" % (coord, api, near))
+    return counts
+
+
+def self_check():
+    # Offline checks of a small synthetic gazetteer, including a save/load round trip
+    import tempfile
+
+    gaz = Gazetteer()
+    gaz.addPlace("Frankfurt,DE", 50.1109, 8.6821)
+    gaz.addPoint(50.1109, 8.6821, "Frankfurt", "DE")
+    gaz.addPoint(50.0379, 8.5622, "Hesse", "DE", priority=1)  # FRA airport, 11 km away
+    gaz.addPoint(48.3538, 11.7861, "Bavaria", "DE", priority=1)  # MUC airport, no other point near
+    gaz.addPoint(-16.5, 179.99, "Northern", "FJ")
+    with tempfile.TemporaryDirectory() as dirt:
+        gaz.save(f"{dirt}/gazetteer.tsv")
+        loaded = Gazetteer.load(f"{dirt}/gazetteer.tsv")
+    for g in [gaz, loaded]:
+        assert g.geocode("frankfurt,de") == {"lat": 50.1109, "lng": 8.6821}
+        assert g.geocode("Berlin,DE") is None
+        assert g.reverse(50.1109, 8.6821) == ("Frankfurt", "DE")  # exact
+        assert g.reverse(50.0379, 8.5622) is None  # airports are not exact answers
+        assert g.reverse(50.12, 8.69) is None  # exact only by default
+        assert g.reverse(50.12, 8.69, 5) == ("Frankfurt", "DE")
+        assert g.reverse(50.04, 8.56, 5) is None  # only the airport is within 5 km
+        assert g.reverse(50.04, 8.56, 5, max_priority=1) == ("Hesse", "DE")
+        assert g.reverse(50.04, 8.56, 20, max_priority=1) == ("Frankfurt", "DE")  # preferred over airports
+        assert g.reverse(48.35, 11.78, 10) is None
+        assert g.reverse(48.35, 11.78, 10, max_priority=1) == ("Bavaria", "DE")
+        assert g.reverse(-16.5, -179.99, 5) == ("Northern", "FJ")  # across the antimeridian
+        assert g.reverse(0.0, 0.0, 100, max_priority=1) is None
+    print("gazetteer self-check passed")
+
+
+if __name__ == "__main__":
+    # Seed the gazetteer from the caches of a redis db version, e.g., from scripts/:
+    #   python -m geolocate.gazetteer --dirt ../data --db 2
+    # check the approximate reverse geocoding against the cached answers:
+    #   python -m geolocate.gazetteer --dirt ../data --db 2 --check 1 5 10
+    # or run the offline self-check:
+    #   python -m geolocate.gazetteer --self_check
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dirt', metavar='dirt', type=str, default="../data")
+    parser.add_argument('--db', metavar='db', type=int, default=0,
+                        help="redis db version (0 for 20240304, 2 for 20240815)")
+    parser.add_argument('--check', metavar='km', type=float, nargs='*',
+                        help="instead of saving, compare the nearest answers within these radiuses with the cached API answers")
+    parser.add_argument('--self_check', action='store_true',
+                        help="only run the offline checks on a synthetic gazetteer")
+    args = parser.parse_args()
+    if args.self_check:
+        self_check()
+        sys.exit(0)
+    if args.check is not None:
+        for km in args.check or [1.0, 5.0, 10.0]:
+            check(args.dirt, args.db, km)
+            check(args.dirt, args.db, km, max_priority=1)
+        sys.exit(0)
+    gaz = build(args.dirt, args.db)
+    filename = f"{args.dirt}/geolocate_cache/gazetteer.tsv"
+    gaz.save(filename)
+    print("Saved %d places and %d points to %s" % (len(gaz.places), len(gaz.points), filename))
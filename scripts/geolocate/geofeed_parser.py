@@ -1,7 +1,8 @@
 
 import io
 import csv
-import ipaddress
+
+from .bogon import network_is_global
 
 
 def stripComment(line):
@@ -25,7 +26,7 @@ def parseGeofeed(line):
     if len(items) != 5:
         return None
     try:
-        if not ipaddress.ip_network(items[0]).is_global:
+        if not network_is_global(items[0]):
             return None
     except:
         return None
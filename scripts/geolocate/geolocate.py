@@ -1,64 +1,230 @@
 import os
-import re
 import csv
 import time
 import json
-import ipaddress
-import requests
-import pickle
+import threading
 
-import tldextract
 import pytricia
 import googlemaps
-import ipinfo
 
 from .geofeed_parser import parseGeofeed
 from .async_dns import AsyncResolver
+from .ext_fetch import ExternalFetcher, ripe_service, ipinfo_service
 from .redis_cache import RedisCache
+from . import snapshot
+from . import shm
+from .hoiho_index import DomainExtractor, load_rules
+from .bogon import is_global, is_global_many
+from .gazetteer import Gazetteer, parse_geocode, parse_reverse_geocode
+from .pipeline import Resolver, Pipeline
+from .records import Airport, IX, intern, geofeed_value
 
 
 class GeoLocate:
-    def __init__(self, dirt="../../data", google_api_key=None, ipinfo_token=None, dbv=0):
+    # In-process LRU per cache namespace, e.g., {"loc": {"lru_entries": 1000000}}
+    LRU_DEFAULT = {
+        "gmap_geo": {"lru_entries": 100000},
+        "gmap_rgeo": {"lru_entries": 100000},
+    }
+
+    # Attributes loaded on first access -> source
+    LAZY_SOURCES = {
+        "iata_loc": "geocode", "clli_loc": "geocode",
+        "pyt_geofeeds": "geofeeds",
+        "pyt_ispfeeds": "ispfeeds",
+        "ixs": "peeringDB", "ixlans": "peeringDB", "pyt_pdb": "peeringDB",
+        "hoiho": "hoiho",
+        "domain_of": "domain",
+        "gazetteer": "gazetteer",
+        "gmaps": "gmaps",
+    }
+    # Static sources -> snapshot sections
+    STATIC_SECTIONS = {
+        "geocode": ["iata_loc", "clli_loc"],
+        "geofeeds": ["pyt_geofeeds"],
+        "ispfeeds": ["pyt_ispfeeds"],
+        "peeringDB": ["ixs", "ixlans", "pyt_pdb"],
+        "hoiho": ["hoiho"],
+    }
+
+    # Fallback chain after local and loc_cache
+    PIPELINE_DEFAULT = ["geofeed", "ispfeed", "peeringDB", "rdns", "ripe", "ipinfo"]
+
+    def __init__(self, dirt="../../data", google_api_key=None, ipinfo_token=None, dbv=0, lru=None, codecs=None,
+                 neg_ttl=7 * 24 * 3600, use_snapshot=True, gazetteer_km=0.0, external=None,
+                 pipeline=None, call_budget=None, run_budget=None, lazy=True, use_shm=False, transient_ttl=600,
+                 gazetteer_airports=False):
         start = time.time()
+        self.__lock = threading.RLock()
+        self.__loaded = set()
+        self.__snapshot = None
+        self.__google_api_key = google_api_key
         self.cnt = 0
+        self.net_calls = 0  # calls to Google Maps, DNS, RIPE IPmap and ipinfo
         self.dirt = dirt
         self.dbv = dbv
-        self.gmaps = googlemaps.Client(key=google_api_key)
-        self.ipinfo_handler = ipinfo.getHandler(ipinfo_token)
+        self.lru = GeoLocate.LRU_DEFAULT if lru is None else lru
+        # Value codec per cache namespace, e.g., {"loc": "loc"}. By default the codec recorded by
+        # migrate_cache.py, or json for namespaces that were not migrated (see RedisCache).
+        self.codecs = codecs
+        # IPs that no source can locate are remembered for neg_ttl seconds (None to disable), or for
+        # transient_ttl seconds when a source failed (timeout, SERVFAIL, 429/5xx) instead of answering
+        self.neg_ttl = neg_ttl
+        self.transient_ttl = transient_ttl
+        self.__transient = set()  # IPs with a failed source since their last negative entry
+        self.use_snapshot = use_snapshot
+        self.use_shm = use_shm
+        # Reverse geocoding falls back to the nearest reverse geocoding result of the gazetteer within
+        # gazetteer_km, exact coordinates only by default (see `python -m geolocate.gazetteer --check`).
+        # gazetteer_airports: the IATA airports answer where no reverse geocoding result is that close
+        self.gazetteer_km = gazetteer_km
+        self.gazetteer_max_priority = 1 if gazetteer_airports else 0
+        # Options of the RIPE IPmap/ipinfo services, e.g., {"ripe": {"base_url": ..., "rate": 20.0}}
+        external = {} if external is None else external
+        self.ext = ExternalFetcher([ripe_service(**external.get("ripe", {})),
+                                    ipinfo_service(ipinfo_token, **external.get("ipinfo", {}))])
         self.__initCache()
-        self.__initGeoCode()
         self.__initLocal()
-        self.__initGeoFeeds()
-        self.__initProviderFeeds()
-        self.__initPeeringDB()
-        self.__initRDNS()
-        self.__check_data()
+        self.__initPipeline(GeoLocate.PIPELINE_DEFAULT if pipeline is None else pipeline, call_budget, run_budget)
+        if not lazy:
+            self.warm()
         end = time.time()
         print("GeoLocate init finished in %.2fs" % (end - start))
         print(
             f"Using redis db version {dbv}. (0 for 20240304, 2 for 20240815)")
 
+    def __newCache(self, name):
+        codec = "detect" if self.codecs is None else self.codecs.get(name)
+        return RedisCache(name, db=self.dbv, codec=codec, **self.lru.get(name, {}))
+
     def __initCache(self):
-        self.loc_cache = RedisCache("loc", db=self.dbv)
-        self.gmap_geo_cache = RedisCache("gmap_geo", db=self.dbv)
-        self.gmap_rgeo_cache = RedisCache("gmap_rgeo", db=self.dbv)
-        self.rDNS_cache = RedisCache("rdns", db=self.dbv)
-        self.ripe_cache = RedisCache("ripe", db=self.dbv)
-        self.ipinfo_cache = RedisCache("ipinfo", db=self.dbv)
+        self.loc_cache = self.__newCache("loc")
+        self.gmap_geo_cache = self.__newCache("gmap_geo")
+        self.gmap_rgeo_cache = self.__newCache("gmap_rgeo")
+        self.rDNS_cache = self.__newCache("rdns")
+        self.ripe_cache = self.__newCache("ripe")
+        self.ipinfo_cache = self.__newCache("ipinfo")
+        self.loc_neg_cache = self.__newCache("loc_neg")
+
+    def cacheStats(self):
+        return [cache.stats() for cache in [self.loc_cache, self.loc_neg_cache, self.gmap_geo_cache,
+                                            self.gmap_rgeo_cache, self.rDNS_cache, self.ripe_cache,
+                                            self.ipinfo_cache]]
+
+    def invalidateNegative(self):
+        # Call after refreshing geofeeds, PeeringDB, hoiho, etc. so that unlocated IPs are retried
+        n_keys = self.loc_neg_cache.clear()
+        print("Removed %d negative loc entries" % n_keys)
+        return n_keys
+
+    def __addNegative(self, ips):
+        if self.neg_ttl is None or len(ips) == 0:
+            return
+        now = int(time.time())
+        transient = [ip for ip in ips if ip in self.__transient]
+        self.__transient.difference_update(transient)
+        transient = set(transient)
+        self.loc_neg_cache.add_many({ip: {"timestamp": now} for ip in ips if ip not in transient}, ex=self.neg_ttl)
+        self.loc_neg_cache.add_many({ip: {"timestamp": now, "transient": True} for ip in transient},
+                                    ex=self.transient_ttl)
 
     def dumpCache(self):
         print("dumpCache is deprecated")
 
-    def __readFromPkl(self, pkl_name, readFunc):  # Not used yet
-        pkl_name = f"{self.dirt}/geolocate_cache/" + pkl_name
-        if os.path.isfile(pkl_name):
-            with open(pkl_name, "rb") as fin:
-                results = pickle.load(fin)
-                return results
-        results = readFunc()
-        with open(pkl_name, "wb") as fout:
-            pickle.dump(results, fout)
-        return results
+    def __staticSources(self):
+        return [f"{self.dirt}/iata-icao.csv",
+                f"{self.dirt}/clli-lat-lon.230606.txt",
+                f"{self.dirt}/geolocate_cache/cache_geofeed.csv",
+                f"{self.dirt}/geofeeds/ripedb_geofeed.csv",
+                f"{self.dirt}/geofeeds/geofeed-finder.csv",
+                f"{self.dirt}/geofeeds/opengeofeed.csv",
+                f"{self.dirt}/ip_ranges/aws-ip-ranges.json",
+                f"{self.dirt}/peeringDB/peeringDB_ix.json",
+                f"{self.dirt}/peeringDB/peeringDB_ixlan.json",
+                f"{self.dirt}/peeringDB/peeringDB_ixpfx.json",
+                f"{self.dirt}/peeringDB/peeringDB_netixlan.json",
+                f"{self.dirt}/202103-midar-iff.geo-re.json"]
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set yet: load the source of a lazy attribute
+        source = GeoLocate.LAZY_SOURCES.get(name)
+        if source is None:
+            raise AttributeError(name)
+        self.__load(source)
+        return self.__dict__[name]
+
+    def warm(self):
+        # Load every source now, like the eager constructor did
+        for source in dict.fromkeys(GeoLocate.LAZY_SOURCES.values()):
+            self.__load(source)
+
+    def __load(self, source):
+        with self.__lock:
+            if source in self.__loaded:
+                return
+            start = time.time()
+            if source == "gmaps":
+                self.gmaps = googlemaps.Client(key=self.__google_api_key)
+            elif source == "domain":
+                self.domain_of = DomainExtractor()
+            elif source == "gazetteer":
+                self.__initGazetteer()
+            else:
+                self.__initStatic(source)
+            self.__loaded.add(source)
+            if source == "geofeeds":
+                self.__check_data()
+            print("GeoLocate %s loaded in %.2fs" % (source, time.time() - start))
+
+    def __initStatic(self, source):
+        # The tables parsed from the static datasets are saved in a snapshot (see snapshot.py),
+        # which is rebuilt when any source file changes. PyTricia tables are stored as interval arrays.
+        # Sections of a fresh snapshot are loaded per source, a rebuild parses every source.
+        # With use_shm, the snapshot published by publish() is attached from shared memory first.
+        if self.__snapshot is None:
+            snap = None
+            if self.use_shm:
+                snap = shm.attach(shm.segment_name("static", self.dirt), self.__staticSources())
+            if snap is None and self.use_snapshot:
+                snap = snapshot.load_lazy(self.__snapshotPath(), self.__staticSources())
+            self.__snapshot = snap or False
+        if self.__snapshot:
+            for name in GeoLocate.STATIC_SECTIONS[source]:
+                setattr(self, name, self.__snapshot.get(name))
+            return
+
+        self.__buildStatic(self.use_snapshot)
+        if source != "geofeeds":
+            self.__check_data()
+
+    def __snapshotPath(self):
+        return f"{self.dirt}/geolocate_cache/static.snapshot"
+
+    def __buildStatic(self, save):
+        self.__initGeoCode()
+        self.__initGeoFeeds()
+        self.__initProviderFeeds()
+        self.__initPeeringDB()
+        self.__initRDNS()
+        self.__loaded.update(GeoLocate.STATIC_SECTIONS.keys())
+        if save:
+            path = self.__snapshotPath()
+            snapshot.save(path, self.__staticSources(),
+                          {"iata_loc": self.iata_loc, "clli_loc": self.clli_loc, "ixs": self.ixs,
+                           "ixlans": self.ixlans, "hoiho": self.hoiho},
+                          {"pyt_geofeeds": snapshot.PrefixTable.fromPyTricia(self.pyt_geofeeds),
+                           "pyt_ispfeeds": snapshot.PrefixTable.fromPyTricia(self.pyt_ispfeeds),
+                           "pyt_pdb": snapshot.PrefixTable.fromPyTricia(self.pyt_pdb)})
+            print("GeoLocate snapshot saved to", path)
+
+    def publish(self):
+        # Publish the static snapshot to shared memory, for GeoLocate(use_shm=True) in other processes
+        path = self.__snapshotPath()
+        with self.__lock:
+            if snapshot.load_lazy(path, self.__staticSources()) is None:
+                self.__buildStatic(True)
+            with open(path, "rb") as fin:
+                shm.publish(shm.segment_name("static", self.dirt), fin.read())
 
     def __check_data(self):
         if len(self.pyt_geofeeds) != 208309:
@@ -79,7 +245,7 @@ class GeoLocate:
         with open(f"{self.dirt}/iata-icao.csv", "r", encoding="utf-8") as fin:
             reader = csv.DictReader(fin)
             for row in reader:
-                self.iata_loc[row["iata"].lower()] = row
+                self.iata_loc[row["iata"].lower()] = Airport(row)
         # print("iata_loc:", len(self.iata_loc))
 
         self.clli_loc = {}
@@ -98,7 +264,7 @@ class GeoLocate:
             with open(cachename, "r", encoding="utf-8") as fin:
                 reader = csv.reader(fin)
                 for row in reader:
-                    self.pyt_geofeeds[row[0]] = row
+                    self.pyt_geofeeds[row[0]] = geofeed_value(row)
         else:
             fout = open(cachename, "w", encoding="utf-8")
             writer = csv.writer(fout, lineterminator="\n")
@@ -107,7 +273,7 @@ class GeoLocate:
                     for line in fin:
                         row = parseGeofeed(line)
                         if row is not None:
-                            self.pyt_geofeeds[row[0]] = row
+                            self.pyt_geofeeds[row[0]] = geofeed_value(row)
                             writer.writerow(row)
             fout.close()
         # print("pyt_geofeed:", len(self.pyt_geofeeds))
@@ -118,7 +284,7 @@ class GeoLocate:
             data = json.loads(fin.read())
             for item in data["prefixes"]:
                 self.pyt_ispfeeds[item["ip_prefix"]
-                                  ] = item["network_border_group"]
+                                  ] = intern(item["network_border_group"])
         # print("pyt_ispfeeds:", len(self.pyt_ispfeeds))
 
     def __initPeeringDB(self):
@@ -128,13 +294,13 @@ class GeoLocate:
         with open(f"{self.dirt}/peeringDB/peeringDB_ix.json", "r", encoding="utf-8") as fin:
             data = json.loads(fin.read())["data"]
             for ix in data:
-                self.ixs[ix["id"]] = ix
+                self.ixs[ix["id"]] = IX(ix)
         # print("ixs:", len(self.ixs))
 
         with open(f"{self.dirt}/peeringDB/peeringDB_ixlan.json", "r", encoding="utf-8") as fin:
             data = json.loads(fin.read())["data"]
             for ixlan in data:
-                self.ixlans[ixlan["id"]] = ixlan
+                self.ixlans[ixlan["id"]] = ixlan["ix_id"]
         # print("ixlans:", len(self.ixlans))
 
         with open(f"{self.dirt}/peeringDB/peeringDB_ixpfx.json", "r", encoding="utf-8") as fin:
@@ -142,7 +308,7 @@ class GeoLocate:
             for pfx in data:
                 if pfx["ixlan_id"] in self.ixlans:
                     self.pyt_pdb[pfx["prefix"]
-                                 ] = self.ixlans[pfx["ixlan_id"]]["ix_id"]
+                                 ] = self.ixlans[pfx["ixlan_id"]]
 
         with open(f"{self.dirt}/peeringDB/peeringDB_netixlan.json", "r", encoding="utf-8") as fin:
             data = json.loads(fin.read())["data"]
@@ -151,49 +317,94 @@ class GeoLocate:
                     self.pyt_pdb[ixlan["ipaddr4"]] = ixlan["ix_id"]
         # print("pyt_pdb:", len(self.pyt_pdb))
 
+    def __initGazetteer(self):
+        # Built offline from the gmap caches with `python -m geolocate.gazetteer`
+        filename = f"{self.dirt}/geolocate_cache/gazetteer.tsv"
+        self.gazetteer = Gazetteer.load(filename) if os.path.isfile(filename) else Gazetteer()
+        print("gazetteer: %d places, %d points" % (len(self.gazetteer.places), len(self.gazetteer.points)))
+
+    def __initPipeline(self, names, call_budget, run_budget):
+        # names: resolver names, or Resolver objects for custom tiers
+        resolvers = {
+            "geofeed": Resolver("geofeed", self.byGeoFeeds),
+            "ispfeed": Resolver("ispfeed", self.byProviderFeeds),
+            "peeringDB": Resolver("peeringDB", self.byPeeringDB),
+            "rdns": Resolver("rdns", self.byRDNS, network=True,
+                             cached=lambda ip: self.rDNS_cache.get(ip) is not None),
+            "ripe": Resolver("ripe", self.byRipeIPMap, network=True,
+                             cached=lambda ip: self.ripe_cache.get(ip) is not None),
+            "ipinfo": Resolver("ipinfo", self.byIPInfo, network=True,
+                               cached=lambda ip: self.ipinfo_cache.get(ip) is not None),
+        }
+        self.pipeline = Pipeline([resolvers[name] if isinstance(name, str) else name for name in names],
+                                 lambda: self.net_calls, call_budget, run_budget)
+
+    def newRun(self, call_budget=None, run_budget=None):
+        # Reset the per-run statistics and budgets (None for no budget)
+        self.pipeline.reset(call_budget, run_budget)
+
+    def report(self):
+        report = self.pipeline.report()
+        report["cnt"] = self.cnt
+        return report
+
+    def dumpReport(self, filename):
+        return self.pipeline.dumpReport(filename, cnt=self.cnt)
+
+    def runDeferred(self):
+        # Batch pass over the IPs deferred by the budgets: bulk rDNS and external lookups, then
+        # the full chain without budgets
+        ips = self.pipeline.takeDeferred()
+        if len(ips) == 0:
+            return {}
+        print("runDeferred: %d deferred IPs" % len(ips))
+        self.prefetchRDNS(ips)
+        self.prefetchExternal(ips)
+        call_budget, run_budget = self.pipeline.call_budget, self.pipeline.run_budget
+        self.pipeline.call_budget, self.pipeline.run_budget = None, None
+        try:
+            return self.geoLocateMany(ips)
+        finally:
+            self.pipeline.call_budget, self.pipeline.run_budget = call_budget, run_budget
+
     def __initRDNS(self):
-        self.hoiho = {}
-        with open(f"{self.dirt}/202103-midar-iff.geo-re.json", "r", encoding="utf-8") as fin:
-            for line in fin:
-                data = json.loads(line)
-                self.hoiho[data["domain"]] = data
+        self.hoiho = load_rules(f"{self.dirt}/202103-midar-iff.geo-re.json")  # domain -> HoihoRule
         # print("hoiho:", len(self.hoiho))
 
     def gmapGeocode(self, addr):
         addr = addr.lower()
+        loc = self.gazetteer.geocode(addr)
+        if loc is not None:
+            return loc
         res = self.gmap_geo_cache.get(addr)
         if res is None:
             res = self.gmaps.geocode(addr)
+            self.net_calls += 1
             self.gmap_geo_cache.add(addr, res)
-        try:
-            return res[0]["geometry"]["location"]
-        except:
-            return None
+        loc = parse_geocode(res)
+        if loc is not None:
+            self.gazetteer.addPlace(addr, loc["lat"], loc["lng"])
+        return loc
 
     def gmapReverseGeocode(self, lat, lng):
+        # exact gazetteer point -> cache -> nearest gazetteer point (with gazetteer_km) -> Google Maps API
+        res = self.gazetteer.reverse(lat, lng)
+        if res is not None:
+            return res
         coord_str = "%.5f,%.5f" % (lat, lng)
         res = self.gmap_rgeo_cache.get(coord_str)
+        if res is None and self.gazetteer_km > 0:
+            near = self.gazetteer.reverse(lat, lng, self.gazetteer_km, self.gazetteer_max_priority)
+            if near is not None:
+                return near
         if res is None:
             res = self.gmaps.reverse_geocode((lat, lng))
+            self.net_calls += 1
             self.gmap_rgeo_cache.add(coord_str, res)
-        if len(res) > 0:
-            items = res[0]["address_components"]
-            addr1 = None
-            addr2 = None
-            country = None
-            for item in items:
-                if "administrative_area_level_1" in item["types"]:
-                    addr1 = item["long_name"]
-                if "administrative_area_level_2" in item["types"]:
-                    addr2 = item["long_name"]
-                if "country" in item["types"]:
-                    country = item["short_name"]
-            if country is None:
-                return (None, None)
-            if addr2 is not None:
-                return (addr2, country)
-            return (addr1, country)
-        return (None, None)
+        place, country = parse_reverse_geocode(res)
+        if country is not None:
+            self.gazetteer.addPoint(lat, lng, place, country)
+        return (place, country)
 
     def byLocal(self, ip):
         if ip in self.local_ip:
@@ -207,11 +418,9 @@ class GeoLocate:
 
     def byGeoFeeds(self, ip):
         if ip in self.pyt_geofeeds:
-            items = self.pyt_geofeeds[ip]
-            country = items[1]
-            place = items[3]
+            country, region, place = self.pyt_geofeeds[ip]
             if len(place) == 0:
-                place = items[2]
+                place = region
             if len(place) > 0 and len(country) > 0:
                 loc = self.gmapGeocode(f"{place},{country}")
                 if loc is not None:
@@ -230,10 +439,10 @@ class GeoLocate:
             if len(items) == 5:
                 loc = self.iata_loc[items[3]]
                 return {
-                    "place": loc["region_name"],
-                    "country": loc["country_code"],
-                    "lat": float(loc["latitude"]),
-                    "lng": float(loc["longitude"]),
+                    "place": loc.region_name,
+                    "country": loc.country_code,
+                    "lat": float(loc.latitude),
+                    "lng": float(loc.longitude),
                     "method": "ispfeed"
                 }
         return None
@@ -241,10 +450,10 @@ class GeoLocate:
     def byPeeringDB(self, ip):
         if ip in self.pyt_pdb:
             ix = self.ixs[self.pyt_pdb[ip]]
-            city = ix["city"]
+            city = ix.city
             if city.find(', ') != -1:  # May include multiple cities, just take the first one
                 city = city.split(', ')[0]
-            country = ix["country"]
+            country = ix.country
             loc = self.gmapGeocode(f"{city},{country}")
             if loc is not None:
                 return {
@@ -258,18 +467,20 @@ class GeoLocate:
 
     #  May use RIPE IP map rDNS engine instead
     def byHoiho(self, host):
-        domain = tldextract.extract(host).registered_domain
-        if domain not in self.hoiho:
+        rule = self.hoiho.get(self.domain_of(host))
+        if rule is None:
             return None
-        for regex in self.hoiho[domain]["re"]:
-            res = re.match(regex, host)
-            if res is None:
-                continue
-            code = res.group(1).lower()
-            for hint in self.hoiho[domain]["geohints"]:
-                if code == hint["code"]:
-                    if hint["type"] == "clli":
-                        code = code[:6]
+        for code in rule.codes(host):
+            # Hints are tried in file order. A clli hint truncates the code to its 6-character CLLI
+            # location, and the hints after it are matched against the truncated code.
+            pos = -1
+            while pos is not None:
+                after, pos = pos, None
+                for i, hint in rule.hints_after(code, after):
+                    if hint.type == "clli":
+                        if len(code) > 6:
+                            code = code[:6]
+                            pos = i
                         if code in self.clli_loc:
                             loc = self.clli_loc[code]
                             (city, country) = self.gmapReverseGeocode(
@@ -281,19 +492,19 @@ class GeoLocate:
                                 "lng": loc[1],
                                 "method": "hoiho"
                             }
+                        if pos is not None:  # match the next hints with the truncated code
+                            break
                     else:
+                        if hint.location is not None:
+                            (city, country) = hint.location
+                        elif hint.lat is not None and hint.lng is not None:
+                            (city, country) = self.gmapReverseGeocode(
+                                float(hint.lat), float(hint.lng))
+                        else:
+                            continue
                         try:
-                            city = hint["location"]["place"]
-                            country = hint["location"]["cc"]
-                        except Exception as e:
-                            if "lat" in hint and "lng" in hint:
-                                (city, country) = self.gmapReverseGeocode(
-                                    float(hint["lat"]), float(hint["lng"]))
-                            else:
-                                continue
-                        try:
-                            lat = float(hint["lat"])
-                            lng = float(hint["lng"])
+                            lat = float(hint.lat)
+                            lng = float(hint.lng)
                         except Exception as e:
                             loc = self.gmapGeocode(f"{city},{country}")
                             lat = loc["lat"]
@@ -312,22 +523,105 @@ class GeoLocate:
         res = self.rDNS_cache.get(ip)
         if res is None:
             ar = AsyncResolver([ip])
+            self.net_calls += 1
             res = ar.resolve()[0]
-            self.rDNS_cache.add(ip, res)
+            self.rDNS_cache.add(ip, res, ex=None if res.get("error") is None else self.transient_ttl)
+        if res.get("error") is not None:
+            self.__transient.add(ip)
         host = res["host"]
         if host is not None:
             return self.byHoiho(host)
         return None
 
+    def prefetchRDNS(self, ips, batch=100000, intensity=500):
+        # Resolve the PTR records of all IPs that may reach byRDNS concurrently and write them,
+        # failures included, to rDNS_cache in bulk, so later byRDNS/byHoiho calls are cache hits
+        ips = list(dict.fromkeys(ips))
+        ips = [ip for ip, glob in zip(ips, is_global_many(ips)) if glob and self.byLocal(ip) is None]
+        ips = [ip for ip, res in zip(ips, self.loc_cache.get_many(ips)) if res is None]
+        if self.neg_ttl is not None:
+            ips = [ip for ip, res in zip(ips, self.loc_neg_cache.get_many(ips)) if res is None]
+        todo = [ip for ip, res in zip(ips, self.rDNS_cache.get_many(ips)) if res is None]
+        print("prefetchRDNS: %d uncached IPs, %d need rDNS" % (len(ips), len(todo)))
+
+        start = time.time()
+        n_done = 0
+        n_hosts = 0
+        for i in range(0, len(todo), batch):
+            results = AsyncResolver(todo[i:i + batch], intensity=intensity).resolve()
+            self.net_calls += len(results)
+            self.rDNS_cache.add_many({res["ip"]: res for res in results if res["error"] is None})
+            # failures are retried after transient_ttl
+            self.rDNS_cache.add_many({res["ip"]: res for res in results if res["error"] is not None},
+                                     ex=self.transient_ttl)
+            n_done += len(results)
+            n_hosts += sum(res["host"] is not None for res in results)
+            self.pipeline.count("prefetch_rdns", sum(res["host"] is not None for res in results),
+                                sum(res["host"] is None for res in results))
+            elapsed = time.time() - start
+            print("prefetchRDNS: %d/%d resolved, %d with host names, %.0f IPs/s" %
+                  (n_done, len(todo), n_hosts, n_done / max(elapsed, 1e-6)))
+        return n_done
+
+    def prefetchExternal(self, ips, batch=10000):
+        # Run the local tiers for all uncached IPs, then fetch RIPE IPmap concurrently for the IPs
+        # that fall through them, and ipinfo for those RIPE IPmap cannot locate, filling the
+        # ripe/ipinfo caches in bulk. Run prefetchRDNS first, byRDNS resolves PTRs inline otherwise.
+        # The IPs located by the local tiers are left to the pipeline, which counts them per tier.
+        ips = list(dict.fromkeys(ips))
+        ips = [ip for ip, glob in zip(ips, is_global_many(ips)) if glob and self.byLocal(ip) is None]
+        ips = [ip for ip, res in zip(ips, self.loc_cache.get_many(ips)) if res is None]
+        if self.neg_ttl is not None:
+            ips = [ip for ip, res in zip(ips, self.loc_neg_cache.get_many(ips)) if res is None]
+
+        start = time.time()
+        todo = []
+        for ip in ips:
+            for func in [self.byGeoFeeds, self.byProviderFeeds, self.byPeeringDB, self.byRDNS]:
+                if func(ip) is not None:
+                    break
+            else:
+                todo.append(ip)
+        print("prefetchExternal: %d uncached IPs, %d located by local tiers, %d fall through" %
+              (len(ips), len(ips) - len(todo), len(todo)))
+
+        for name, cache, parse in [("ripe", self.ripe_cache, self.__parseRipe),
+                                   ("ipinfo", self.ipinfo_cache, self.__parseIPInfo)]:
+            cached = dict(zip(todo, cache.get_many(todo)))
+            fetch = [ip for ip in todo if cached[ip] is None]
+            n_done = 0
+            for i in range(0, len(fetch), batch):
+                results = {}
+                self.net_calls += len(fetch[i:i + batch])
+                for ip, res in self.ext.fetch(name, fetch[i:i + batch]):
+                    if res is not None:
+                        results[ip] = res
+                    elif self.ext.takeFailed(name, ip):
+                        self.__transient.add(ip)
+                cache.add_many(results)
+                cached.update(results)
+                self.pipeline.count(f"prefetch_{name}", len(results), len(fetch[i:i + batch]) - len(results))
+                n_done += len(fetch[i:i + batch])
+                elapsed = time.time() - start
+                print("prefetchExternal: %s %d/%d fetched, %.0f IPs/s %s" %
+                      (name, n_done, len(fetch), n_done / max(elapsed, 1e-6), self.ext.stats[name]))
+            todo = [ip for ip in todo if parse(cached[ip]) is None]
+        return len(ips)
+
     def byRipeIPMap(self, ip):
         res = self.ripe_cache.get(ip)
         if res is None:
-            response = requests.get(
-                # f"https://ipmap-api.ripe.net/v1/locate/{ip}?engines=single-radius,latency")
-                f"https://ipmap-api.ripe.net/v1/locate/{ip}")
-            if response.status_code == 200:
-                res = response.json()
+            # f"https://ipmap-api.ripe.net/v1/locate/{ip}?engines=single-radius,latency"
+            res = self.ext.fetchOne("ripe", ip)
+            self.net_calls += 1
+            if res is not None:
                 self.ripe_cache.add(ip, res)
+            elif self.ext.takeFailed("ripe", ip):
+                self.__transient.add(ip)
+        return self.__parseRipe(res)
+
+    @staticmethod
+    def __parseRipe(res):
         if res is not None and "locations" in res:
             for loc in res["locations"]:
                 try:
@@ -346,12 +640,16 @@ class GeoLocate:
     def byIPInfo(self, ip):
         res = self.ipinfo_cache.get(ip)
         if res is None:
-            try:
-                res = self.ipinfo_handler.getDetails(ip, timeout=60).details
+            res = self.ext.fetchOne("ipinfo", ip)
+            self.net_calls += 1
+            if res is not None:
                 self.ipinfo_cache.add(ip, res)
-            except Exception as e:
-                print(e)
-                pass
+            elif self.ext.takeFailed("ipinfo", ip):
+                self.__transient.add(ip)
+        return self.__parseIPInfo(res)
+
+    @staticmethod
+    def __parseIPInfo(res):
         try:
             return {
                 "place": res["city"],
@@ -365,42 +663,78 @@ class GeoLocate:
         return None
 
     def geoLocate(self, ip, cache_only=False):
-        if not ipaddress.ip_address(ip).is_global:
+        if not is_global(ip):
             return None
 
         self.cnt += 1
 
         res = self.byLocal(ip)
+        self.pipeline.count("local", res is not None, res is None)
         if res is not None:
             return res
 
         res = self.loc_cache.get(ip)
+        self.pipeline.count("loc_cache", res is not None, res is None)
         if res is not None or cache_only:
             return res
 
-        while True:
-            res = self.byGeoFeeds(ip)
-            if res is not None:
-                break
-            res = self.byProviderFeeds(ip)
-            if res is not None:
-                break
-            res = self.byPeeringDB(ip)
-            if res is not None:
-                break
-            res = self.byRDNS(ip)
-            if res is not None:
-                break
-            res = self.byRipeIPMap(ip)
-            if res is not None:
-                break
-            res = self.byIPInfo(ip)
-            break
+        if self.neg_ttl is not None and self.loc_neg_cache.get(ip) is not None:
+            self.pipeline.count("loc_neg", 1)
+            return None
 
+        res, deferred = self.pipeline.locate(ip)
         if res is not None:
             self.loc_cache.add(ip, res)
+        elif not deferred:  # deferred IPs are located again by runDeferred
+            self.__addNegative([ip])
         return res
 
+    def geoLocateMany(self, ips, cache_only=False):
+        # Same as geoLocate for every distinct ip, but loc_cache is read by one pipelined MGET
+        # and the new results are written back by one pipelined MSET
+        results = {}
+        cache_ips = []
+        cnt = self.cnt
+        ips = list(dict.fromkeys(ips))
+        for ip, glob in zip(ips, is_global_many(ips)):
+            if not glob:
+                results[ip] = None
+                continue
+            self.cnt += 1
+            res = self.byLocal(ip)
+            if res is not None:
+                results[ip] = res
+            else:
+                cache_ips.append(ip)
+
+        self.pipeline.count("local", self.cnt - cnt - len(cache_ips), len(cache_ips))
+
+        miss_ips = []
+        for ip, res in zip(cache_ips, self.loc_cache.get_many(cache_ips)):
+            results[ip] = res
+            if res is None:
+                miss_ips.append(ip)
+        self.pipeline.count("loc_cache", len(cache_ips) - len(miss_ips), len(miss_ips))
+        if cache_only:
+            return results
+
+        if self.neg_ttl is not None:
+            negs = self.loc_neg_cache.get_many(miss_ips)
+            self.pipeline.count("loc_neg", sum(neg is not None for neg in negs))
+            miss_ips = [ip for ip, neg in zip(miss_ips, negs) if neg is None]
+        new_results = {}
+        new_negs = []
+        for ip in miss_ips:
+            res, deferred = self.pipeline.locate(ip)
+            if res is not None:
+                new_results[ip] = res
+            elif not deferred:
+                new_negs.append(ip)
+            results[ip] = res
+        self.loc_cache.add_many(new_results)
+        self.__addNegative(new_negs)
+        return results
+
 
 if __name__ == "__main__":
     geoloc = GeoLocate(
@@ -421,3 +755,4 @@ if __name__ == "__main__":
     print(geoloc.geoLocate("54.94.206.42"))
     print(geoloc.geoLocate("15.197.187.232"))
     print(geoloc.geoLocate("220.128.12.161"))
+    print(json.dumps(geoloc.report(), indent=2))
@@ -0,0 +1,125 @@
+import re
+import json
+import bisect
+import functools
+
+import tldextract
+
+from .records import GeoHint
+
+
+class HoihoRule:
+    # Rules of one domain in the hoiho geo-re file: regexes compiled on first use and
+    # GeoHint records indexed by code (a code may have several hints, kept in file order)
+    __slots__ = ("patterns", "hints", "positions", "compiled")
+
+    def __init__(self, data):
+        self.patterns = data["re"]
+        self.hints = {}
+        self.positions = {}  # code -> positions of its hints in the geohints of the file
+        for i, hint in enumerate(data["geohints"]):
+            hint = GeoHint(hint)
+            self.hints.setdefault(hint.code, []).append(hint)
+            self.positions.setdefault(hint.code, []).append(i)
+        self.compiled = None
+
+    def __getstate__(self):
+        return (self.patterns, self.hints, self.positions)
+
+    def __setstate__(self, state):
+        self.patterns, self.hints, self.positions = state
+        self.compiled = None
+
+    def hints_after(self, code, pos=-1):
+        # (position, hint) of the hints of code after position pos, in file order
+        positions = self.positions.get(code, [])
+        i = bisect.bisect_right(positions, pos)
+        return zip(positions[i:], self.hints.get(code, [])[i:])
+
+    def codes(self, host):
+        # Lowercased geohint codes extracted by the regexes that match host, in regex order
+        if self.compiled is None:
+            self.compiled = [re.compile(pattern) for pattern in self.patterns]
+        for regex in self.compiled:
+            res = regex.match(host)
+            if res is not None and res.group(1) is not None:  # the code group may be optional
+                yield res.group(1).lower()
+
+
+class DomainExtractor:
+    # Memoized registered domain of host names, using the public suffix list bundled with tldextract
+    # (never fetched from the network). Router names share their last labels, so the memo is keyed
+    # by the last `tail` labels, which contain the registered domain unless the suffix is longer.
+    def __init__(self, tail=5, maxsize=1 << 16):
+        self.tail = tail
+        self.__tld = tldextract.TLDExtract(suffix_list_urls=())
+        self.__memo = functools.lru_cache(maxsize=maxsize)(self.__extract)
+
+    def __extract(self, name):
+        return self.__tld(name).registered_domain
+
+    def __call__(self, host):
+        labels = host.split(".")
+        if len(labels) <= self.tail:
+            return self.__memo(host)
+        domain = self.__memo(".".join(labels[-self.tail:]))
+        if domain == "":  # the tail is entirely public suffix
+            domain = self.__extract(host)
+        return domain
+
+
+def load_rules(filename):
+    rules = {}
+    with open(filename, "r", encoding="utf-8") as fin:
+        for line in fin:
+            data = json.loads(line)
+            rules[data["domain"]] = HoihoRule(data)
+    return rules
+
+
+if __name__ == "__main__":
+    # Benchmark host name -> geohint matching over a corpus of PTR names (one per line), e.g.,
+    #   python -m geolocate.hoiho_index ../data/202103-midar-iff.geo-re.json ptr_names.txt
+    import sys
+    import time
+
+    hoiho = {}
+    with open(sys.argv[1], "r", encoding="utf-8") as fin:
+        for line in fin:
+            data = json.loads(line)
+            hoiho[data["domain"]] = data
+    rules = load_rules(sys.argv[1])
+    with open(sys.argv[2], "r", encoding="utf-8") as fin:
+        hosts = [line.strip() for line in fin if len(line.strip()) > 0]
+
+    def match_raw(host):
+        domain = tldextract.extract(host).registered_domain
+        if domain not in hoiho:
+            return None
+        for regex in hoiho[domain]["re"]:
+            res = re.match(regex, host)
+            if res is None:
+                continue
+            code = res.group(1).lower()
+            for hint in hoiho[domain]["geohints"]:
+                if code == hint["code"]:
+                    return hint
+        return None
+
+    domain_of = DomainExtractor()
+
+    def match_index(host):
+        rule = rules.get(domain_of(host))
+        if rule is None:
+            return None
+        for code in rule.codes(host):
+            for hint in rule.hints.get(code, []):
+                return hint
+        return None
+
+    for name, func in [("raw", match_raw), ("index", match_index)]:
+        start = time.time()
+        res = [func(host) for host in hosts]
+        end = time.time()
+        print("%-5s %d hosts, %d matched in %.2fs (%.0f hosts/s)" %
+              (name, len(hosts), sum(r is not None for r in res), end - start, len(hosts) / (end - start)))
@@ -1,32 +1,136 @@
 import time
 import json
+import array
+import bisect
+import socket
 import pyasn
 import pytricia
 
+try:
+    import numpy as np
+except ImportError:  # lookup_many falls back to lookup() per IP, and shared memory is not used
+    np = None
+
+from . import shm
+from . import snapshot
+from .snapshot import flatten, prefix_range, ip_to_int
+
+# method codes of lookup_many
+METHOD_NONE = 0
+METHOD_PYASN = 1
+METHOD_IXP = 2
+METHOD_ISPFEED = 3
+METHODS = [None, "pyasn", "ixp", "ispfeed"]
+
+
+def ipv4_to_uint32(ips):
+    # Returns (uint32 addresses, mask of valid IPv4 addresses)
+    packed = bytearray(4 * len(ips))
+    valid = np.zeros(len(ips), dtype=bool)
+    for i, ip in enumerate(ips):
+        try:
+            packed[4 * i:4 * i + 4] = socket.inet_pton(socket.AF_INET, ip)
+            valid[i] = True
+        except (OSError, TypeError):
+            pass
+    return np.frombuffer(bytes(packed), dtype=">u4").astype(np.uint32), valid
+
+
+def range_lookup(table, addrs):
+    # table: (starts, ends, vals) of disjoint sorted ranges. Returns (found mask, vals)
+    starts, ends, vals = table
+    if len(starts) == 0:
+        return np.zeros(len(addrs), dtype=bool), np.zeros(len(addrs), dtype=vals.dtype)
+    i = np.searchsorted(starts, addrs, side="right") - 1
+    found = i >= 0
+    i[~found] = 0
+    found &= addrs <= ends[i]
+    return found, vals[i]
+
+
+def range_table(ranges):
+    starts, ends, vals = flatten(ranges)
+    return (np.array(starts, dtype=np.uint32), np.array(ends, dtype=np.uint32),
+            np.array(vals, dtype=np.int64))
+
 
 class IpAsnOrg:
-    def __init__(self, dirt="../../data", enable_org=False):
+    def __init__(self, dirt="../../data", enable_org=False, use_shm=False):
         start = time.time()
         self.dirt = dirt
         self.enable_org = enable_org
-        self.__initPyASN()
-        self.__initIXP()
-        self.__initProviderFeeds()
+        self.__tables = None  # IPv4 tables of lookup_many, built on the first call
+        if not (use_shm and np is not None and self.__attach()):
+            self.__initPyASN()
+            self.__initIXP()
+            self.__initProviderFeeds()
         if self.enable_org:
             self.__initASNOrg()
         end = time.time()
         print("IpAsnOrg init finished in %.2fs" % (end-start))
 
+    def __sources(self):
+        return [f"{self.dirt}/ipasn_20240901.dat",
+                f"{self.dirt}/caida/ix-asns_202310.jsonl",
+                f"{self.dirt}/ip_ranges/aws-ip-ranges.json",
+                f"{self.dirt}/ip_ranges/azure-ip-ranges.json",
+                f"{self.dirt}/ip_ranges/gcp-ip-ranges.json"]
+
+    def __attach(self):
+        # Zero-copy tables published by publish(). IPv4 pyasn lookups use the pyasn table,
+        # pyasn itself is loaded on the first IPv6 lookup.
+        snap = shm.attach(shm.segment_name("ipasn", self.dirt), self.__sources())
+        if snap is None:
+            return False
+        self.asndb = None
+        self.ixp_v4 = (snap.get("ixp_v4.addrs"), snap.get("ixp_v4.asns"))
+        self.ixp_v6 = snap.get("ixp_v6")
+        self.pyt_ispfeeds = snap.get("pyt_ispfeeds")
+        tables = {}
+        for name in ["pyasn", "ispfeed"]:
+            tables[name] = (np.frombuffer(snap.get(f"{name}.starts"), dtype=np.uint32),
+                            np.frombuffer(snap.get(f"{name}.ends"), dtype=np.uint32),
+                            np.frombuffer(snap.get(f"{name}.vals"), dtype=np.int64))
+        ixp_addrs = np.frombuffer(self.ixp_v4[0], dtype=np.uint32)
+        ixp_table = (ixp_addrs, ixp_addrs, np.frombuffer(self.ixp_v4[1], dtype=np.uint32).astype(np.int64))
+        self.__tables = (tables["pyasn"], ixp_table, tables["ispfeed"])
+        return True
+
+    def publish(self):
+        # Publish the lookup tables to shared memory, for IpAsnOrg(use_shm=True) in other processes
+        if self.asndb is None:
+            raise ValueError("publish() needs an IpAsnOrg loaded from the data files")
+        if np is None:
+            raise ImportError("publish() needs numpy")
+        if self.__tables is None:
+            self.__initTables()
+        arrays = {"ixp_v4.addrs": self.ixp_v4[0], "ixp_v4.asns": self.ixp_v4[1]}
+        for name, table in [("pyasn", self.__tables[0]), ("ispfeed", self.__tables[2])]:
+            for key, arr, typecode, dtype in zip(["starts", "ends", "vals"], table,
+                                                 ["I", "I", "q"], [np.uint32, np.uint32, np.int64]):
+                arrays[f"{name}.{key}"] = array.array(typecode, arr.astype(dtype).tobytes())
+        data = snapshot.pack(self.__sources(), {"ixp_v6": self.ixp_v6},
+                             {"pyt_ispfeeds": snapshot.PrefixTable.fromPyTricia(self.pyt_ispfeeds)}, arrays)
+        shm.publish(shm.segment_name("ipasn", self.dirt), data)
+
     def __initPyASN(self):
         self.asndb = pyasn.pyasn(f"{self.dirt}/ipasn_20240901.dat")
 
     def __initIXP(self):
-        self.ixp_ip_asn = {}
+        # IXP interface IPs as integers: sorted IPv4 arrays, and a dict for the few IPv6 ones
+        ixp_ip_asn = {4: {}, 6: {}}
         with open(f"{self.dirt}/caida/ix-asns_202310.jsonl") as fin:
             for line in fin:
                 data = json.loads(line)
                 for ip in data["ipv4"]+data["ipv6"]:
-                    self.ixp_ip_asn[ip] = data["asn"]
+                    try:
+                        version, n = ip_to_int(ip)
+                    except (OSError, ValueError):
+                        continue
+                    ixp_ip_asn[version][n] = data["asn"]
+        items = sorted(ixp_ip_asn[4].items())
+        self.ixp_v4 = (array.array("I", [n for n, _ in items]), array.array("I", [asn for _, asn in items]))
+        self.ixp_v6 = ixp_ip_asn[6]
 
     def __initProviderFeeds(self):
         self.pyt_ispfeeds = pytricia.PyTricia(128)
@@ -68,15 +172,90 @@ class IpAsnOrg:
                 if len(org) > 0:
                     self.asn_org[asn] = org
 
+    def __initTables(self):
+        # IPv4 prefixes of the loaded pyasn radix tree
+        radix = self.asndb.radix
+        ranges = []
+        for prefix in radix.prefixes():
+            if ":" in prefix:
+                continue
+            _, start, end = prefix_range(prefix)
+            ip, mask = prefix.split("/")  # search_exact does not parse prefixes, as in pyasn.get_as_prefixes
+            ranges.append((start, end, radix.search_exact(ip, masklen=int(mask)).asn))
+        pyasn_table = range_table(ranges)
+
+        ixp_addrs = np.array(self.ixp_v4[0], dtype=np.uint32)
+        ixp_table = (ixp_addrs, ixp_addrs, np.array(self.ixp_v4[1], dtype=np.int64))
+
+        ranges = []
+        for prefix in self.pyt_ispfeeds:
+            if ":" not in prefix:
+                _, start, end = prefix_range(prefix)
+                ranges.append((start, end, self.pyt_ispfeeds[prefix]))
+        ispfeed_table = range_table(ranges)
+        self.__tables = (pyasn_table, ixp_table, ispfeed_table)
+
+    def lookup_many(self, ips):
+        # Vectorized lookup() for IPv4 with the same pyasn -> IXP -> ispfeed precedence.
+        # Returns parallel arrays (asn, method code), asn is -1 and method is METHOD_NONE if not found.
+        if np is None:
+            asns, methods = array.array("q"), array.array("B")
+            for ip in ips:
+                res = self.lookup(ip)
+                asns.append(-1 if res is None else res["asn"])
+                methods.append(METHOD_NONE if res is None else METHODS.index(res["method"]))
+            return asns, methods
+        if self.__tables is None:
+            self.__initTables()
+        addrs, valid = ipv4_to_uint32(ips)
+        asns = np.full(len(ips), -1, dtype=np.int64)
+        methods = np.zeros(len(ips), dtype=np.uint8)
+        todo = valid.copy()
+        for table, method in zip(self.__tables, [METHOD_PYASN, METHOD_IXP, METHOD_ISPFEED]):
+            found, vals = range_lookup(table, addrs)
+            found &= todo
+            asns[found] = vals[found]
+            methods[found] = method
+            todo &= ~found
+        for i in np.flatnonzero(~valid):  # IPv6 and malformed addresses
+            res = self.lookup(ips[i])
+            if res is not None:
+                asns[i] = res["asn"]
+                methods[i] = METHODS.index(res["method"])
+        return asns, methods
+
     def byPyASN(self, ip):
+        if self.asndb is None and ":" not in ip:  # attached from shared memory
+            try:
+                _, n = ip_to_int(ip)
+            except (OSError, TypeError, ValueError):
+                n = None
+            if n is not None:
+                starts, ends, vals = self.__tables[0]
+                i = int(np.searchsorted(starts, n, side="right")) - 1
+                if i >= 0 and n <= ends[i]:
+                    return {"asn": int(vals[i]), "method": "pyasn"}
+                return None
+        if self.asndb is None:
+            self.__initPyASN()
         asn = self.asndb.lookup(ip)[0]  # (asn, prefix) or (None, None)
         if asn is not None:
             return {"asn": asn, "method": "pyasn"}
         return None
 
     def byIXP(self, ip):
-        if ip in self.ixp_ip_asn:
-            return {"asn": self.ixp_ip_asn[ip], "method": "ixp"}
+        try:
+            version, n = ip_to_int(ip)
+        except (OSError, TypeError, ValueError):
+            return None
+        if version == 4:
+            addrs, asns = self.ixp_v4
+            i = bisect.bisect_left(addrs, n)
+            if i < len(addrs) and addrs[i] == n:
+                return {"asn": asns[i], "method": "ixp"}
+            return None
+        if n in self.ixp_v6:
+            return {"asn": self.ixp_v6[n], "method": "ixp"}
         return None
 
     def byProviderFeeds(self, ip):
@@ -111,3 +290,19 @@ if __name__ == "__main__":
     print(ipasn.lookup("8.35.192.0"))  # AS 396982 - Google
     print(ipasn.lookup("34.0.0.0"))  # AS 19527 - Google
     print(ipasn.lookup("91.210.16.168"))  # NIX.CZ AS 15169 - Google
+
+    # lookup_many must agree with lookup, on random IPv4 addresses, the addresses above and an
+    # IPv6 address, which it hands over to lookup
+    import random
+    rnd = random.Random(0)
+    ips = [socket.inet_ntoa(rnd.getrandbits(32).to_bytes(4, "big")) for _ in range(100000)]
+    ips += ["206.108.115.47", "20.35.240.0", "8.35.192.0", "34.0.0.0", "91.210.16.168",
+            "2001:4860:4860::8888"]
+    start = time.time()
+    asns, methods = ipasn.lookup_many(ips)
+    print("lookup_many: %d IPs in %.2fs" % (len(ips), time.time() - start))
+    for ip, asn, method in zip(ips, asns, methods):
+        res = ipasn.lookup(ip)
+        expected = (-1, None) if res is None else (res["asn"], res["method"])
+        assert (int(asn), METHODS[method]) == expected, (ip, asn, METHODS[method], expected)
+    print("lookup_many agrees with lookup on %d IPs" % len(ips))
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__data = OrderedDict()  # key -> (value, size in bytes)
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __full(self):
+        if self.max_entries is not None and len(self.__data) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self.nbytes > self.max_bytes:
+            return True
+        return False
+
+    def get(self, key):
+        item = self.__data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.__data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, value, size=0):
+        self.remove(key)
+        self.__data[key] = (value, size)
+        self.nbytes += size
+        while len(self.__data) > 0 and self.__full():
+            _, (_, old_size) = self.__data.popitem(last=False)
+            self.nbytes -= old_size
+            self.evictions += 1
+
+    def remove(self, key):
+        item = self.__data.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[1]
+
+    def clear(self):
+        self.__data.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.__data), "bytes": self.nbytes}
+
+
+if __name__ == "__main__":
+    lru = LRUCache(max_entries=2)
+    lru.put("a", 1)
+    lru.put("b", 2)
+    lru.get("a")
+    lru.put("c", 3)  # evicts "b"
+    print(lru.get("b"), lru.get("a"), lru.get("c"), lru.stats())
@@ -0,0 +1,49 @@
+# Re-encode the values of a RedisCache namespace in place, e.g., from scripts/:
+#   python -m geolocate.migrate_cache -n loc -c loc --db 2
+# Readers with any codec still decode json values, so the migration can run while caches are in use.
+# The expire times of the keys are kept, and the codec is recorded for the namespace, so that
+# GeoLocate (codecs=None) and RedisCache(codec="detect") read and write it with the new codec.
+import time
+import argparse
+
+from .redis_cache import RedisCache
+from .redis_codec import CODECS
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--namespace', metavar='namespace', type=str, required=True,
+                    help="loc, gmap_geo, gmap_rgeo, rdns, ripe, ipinfo")
+parser.add_argument('-c', '--codec', metavar='codec', type=str, required=True,
+                    choices=list(CODECS.keys()))
+parser.add_argument('--db', metavar='db', type=int, default=0,
+                    help="redis db version (0 for 20240304, 2 for 20240815)")
+parser.add_argument('-b', '--batch', metavar='batch', type=int, default=1000)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    cache = RedisCache(args.namespace, db=args.db, codec=args.codec)
+    start = time.time()
+    n_keys = 0
+    items = {}
+
+    def flush(items):
+        keys = list(items)
+        px = {}
+        for key, pttl in zip(keys, cache.pttl_many(keys)):
+            if pttl == -2:  # expired during the scan
+                del items[key]
+            elif pttl > 0:
+                px[key] = pttl
+        cache.add_many(items, px=px)
+        return len(items)
+
+    for key, value in cache.scan_namespace(args.batch):
+        items[key] = value
+        if len(items) >= args.batch:
+            n_keys += flush(items)
+            items = {}
+    n_keys += flush(items)
+    cache.set_stored_codec(args.codec)
+    end = time.time()
+    print("re-encoded %d keys of %s with %s in %.2fs (%.0f keys/s)" %
+          (n_keys, args.namespace, args.codec, end - start, n_keys / max(end - start, 1e-6)))
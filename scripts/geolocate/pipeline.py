@@ -0,0 +1,119 @@
+import json
+import time
+from datetime import datetime
+
+
+class Resolver:
+    # One tier of the GeoLocate fallback chain: func(ip) -> location or None.
+    # network: the tier may call an external service, cached(ip) tells whether it can answer without one
+    def __init__(self, name, func, network=False, cached=None):
+        self.name = name
+        self.func = func
+        self.network = network
+        self.cached = cached
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.time = 0.0
+        self.net_calls = 0  # external calls made
+        self.net_time = 0.0  # wall time of the calls that made external calls
+        self.calls_with_net = 0
+        self.skipped = 0  # IPs deferred instead of calling this tier
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "time": round(self.time, 6),
+                "net_calls": self.net_calls, "calls_with_net": self.calls_with_net,
+                "net_time": round(self.net_time, 6), "skipped": self.skipped,
+                "network": self.network}
+
+
+class Pipeline:
+    def __init__(self, resolvers, net_counter, call_budget=None, run_budget=None):
+        """
+        resolvers: [Resolver] in fallback order
+        net_counter: () -> number of external calls made so far
+        call_budget: seconds one lookup may spend before its uncached network tiers are deferred
+        run_budget: seconds of network time of a run after which uncached network tiers are deferred
+        """
+        self.resolvers = list(resolvers)
+        self.net_counter = net_counter
+        self.call_budget = call_budget
+        self.run_budget = run_budget
+        self.counts = {}  # stage outside of the chain (local, loc_cache, loc_neg) -> [hits, misses]
+        self.deferred = {}  # ip -> None, in deferral order
+        self.start = time.time()
+        self.started = datetime.utcnow()
+
+    def reset(self, call_budget=None, run_budget=None):
+        self.call_budget = call_budget
+        self.run_budget = run_budget
+        for resolver in self.resolvers:
+            resolver.reset()
+        self.counts = {}
+        self.start = time.time()
+        self.started = datetime.utcnow()
+
+    def count(self, stage, hits, misses=0):
+        counts = self.counts.setdefault(stage, [0, 0])
+        counts[0] += hits
+        counts[1] += misses
+
+    def netTime(self):
+        return sum(resolver.net_time for resolver in self.resolvers)
+
+    def __overBudget(self, begin):
+        if self.call_budget is not None and time.perf_counter() - begin > self.call_budget:
+            return True
+        return self.run_budget is not None and self.netTime() > self.run_budget
+
+    def locate(self, ip):
+        # Returns (location or None, deferred)
+        begin = time.perf_counter()
+        for resolver in self.resolvers:
+            if resolver.network and self.__overBudget(begin) \
+                    and (resolver.cached is None or not resolver.cached(ip)):
+                resolver.skipped += 1
+                self.deferred[ip] = None
+                return None, True
+            net_before = self.net_counter()
+            t = time.perf_counter()
+            res = resolver.func(ip)
+            elapsed = time.perf_counter() - t
+            resolver.time += elapsed
+            net_calls = self.net_counter() - net_before
+            if net_calls > 0:
+                resolver.net_calls += net_calls
+                resolver.net_time += elapsed
+                resolver.calls_with_net += 1
+            if res is not None:
+                resolver.hits += 1
+                return res, False
+            resolver.misses += 1
+        return None, False
+
+    def takeDeferred(self):
+        ips = list(self.deferred)
+        self.deferred = {}
+        return ips
+
+    def report(self):
+        return {
+            "started": str(self.started),
+            "elapsed": round(time.time() - self.start, 3),
+            "call_budget": self.call_budget,
+            "run_budget": self.run_budget,
+            "net_time": round(self.netTime(), 6),
+            "deferred": len(self.deferred),
+            "stages": {stage: {"hits": hits, "misses": misses} for stage, (hits, misses) in self.counts.items()},
+            "resolvers": {resolver.name: resolver.stats() for resolver in self.resolvers},
+        }
+
+    def dumpReport(self, filename, **extra):
+        # One JSON object per line, appended per run
+        report = self.report()
+        report.update(extra)
+        with open(filename, "a") as fout:
+            fout.write(json.dumps(report) + "\n")
+        return report
@@ -0,0 +1,114 @@
+import sys
+
+# Slim records for the static GeoLocate tables: only the fields the locators read, with the
+# repeated country/place/type strings interned so that every record shares one copy.
+# GeoLocate is forked into many workers, and each one pays for these tables.
+
+
+def intern(s):
+    return sys.intern(s) if isinstance(s, str) else s
+
+
+def to_float(s):
+    # Keep values that are not numbers, so they fail at lookup time like the raw rows did
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return s
+
+
+class Airport:
+    # Row of iata-icao.csv
+    __slots__ = ("region_name", "country_code", "latitude", "longitude")
+
+    def __init__(self, row):
+        self.region_name = intern(row["region_name"])
+        self.country_code = intern(row["country_code"])
+        self.latitude = to_float(row["latitude"])
+        self.longitude = to_float(row["longitude"])
+
+
+class IX:
+    # PeeringDB ix object
+    __slots__ = ("city", "country")
+
+    def __init__(self, ix):
+        self.city = intern(ix["city"])
+        self.country = intern(ix["country"])
+
+
+class GeoHint:
+    # hoiho geohint. location is (place, cc), or None if either is missing; lat/lng are None if missing
+    __slots__ = ("code", "type", "location", "lat", "lng")
+
+    def __init__(self, hint):
+        self.code = intern(hint["code"])
+        self.type = intern(hint["type"])
+        try:
+            self.location = (intern(hint["location"]["place"]), intern(hint["location"]["cc"]))
+        except (KeyError, TypeError):
+            self.location = None
+        self.lat = hint.get("lat")
+        self.lng = hint.get("lng")
+
+
+def geofeed_value(row):
+    # (country, region, city) of a geofeed row [prefix, country, region, city, postal code]
+    return (intern(row[1]), intern(row[2]), intern(row[3]))
+
+
+if __name__ == "__main__":
+    # Resident size of the raw and slim tables, each built in a forked child, e.g., from scripts/:
+    #   python -m geolocate.records ../data
+    import os
+    import csv
+    import json
+
+    from .hoiho_index import load_rules
+
+    dirt = sys.argv[1] if len(sys.argv) > 1 else "../data"
+    page = os.sysconf("SC_PAGE_SIZE")
+
+    def rss():
+        with open("/proc/self/statm") as fin:
+            return int(fin.read().split()[1]) * page
+
+    def iata(slim):
+        with open(f"{dirt}/iata-icao.csv", "r", encoding="utf-8") as fin:
+            return {row["iata"].lower(): Airport(row) if slim else row for row in csv.DictReader(fin)}
+
+    def peeringdb(slim):
+        with open(f"{dirt}/peeringDB/peeringDB_ix.json", "r", encoding="utf-8") as fin:
+            ixs = {ix["id"]: IX(ix) if slim else ix for ix in json.loads(fin.read())["data"]}
+        with open(f"{dirt}/peeringDB/peeringDB_ixlan.json", "r", encoding="utf-8") as fin:
+            ixlans = {ixlan["id"]: ixlan["ix_id"] if slim else ixlan for ixlan in json.loads(fin.read())["data"]}
+        return ixs, ixlans
+
+    def geofeeds(slim):
+        with open(f"{dirt}/geolocate_cache/cache_geofeed.csv", "r", encoding="utf-8") as fin:
+            return [geofeed_value(row) if slim else row for row in csv.reader(fin)]
+
+    def hoiho(slim):
+        filename = f"{dirt}/202103-midar-iff.geo-re.json"
+        if slim:
+            return load_rules(filename)
+        with open(filename, "r", encoding="utf-8") as fin:
+            return {data["domain"]: data for data in map(json.loads, fin)}
+
+    for name, build in [("iata_loc", iata), ("ixs/ixlans", peeringdb), ("pyt_geofeeds values", geofeeds),
+                        ("hoiho", hoiho)]:
+        sizes = []
+        for slim in [False, True]:
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(r)
+                before = rss()
+                table = build(slim)
+                os.write(w, str(rss() - before).encode())
+                os._exit(0)
+            os.close(w)
+            with os.fdopen(r) as fin:
+                sizes.append(int(fin.read()))
+            os.waitpid(pid, 0)
+        print("%-20s raw %8.1f MB  slim %8.1f MB" % (name, sizes[0] / 2 ** 20, sizes[1] / 2 ** 20))
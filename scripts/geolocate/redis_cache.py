@@ -1,42 +1,176 @@
 import os
 import json
+import itertools
 import redis
 
+from .lru_cache import LRUCache
+from .redis_codec import CODECS
+
+CODEC_KEY = "codec:"  # + namespace -> codec set by migrate_cache.py
+
 
 class RedisCache:
     def __init__(self, name="cache", db=0,
-                 encoder=json.dumps, decoder=json.loads):
+                 encoder=json.dumps, decoder=json.loads,
+                 lru_entries=None, lru_bytes=None, codec=None):
         self.name = name
+        # Binary codecs (see redis_codec.py) need raw bytes from redis. Their decoder also reads json values.
+        # codec="detect" takes the codec recorded by migrate_cache.py for the namespace, json otherwise.
+        self.__binary = codec is not None
         self.__conn = redis.Redis(host="localhost", port=6379, username="lsh",
-                                  password="password", decode_responses=True, db=db)
+                                  password="password", decode_responses=not self.__binary, db=db)
+        if codec == "detect":
+            codec = self.stored_codec() or "json"
+        if codec is not None:
+            encoder, decoder = CODECS[codec]
+        self.codec = codec
         self.__encoder = encoder
         self.__decoder = decoder
+        # Optional in-process LRU in front of redis, writes go through to redis.
+        # Values are shared with the callers, so they must not be modified in place.
+        self.lru = None
+        if lru_entries is not None or lru_bytes is not None:
+            self.lru = LRUCache(max_entries=lru_entries, max_bytes=lru_bytes)
 
     def __gen_key(self, key):
         return self.name + ":" + key
 
-    def add(self, key: str, value: dict):
-        key = self.__gen_key(key)
-        value = self.__encoder(value)
-        res = self.__conn.set(key, value, get=True)
+    def stored_codec(self):
+        # Codec the namespace was migrated to, kept outside of the namespace
+        codec = self.__conn.get(CODEC_KEY + self.name)
+        if isinstance(codec, bytes):
+            codec = codec.decode("utf-8")
+        return codec
+
+    def set_stored_codec(self, codec):
+        self.__conn.set(CODEC_KEY + self.name, codec)
+
+    def add(self, key: str, value: dict, ex: int = None):
+        # ex: expire time in seconds. Note that the LRU layer does not expire entries.
+        encoded = self.__encoder(value)
+        res = self.__conn.set(self.__gen_key(key), encoded, ex=ex, get=True)
+        if self.lru is not None:
+            self.lru.put(key, value, len(encoded))
         if res is not None:
             res = self.__decoder(res)
         return res
 
     def get(self, key: str) -> dict:
-        key = self.__gen_key(key)
-        res = self.__conn.get(key)
+        if self.lru is not None:
+            res = self.lru.get(key)
+            if res is not None:
+                return res
+        res = self.__conn.get(self.__gen_key(key))
         if res is not None:
-            res = self.__decoder(res)
+            encoded = res
+            res = self.__decoder(encoded)
+            if self.lru is not None:
+                self.lru.put(key, res, len(encoded))
         return res
 
+    def get_many(self, keys: list, batch: int = 10000) -> list:
+        # MGETs of `batch` keys sent in one pipeline, values are returned in the order of keys
+        res = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            if self.lru is not None:
+                res[i] = self.lru.get(key)
+            if res[i] is None:
+                missing.append(i)
+        if len(missing) == 0:
+            return res
+        pipe = self.__conn.pipeline(transaction=False)
+        for i in range(0, len(missing), batch):
+            pipe.mget([self.__gen_key(keys[j]) for j in missing[i:i + batch]])
+        values = itertools.chain.from_iterable(pipe.execute())
+        for i, encoded in zip(missing, values):
+            if encoded is not None:
+                res[i] = self.__decoder(encoded)
+                if self.lru is not None:
+                    self.lru.put(keys[i], res[i], len(encoded))
+        return res
+
+    def add_many(self, items: dict, batch: int = 10000, ex: int = None, px: dict = None):
+        # px: key -> expire time in milliseconds, for the keys that expire (e.g., from pttl_many)
+        if len(items) == 0:
+            return
+        items = list(items.items())
+        pipe = self.__conn.pipeline(transaction=False)
+        for i in range(0, len(items), batch):
+            encoded = {key: self.__encoder(value) for key, value in items[i:i + batch]}
+            if ex is None:
+                pipe.mset({self.__gen_key(key): value for key, value in encoded.items()})
+            else:  # MSET cannot set expire times
+                for key, value in encoded.items():
+                    pipe.set(self.__gen_key(key), value, ex=ex)
+            if px is not None:
+                for key in encoded:
+                    if key in px:
+                        pipe.pexpire(self.__gen_key(key), px[key])
+            if self.lru is not None:
+                for key, value in items[i:i + batch]:
+                    self.lru.put(key, value, len(encoded[key]))
+        pipe.execute()
+
+    def pttl_many(self, keys: list) -> list:
+        # Remaining time to live in milliseconds of each key, -1 without expire time, -2 if missing
+        pipe = self.__conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.pttl(self.__gen_key(key))
+        return pipe.execute()
+
     def remove(self, key) -> int:
+        if self.lru is not None:
+            self.lru.remove(key)
         key = self.__gen_key(key)
         return self.__conn.delete(key)
 
+    def clear(self, batch: int = 1000) -> int:
+        # Remove the whole namespace
+        if self.lru is not None:
+            self.lru.clear()
+        n_keys = 0
+        full_keys = []
+        for full_key in self.__conn.scan_iter(self.__gen_key("*"), count=batch):
+            full_keys.append(full_key)
+            if len(full_keys) >= batch:
+                n_keys += self.__conn.unlink(*full_keys)
+                full_keys = []
+        if len(full_keys) > 0:
+            n_keys += self.__conn.unlink(*full_keys)
+        return n_keys
+
+    def stats(self) -> dict:
+        if self.lru is None:
+            return {"name": self.name, "lru": False}
+        return {"name": self.name, "lru": True, **self.lru.stats()}
+
     def scan(self, key):
         key = self.__gen_key(key)
         res = []
         for full_key in self.__conn.scan_iter(key):
+            if self.__binary:
+                full_key = full_key.decode("utf-8")
             res.append(full_key.replace(self.name + ":", ''))
         return res
+
+    def scan_namespace(self, batch: int = 1000):
+        # Yield (key, value) of the whole namespace, SCAN `batch` keys at a time and MGET their values
+        prefix_len = len(self.name) + 1
+        full_keys = []
+        for full_key in self.__conn.scan_iter(self.__gen_key("*"), count=batch):
+            full_keys.append(full_key)
+            if len(full_keys) >= batch:
+                yield from self.__mget_items(full_keys, prefix_len)
+                full_keys = []
+        yield from self.__mget_items(full_keys, prefix_len)
+
+    def __mget_items(self, full_keys, prefix_len):
+        if len(full_keys) == 0:
+            return
+        for full_key, value in zip(full_keys, self.__conn.mget(full_keys)):
+            if value is None:  # removed during the scan
+                continue
+            if self.__binary:
+                full_key = full_key.decode("utf-8")
+            yield full_key[prefix_len:], self.__decoder(value)
@@ -0,0 +1,108 @@
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Binary values start with a magic byte, which never starts a json document,
+# so decode() reads both the binary formats and the old json values.
+LOC_MAGIC = b"\x01"
+MSGPACK_MAGIC = b"\x02"
+
+LOC_KEYS = {"place", "country", "lat", "lng", "method"}
+LOC_METHODS = ["local", "geofeed", "ispfeed", "peeringDB", "hoiho", "ripe IP Map", "ipinfo"]
+LOC_METHOD_IDX = {method: i for i, method in enumerate(LOC_METHODS)}
+LOC_STRUCT = struct.Struct("<ddB")  # lat, lng, method index
+STR_LEN = struct.Struct("<H")
+NONE_LEN = 0xFFFF
+
+
+def encode_json(value) -> bytes:
+    return json.dumps(value).encode("utf-8")
+
+
+def encode_msgpack(value) -> bytes:
+    if msgpack is None:
+        return encode_json(value)
+    return MSGPACK_MAGIC + msgpack.packb(value, use_bin_type=True)
+
+
+def _encode_str(s):
+    if s is None:
+        return STR_LEN.pack(NONE_LEN)
+    data = s.encode("utf-8")
+    return STR_LEN.pack(len(data)) + data
+
+
+def _decode_str(data, offset):
+    (n,) = STR_LEN.unpack_from(data, offset)
+    offset += STR_LEN.size
+    if n == NONE_LEN:
+        return None, offset
+    return data[offset:offset + n].decode("utf-8"), offset + n
+
+
+def encode_loc(value) -> bytes:
+    # Fixed layout for the records returned by GeoLocate.geoLocate, anything else falls back to msgpack
+    try:
+        if value.keys() != LOC_KEYS or value["method"] not in LOC_METHOD_IDX or \
+                type(value["lat"]) is not float or type(value["lng"]) is not float:
+            return encode_msgpack(value)
+        place = _encode_str(value["place"])
+        country = _encode_str(value["country"])
+    except (AttributeError, TypeError):
+        return encode_msgpack(value)
+    if len(place) > NONE_LEN or len(country) > NONE_LEN:
+        return encode_msgpack(value)
+    return LOC_MAGIC + LOC_STRUCT.pack(value["lat"], value["lng"], LOC_METHOD_IDX[value["method"]]) + \
+        place + country
+
+
+def decode_loc(data: bytes):
+    lat, lng, method = LOC_STRUCT.unpack_from(data, 1)
+    place, offset = _decode_str(data, 1 + LOC_STRUCT.size)
+    country, offset = _decode_str(data, offset)
+    return {"place": place, "country": country, "lat": lat, "lng": lng, "method": LOC_METHODS[method]}
+
+
+def decode(data):
+    if isinstance(data, str):
+        return json.loads(data)
+    magic = data[:1]
+    if magic == LOC_MAGIC:
+        return decode_loc(data)
+    if magic == MSGPACK_MAGIC:
+        return msgpack.unpackb(data[1:], raw=False)
+    return json.loads(data)
+
+
+CODECS = {
+    "json": (encode_json, decode),
+    "msgpack": (encode_msgpack, decode),
+    "loc": (encode_loc, decode),
+}
+
+
+if __name__ == "__main__":
+    import time
+
+    loc = {"place": "Frankfurt am Main", "country": "DE",
+           "lat": 50.1109221, "lng": 8.6821267, "method": "geofeed"}
+    n = 200000
+    for name, (encoder, decoder) in CODECS.items():
+        if name == "msgpack" and msgpack is None:
+            print("msgpack is not installed")
+            continue
+        data = encoder(loc)
+        assert decoder(data) == loc
+        start = time.time()
+        for _ in range(n):
+            encoder(loc)
+        mid = time.time()
+        for _ in range(n):
+            decoder(data)
+        end = time.time()
+        print("%-8s %3d bytes, encode %8.0f/s, decode %8.0f/s" %
+              (name, len(data), n / (mid - start), n / (end - mid)))
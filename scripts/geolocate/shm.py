@@ -0,0 +1,89 @@
+import os
+import mmap
+import hashlib
+from multiprocessing import shared_memory, resource_tracker
+
+from . import snapshot
+
+# Read-only lookup tables published once into POSIX shared memory and attached zero-copy by
+# later processes. A segment holds the same bytes as a snapshot file (see snapshot.py), so it
+# carries the format version and the fingerprint of its source files: attach() returns None
+# for a segment of another version or built from files that changed since.
+#
+# Segments outlive the publishing process and are removed by unlink() (or a reboot).
+
+
+def segment_name(kind, dirt):
+    # One segment per table kind and data directory
+    digest = hashlib.sha1(os.path.abspath(dirt).encode("utf-8")).hexdigest()[:12]
+    return f"geolocate_{kind}_{digest}"
+
+
+def untrack(shm):
+    # The resource tracker would unlink the segment when this process exits
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def publish(name, data):
+    # Replace the segment `name` with the snapshot bytes `data`. Processes attached to the old
+    # segment keep their mapping until they exit.
+    unlink(name)
+    shm = shared_memory.SharedMemory(name=name, create=True, size=len(data))
+    untrack(shm)
+    shm.buf[:len(data)] = data
+    shm.close()
+    print("Published %s (%.1f MB)" % (name, len(data) / 2 ** 20))
+
+
+def attach(name, sources):
+    # Return a snapshot.Snapshot backed by the segment, or None if it is missing or stale
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return None
+    untrack(shm)
+    # A read-only mapping of our own, so the SharedMemory object can be closed right away
+    mm = mmap.mmap(shm._fd, shm.size, access=mmap.ACCESS_READ)
+    shm.close()
+    snap = snapshot.parse(mm, sources)
+    if snap is None:
+        print("Shared memory segment %s is stale" % name)
+        return None
+    snap.owner = name
+    return snap
+
+
+def unlink(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return False
+    shm.unlink()  # also unregisters it from the resource tracker
+    shm.close()
+    return True
+
+
+if __name__ == "__main__":
+    # Publish the GeoLocate and IpAsnOrg tables of a data directory, e.g., from scripts/:
+    #   python -m geolocate.shm publish --dirt ../data
+    #   python -m geolocate.shm unlink --dirt ../data
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=["publish", "unlink"])
+    parser.add_argument('--dirt', metavar='dirt', type=str, default="../data")
+    args = parser.parse_args()
+
+    if args.action == "publish":
+        from .geolocate import GeoLocate
+        from .ip_asn_org import IpAsnOrg
+
+        GeoLocate(dirt=args.dirt).publish()
+        IpAsnOrg(dirt=args.dirt).publish()
+    else:
+        for kind in ["static", "ipasn"]:
+            name = segment_name(kind, args.dirt)
+            print(name, "removed" if unlink(name) else "not found")
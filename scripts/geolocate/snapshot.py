@@ -0,0 +1,298 @@
+import os
+import sys
+import mmap
+import json
+import array
+import pickle
+import socket
+import struct
+import bisect
+import hashlib
+import threading
+import ipaddress
+
+# Versioned snapshot of the static GeoLocate tables:
+#   MAGIC | version (uint32) | header length (uint64) | json header | 8-byte aligned sections
+# Array sections are read zero-copy from a read-only mmap, other objects are pickled sections.
+MAGIC = b"GLSNAP\0\0"
+VERSION = 4  # 2: hoiho rules are HoihoRule objects, 3: slim records (records.py), 4: hoiho hint positions
+PREAMBLE = struct.Struct("<8sIQ")
+
+
+def ip_to_int(ip: str):
+    if ":" in ip:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+    return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+
+
+def prefix_range(prefix: str):
+    net = ipaddress.ip_network(prefix, strict=False)
+    return net.version, int(net.network_address), int(net.broadcast_address)
+
+
+def flatten(ranges):
+    # Longest-prefix match over nested prefixes -> disjoint sorted intervals.
+    # ranges: [(start, end, value index)], for identical prefixes the later one wins like in PyTricia
+    starts, ends, vals = [], [], []
+
+    def emit(start, end, val):
+        if start > end:
+            return
+        if len(ends) > 0 and ends[-1] + 1 == start and vals[-1] == val:
+            ends[-1] = end
+            return
+        starts.append(start)
+        ends.append(end)
+        vals.append(val)
+
+    stack = []  # (end, val) of the enclosing prefixes
+    cur = 0
+    for start, end, val in sorted(ranges, key=lambda r: (r[0], -r[1])):
+        while len(stack) > 0 and stack[-1][0] < start:
+            top_end, top_val = stack.pop()
+            emit(cur, top_end, top_val)
+            cur = top_end + 1
+        if len(stack) > 0:
+            emit(cur, start - 1, stack[-1][1])
+        stack.append((end, val))
+        cur = start
+    while len(stack) > 0:
+        top_end, top_val = stack.pop()
+        emit(cur, top_end, top_val)
+        cur = top_end + 1
+    return starts, ends, vals
+
+
+class U128View:
+    # Sequence of 128-bit integers stored as two uint64 arrays, for bisect
+    def __init__(self, hi, lo):
+        self.hi = hi
+        self.lo = lo
+
+    def __len__(self):
+        return len(self.hi)
+
+    def __getitem__(self, i):
+        return (self.hi[i] << 64) | self.lo[i]
+
+
+class PrefixTable:
+    # Read-only replacement of PyTricia for `ip in table`, `table[ip]`, `table.get(ip)`
+    def __init__(self, v4, v6, values, n_prefixes):
+        self.v4 = v4  # (starts, ends, vals) of uint32
+        self.v6 = v6  # ((hi, lo) starts, (hi, lo) ends, vals)
+        self.values = values
+        self.n_prefixes = n_prefixes
+        self.__v6_starts = U128View(*v6[0])
+        self.__v6_ends = U128View(*v6[1])
+
+    @staticmethod
+    def fromItems(items):
+        # items: [(prefix, value)] in insertion order
+        ranges = {4: [], 6: []}
+        values = []
+        for prefix, value in items:
+            version, start, end = prefix_range(prefix)
+            ranges[version].append((start, end, len(values)))
+            values.append(value)
+        starts, ends, vals = flatten(ranges[4])
+        v4 = (array.array("I", starts), array.array("I", ends), array.array("I", vals))
+        starts, ends, vals = flatten(ranges[6])
+        mask = (1 << 64) - 1
+        v6 = ((array.array("Q", [x >> 64 for x in starts]), array.array("Q", [x & mask for x in starts])),
+              (array.array("Q", [x >> 64 for x in ends]), array.array("Q", [x & mask for x in ends])),
+              array.array("I", vals))
+        return PrefixTable(v4, v6, values, len(values))
+
+    @staticmethod
+    def fromPyTricia(pyt):
+        return PrefixTable.fromItems([(prefix, pyt[prefix]) for prefix in pyt])
+
+    def __len__(self):
+        return self.n_prefixes
+
+    def __lookup(self, ip):
+        try:
+            version, n = ip_to_int(ip)
+        except (OSError, ValueError, TypeError):
+            return None
+        if version == 4:
+            starts, ends, vals = self.v4
+        else:
+            starts, ends, vals = self.__v6_starts, self.__v6_ends, self.v6[2]
+        i = bisect.bisect_right(starts, n) - 1
+        if i >= 0 and n <= ends[i]:
+            return vals[i]
+        return None
+
+    def __contains__(self, ip):
+        return self.__lookup(ip) is not None
+
+    def __getitem__(self, ip):
+        i = self.__lookup(ip)
+        if i is None:
+            raise KeyError(ip)
+        return self.values[i]
+
+    def get(self, ip, default=None):
+        i = self.__lookup(ip)
+        return default if i is None else self.values[i]
+
+    def arrays(self):
+        return {"v4.starts": self.v4[0], "v4.ends": self.v4[1], "v4.vals": self.v4[2],
+                "v6.starts.hi": self.v6[0][0], "v6.starts.lo": self.v6[0][1],
+                "v6.ends.hi": self.v6[1][0], "v6.ends.lo": self.v6[1][1], "v6.vals": self.v6[2]}
+
+    @staticmethod
+    def fromArrays(arrays, values, n_prefixes):
+        v4 = (arrays["v4.starts"], arrays["v4.ends"], arrays["v4.vals"])
+        v6 = ((arrays["v6.starts.hi"], arrays["v6.starts.lo"]),
+              (arrays["v6.ends.hi"], arrays["v6.ends.lo"]), arrays["v6.vals"])
+        return PrefixTable(v4, v6, values, n_prefixes)
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fingerprint(sources):
+    res = {}
+    for path in sources:
+        if os.path.isfile(path):
+            st = os.stat(path)
+            res[path] = [st.st_size, st.st_mtime_ns, file_hash(path)]
+        else:
+            res[path] = None
+    return res
+
+
+def is_fresh(saved, sources):
+    # Cheap stat check first, hash only the files whose size or mtime changed
+    if sorted(saved.keys()) != sorted(sources):
+        return False
+    for path in sources:
+        if saved[path] is None or not os.path.isfile(path):
+            if saved[path] is not None or os.path.isfile(path):
+                return False
+            continue
+        st = os.stat(path)
+        size, mtime_ns, digest = saved[path]
+        if st.st_size != size:
+            return False
+        if st.st_mtime_ns != mtime_ns and file_hash(path) != digest:
+            return False
+    return True
+
+
+def pack(sources, objects: dict, tables: dict, arrays=None):
+    # objects: name -> picklable object, tables: name -> PrefixTable, arrays: name -> array.array
+    sections = []  # (name, kind, typecode, bytes)
+    for name, arr in (arrays or {}).items():
+        sections.append((name, "array", arr.typecode, arr.tobytes()))
+    for name, obj in objects.items():
+        sections.append((name, "pickle", None, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)))
+    meta = {}
+    for name, table in tables.items():
+        for key, arr in table.arrays().items():
+            sections.append((f"{name}.{key}", "array", arr.typecode, arr.tobytes()))
+        sections.append((f"{name}.values", "pickle", None,
+                         pickle.dumps(table.values, protocol=pickle.HIGHEST_PROTOCOL)))
+        meta[name] = {"n_prefixes": table.n_prefixes}
+
+    header = {"byteorder": sys.byteorder, "sources": fingerprint(sources),
+              "tables": meta, "sections": {}}
+    offset = 0
+    for name, kind, typecode, data in sections:
+        header["sections"][name] = {"kind": kind, "typecode": typecode, "offset": offset, "length": len(data)}
+        offset += (len(data) + 7) // 8 * 8
+    header = json.dumps(header).encode("utf-8")
+    header += b" " * ((-(PREAMBLE.size + len(header))) % 8)
+
+    chunks = [PREAMBLE.pack(MAGIC, VERSION, len(header)), header]
+    for _, _, _, data in sections:
+        chunks.append(data)
+        chunks.append(b"\0" * ((-len(data)) % 8))
+    return b"".join(chunks)
+
+
+def save(path, sources, objects: dict, tables: dict, arrays=None):
+    data = pack(sources, objects, tables, arrays)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as fout:
+        fout.write(data)
+    os.replace(tmp, path)
+
+
+class Snapshot:
+    # Sections are decoded on first access, the arrays stay zero-copy views of the mmap
+    # (or of the shared memory segment, see shm.py)
+    def __init__(self, mm, header, base):
+        self.mm = mm
+        self.owner = None  # name of the shared memory segment, if attached from one
+        self.header = header
+        self.base = base
+        self.buf = memoryview(mm)
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def names(self):
+        tables = self.header["tables"]
+        return list(tables.keys()) + [name for name in self.header["sections"]
+                                      if name.split(".", 1)[0] not in tables]
+
+    def __section(self, name):
+        sec = self.header["sections"][name]
+        data = self.buf[self.base + sec["offset"]:self.base + sec["offset"] + sec["length"]]
+        if sec["kind"] == "array":
+            return data.cast(sec["typecode"])
+        return pickle.loads(data)
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.cache:
+                if name in self.header["tables"]:
+                    prefix = name + "."
+                    arrays = {key[len(prefix):]: self.__section(key) for key in self.header["sections"]
+                              if key.startswith(prefix) and key != prefix + "values"}
+                    self.cache[name] = PrefixTable.fromArrays(arrays, self.__section(prefix + "values"),
+                                                              self.header["tables"][name]["n_prefixes"])
+                else:
+                    self.cache[name] = self.__section(name)
+            return self.cache[name]
+
+
+def parse(mm, sources):
+    # Return a Snapshot of a buffer, or None if it is of another version or stale
+    if len(mm) < PREAMBLE.size:
+        return None
+    magic, version, header_len = PREAMBLE.unpack_from(mm, 0)
+    if magic != MAGIC or version != VERSION:
+        return None
+    header = json.loads(bytes(mm[PREAMBLE.size:PREAMBLE.size + header_len]))
+    if header["byteorder"] != sys.byteorder or not is_fresh(header["sources"], sources):
+        return None
+    return Snapshot(mm, header, PREAMBLE.size + header_len)
+
+
+def load_lazy(path, sources):
+    # Return a Snapshot, or None if the snapshot is missing, of another version or stale
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as fin:
+        try:
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return None
+    return parse(mm, sources)
+
+
+def load(path, sources):
+    # Return {name: object or PrefixTable}, or None if the snapshot is missing, of another version or stale
+    snap = load_lazy(path, sources)
+    if snap is None:
+        return None
+    return {name: snap.get(name) for name in snap.names()}
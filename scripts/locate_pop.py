@@ -1,27 +1,162 @@
+import os
 import sys
 import json
 import csv
+import queue
 import ipaddress
 import argparse
+import threading
+import itertools
+import contextlib
+import collections
+import multiprocessing
+
+# Importing this module has no side effects: utils (database, GeoLocate) and IpAsnOrg are loaded
+# when first used, and the CLI is main().
+
+ipasn = None  # ASN resolver (IpAsnOrg), geolocator (GeoLocate) and probe map of the chunk functions,
+geoloc = None  # set by use() before the workers are forked
+probe_loc = None
+ip_asns = {}  # ip -> (asn, method) or None, memo of ipasn.lookup
+ip_locs = {}  # ip -> location or None, memo of geoloc
+worker_reports = {}  # pid -> last geoloc report of a worker, returned with its chunks
+
+
+def get_probe_loc(table_tag="20240901"):
+    import utils
+    return utils.get_probes_coordinates_city_asn("probe20240801" if table_tag == "20240901" else "probe20231130")
+
+
+def use(asn_resolver=None, geolocator=None, probes=None):
+    # Set the dependencies of the chunk functions. The defaults are the current ones, or built on
+    # first use: IpAsnOrg of utils.data_dir, utils.geoloc and the probes of probe20240801
+    global ipasn, geoloc, probe_loc
+    if asn_resolver is None:
+        asn_resolver = ipasn
+    if asn_resolver is None:
+        import utils
+        from geolocate import ip_asn_org
+        asn_resolver = ip_asn_org.IpAsnOrg(dirt=f"{utils.data_dir}")
+    if geolocator is None:
+        geolocator = geoloc
+    if geolocator is None:
+        import utils
+        geolocator = utils.geoloc
+    if probes is None:
+        probes = probe_loc if probe_loc is not None else get_probe_loc()
+    if asn_resolver is not ipasn:
+        ip_asns.clear()
+    if geolocator is not geoloc:
+        ip_locs.clear()
+    ipasn, geoloc, probe_loc = asn_resolver, geolocator, probes
+
+
+def lookup_asn(ip):
+    if ip not in ip_asns:
+        res = ipasn.lookup(ip)
+        ip_asns[ip] = None if res is None else (res["asn"], res["method"])
+    return ip_asns[ip]
+
+
+def locate_ips(ips):
+    # Locate the IPs not seen yet at once: rDNS and RIPE IPmap/ipinfo prefetched concurrently, then
+    # pipelined cache reads. With geoloc budgets, the network lookups are left to the pipeline,
+    # which defers the IPs over budget (None) to runDeferred, whose batch pass prefetches them.
+    ips = [ip for ip in dict.fromkeys(ips) if ip not in ip_locs]
+    if len(ips) > 0:
+        if geoloc.pipeline.call_budget is None and geoloc.pipeline.run_budget is None:
+            geoloc.prefetchRDNS(ips)
+            geoloc.prefetchExternal(ips)
+        locs = geoloc.geoLocateMany(ips)
+        locs.update(geoloc.runDeferred())
+        ip_locs.update(locs)
+
+
+def needed_hops(hops, borders):
+    # Indexes of the hops whose location can reach a row: the hops with a border IP, and the hop
+    # before each hop with the borders[1] IP, whose location it may take when they are close
+    border_ips = {border["ip"] for border in borders if border is not None}
+    needed = set()
+    for i, hop in enumerate(hops):
+        if hop["ip"] in border_ips:
+            needed.add(i)
+            if i > 0 and hop["ip"] == borders[1]["ip"]:
+                needed.add(i - 1)
+    return needed
+
+
+# Repeat measurements trace the same paths again and again with only the RTTs changing, so the
+# RTT-independent part of a result is kept per path. Both are cleared per locate call (cloud), and
+# paths keeps only the MAX_PATHS most recently used, as one-off traces never repeat.
+MAX_PATHS = 100000
+paths = collections.OrderedDict()  # path key -> (border0, border1, ixp_pop, separated, needed hops) or None without border
+pop_listed_memo = {}  # (place, country, lat, lng) -> in the pop list of the cloud
+
+
+def trace_path(hops, cloud_asns):
+    # Border of a traceroute in: the first hop in the cloud ASNs and the hop before it,
+    # as (index, asn) pairs
+    for i, hop in enumerate(hops):
+        asn = lookup_asn(hop["ip"])  # ensure vm ip is correctly mapped to asn
+        if asn is not None and asn[0] in cloud_asns:  # `hop_ip in cloud_ixp_ips` included in ipasn.lookup
+            border0 = None
+            if i > 0:
+                prev_asn = lookup_asn(hops[i - 1]["ip"])
+                border0 = (i - 1, None if prev_asn is None else prev_asn[0])
+            ixp_pop = (asn[1] == "ixp")
+            return border0, (i, asn[0]), ixp_pop
+    return None
 
-import pytricia
-
-import utils
-from geolocate import ip_asn_org
 
+def trout_path(hops, cloud_asns):
+    # Border of a traceroute out: the first hop not in the cloud ASNs and the hop before it
+    prev_asn = None
+    for i, hop in enumerate(hops):
+        asn = lookup_asn(hop["ip"])
+        if (None if asn is None else asn[0]) not in cloud_asns:
+            border0 = None
+            ixp_pop = None
+            if i > 0:
+                border0 = (i - 1, None if prev_asn is None else prev_asn[0])
+                ixp_pop = (prev_asn is not None and prev_asn[1] == "ixp")
+            return border0, (i, None if asn is None else asn[0]), ixp_pop
+        prev_asn = asn
+    return None
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-c', '--cloud', metavar='cloud',
-                    type=str, help="AWS, Azure, Google")
-parser.add_argument('-t', '--table_tag', metavar='table_tag',
-                    type=str, help="20240304 or 20240901", required=True)
-parser.add_argument('-s', '--start_time', metavar='start_time',
-                    type=str, help="eg. 2024-04-07 10:00:00-04:00", required=True)
-parser.add_argument('-r', '--repeat', action='store_true')
-args = parser.parse_args()
-print(' '.join(sys.argv), args)
 
-ipasn = ip_asn_org.IpAsnOrg(dirt=f"{utils.data_dir}")
+def get_path(key, hops, find_border, cloud_asns, stats):
+    stats["traces"] += 1
+    if key in paths:
+        stats["path_reuse"] += 1
+        paths.move_to_end(key)
+        return paths[key]
+    path = find_border(hops, cloud_asns)
+    if path is not None:
+        border0, border1, ixp_pop = path
+        borders = [None if border0 is None else hops[border0[0]], hops[border1[0]]]
+        separated = (border0 is None) or (borders[0]["id"] + 1 != borders[1]["id"])
+        path = (border0, border1, ixp_pop, separated, needed_hops(hops, borders))
+    paths[key] = path
+    if len(paths) > MAX_PATHS:
+        paths.popitem(last=False)
+    return path
+
+
+def path_borders(hops, path):
+    borders = [None, None]
+    for i, border in enumerate(path[:2]):
+        if border is not None:
+            borders[i] = hops[border[0]]
+            borders[i]["asn"] = border[1]
+    return borders
+
+
+def pop_listed(loc, cloud_pop_list):
+    import utils
+    key = (loc["place"], loc["country"], loc["lat"], loc["lng"])
+    if key not in pop_listed_memo:
+        pop_listed_memo[key] = utils.in_pop_positions(key[:2], key[2], key[3], cloud_pop_list) is not None
+    return pop_listed_memo[key]
 
 
 def is_close(hop1, hop2):
@@ -52,42 +187,238 @@ def check_colocated(separated, dist_km, pen_rtts, pop_rtts):
     return colocated
 
 
-def locate_traceroute(traces, cloud_asns, cloud_pop_list, with_timestamp=False):
-    global probe_loc
+def init_worker():
+    # Count the geoloc statistics of the worker from zero, with the budgets of the parent
+    geoloc.newRun(geoloc.pipeline.call_budget, geoloc.pipeline.run_budget)
+
+
+def run_chunk(task):
+    func, chunk, func_args = task
+    try:
+        return func(chunk, *func_args), (os.getpid(), geoloc.report())
+    except SystemExit:  # exit() in a worker would hang the pool, let the parent exit instead
+        return None
+
+
+def worker_pool(workers):
+    # Workers are forked, so ipasn, geoloc and probe_loc are shared instead of pickled.
+    # Library callers of run_chunks/stream_locate get the defaults of use() if nothing is set yet.
+    use()
+    if workers <= 1:
+        return contextlib.nullcontext()
+    geoloc.warm()  # load the lazy sources once before forking, not in every worker
+    return multiprocessing.get_context("fork").Pool(workers, initializer=init_worker)
+
+
+def dump_report(filename):
+    # Appends the geoloc report of this process and the last one of each worker, one JSON per line
+    geoloc.dumpReport(filename)
+    with open(filename, "a") as fout:
+        for pid, report in worker_reports.items():
+            report["worker"] = pid
+            fout.write(json.dumps(report) + "\n")
+
+
+def iter_chunks(func, chunks, func_args, pool=None, in_flight=2):
+    # Yields (chunk, (rows, stats)) in chunk order, so the rows and stats are the same as the
+    # serial run. At most `in_flight` chunks are submitted to the pool ahead of the consumer.
+    if pool is None:
+        for chunk in chunks:
+            yield chunk, func(chunk, *func_args)
+        return
+    pending = collections.deque()
+
+    def take():
+        chunk, res = pending.popleft()
+        res = res.get()
+        if res is None:
+            exit()
+        res, (pid, report) = res
+        worker_reports[pid] = report
+        return chunk, res
+
+    for chunk in chunks:
+        pending.append((chunk, pool.apply_async(run_chunk, ((func, chunk, func_args),))))
+        if len(pending) >= in_flight:
+            yield take()
+    while len(pending) > 0:
+        yield take()
+
+
+def merge_stats(stats, chunk_stats):
+    for key, value in chunk_stats.items():
+        stats[key] = stats.get(key, 0) + value
+
+
+def run_chunks(func, traces, func_args, workers=1, chunk_size=1000):
+    traces = iter(traces)
+    chunks = iter(lambda: list(itertools.islice(traces, chunk_size)), [])
+    rows = []
+    stats = {}
+    with worker_pool(workers) as pool:
+        for chunk, (chunk_rows, chunk_stats) in iter_chunks(func, chunks, func_args, pool, 2 * workers):
+            rows.extend(chunk_rows)
+            merge_stats(stats, chunk_stats)
+    return rows, stats
+
+
+def sql_literal(v):
+    if isinstance(v, (int, float)):
+        return str(v)
+    return "'" + str(v).replace("'", "''") + "'"
+
+
+def stream_locate(job, func, func_args, table, cols, where, keys, out_table, workers=1, chunk_size=1000,
+                  queue_size=4, copy=True, restart=False, db=None):
+    """
+    Locate the traces of `table` chunk by chunk in the order of `keys` (the first columns of `cols`)
+    and commit the rows of each chunk into `out_table` together with the key of its last trace.
+    A reader thread and a writer thread (with its own connection) are connected to the locating
+    loop by queues of `queue_size` chunks, so memory does not grow with the table.
+    The job (a name in locate_pop_progress) resumes after its last committed chunk unless `restart`,
+    and its position is deleted once all chunks are committed, so a later run of the job starts over.
+    db: Database of the tables, utils.db by default
+    """
+    if db is None:
+        import utils
+        db = utils.db
+    paths.clear()
+    pop_listed_memo.clear()
+    n_keys = len(keys.split(","))
+    if restart:
+        db.execute_raw([("DELETE FROM locate_pop_progress WHERE job=%s", (job,))])
+    res = db.query("locate_pop_progress", "position", f"job={sql_literal(job)}")
+    if len(res) > 0:
+        print("%s: resume after %s" % (out_table, res[0][0]))
+        where = f"({where}) and ({keys}) > ({','.join(sql_literal(v) for v in res[0][0])})"
+
+    chunks = queue.Queue(queue_size)
+    results = queue.Queue(queue_size)
+    errors = []
+
+    def iter_queue(q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def read():
+        try:
+            for chunk in db.iter_query(table, cols, where, f"ORDER BY {keys}",
+                                       itersize=chunk_size, batched=True):
+                chunks.put(chunk)
+        except Exception as e:
+            chunks.put(e)
+            return
+        chunks.put(None)
+
+    def write():
+        writer_db = db.clone()
+        for rows, position in iter_queue(results):
+            if len(errors) > 0:
+                continue  # drain
+            try:
+                writer_db.insert(out_table, rows, copy=copy, commit=False)
+                writer_db.execute_raw([("INSERT INTO locate_pop_progress (job, position, n_rows) VALUES (%s, %s, %s) " +
+                                 "ON CONFLICT (job) DO UPDATE SET position=excluded.position, " +
+                                 "n_rows=locate_pop_progress.n_rows+excluded.n_rows, updated_at=now()",
+                                 (job, json.dumps(position, default=str), len(rows)))], commit=False)
+                writer_db.commit()
+            except Exception as e:
+                writer_db.rollback()
+                errors.append(e)
+
+    stats = {}
+    with worker_pool(workers) as pool:
+        reader = threading.Thread(target=read, daemon=True)
+        writer = threading.Thread(target=write, daemon=True)
+        reader.start()
+        writer.start()
+        try:
+            for chunk, (rows, chunk_stats) in iter_chunks(func, iter_queue(chunks), func_args, pool, 2 * workers):
+                merge_stats(stats, chunk_stats)
+                if len(errors) > 0:
+                    break
+                results.put((rows, list(chunk[-1][:n_keys])))
+        finally:
+            results.put(None)
+            writer.join()
+    if len(errors) > 0:
+        raise errors[0]
+    db.execute_raw([("DELETE FROM locate_pop_progress WHERE job=%s", (job,))])
+    print_stats(stats)
+
+
+def print_stats(stats):
+    print(stats)
+    if stats.get("traces", 0) > 0:
+        print("path reuse: %d/%d (%.1f%%)" % (stats["path_reuse"], stats["traces"],
+                                              100 * stats["path_reuse"] / stats["traces"]))
+
+
+def locate_traceroute(traces, cloud_asns, cloud_pop_list, with_timestamp=False, workers=1,
+                      ipasn=None, geoloc=None, probe_loc=None):
+    # traces: (msm_id, prb_id, timestamp, sanitized_hops, ip_from), see use() for the other arguments
+    use(ipasn, geoloc, probe_loc)
+    paths.clear()
+    pop_listed_memo.clear()
+    rows, stats = run_chunks(locate_traceroute_chunk, traces,
+                             (cloud_asns, cloud_pop_list, with_timestamp), workers)
+    print_stats(stats)
+    return rows
+
+
+def locate_traceroute_out(trouts, cloud_asns, cloud_pop_list, workers=1,
+                          ipasn=None, geoloc=None, probe_loc=None):
+    # trouts: (trout_id, prb_id, vm_ip, dst_ip, sanitized_hops)
+    use(ipasn, geoloc, probe_loc)
+    paths.clear()
+    pop_listed_memo.clear()
+    rows, stats = run_chunks(locate_traceroute_out_chunk, trouts,
+                             (cloud_asns, cloud_pop_list), workers)
+    print_stats(stats)
+    return rows
+
+
+def locate_traceroute_chunk(traces, cloud_asns, cloud_pop_list, with_timestamp=False):
+    import utils
     stats = {
         "geo_violate_event": 0,
-        "colocate_event": 0
+        "colocate_event": 0,
+        "traces": 0,
+        "path_reuse": 0,
     }
     rows = []
+    # Find the borders of all traces first, then locate the IPs of the hops that need a location
+    # at once, so that each IP is located once
+    traces_borders = []
+    needed_ips = []
     for msm_id, prb_id, timestamp, hops, ip_from in traces:
-        borders = [None, None]
-        prev = None
+        key = (ip_from,) + tuple((hop["ip"], hop["id"]) for hop in hops)
         hops = [{"id": -1, "ip": ip_from,
                  "ttl": 0, "rtts": [0, 0, 0]}] + hops
-        for hop in hops:
-            hop_ip = hop["ip"]  # ensure vm ip is correctly mapped to asn
-            hop["asn"] = ipasn.lookup(hop_ip)
-            if hop["asn"] is not None:
-                method = hop["asn"]["method"]
-                hop["asn"] = hop["asn"]["asn"]
-                if hop["asn"] in cloud_asns:  # `hop_ip in cloud_ixp_ips` included in ipasn.lookup
-                    ixp_pop = (method == "ixp")
-                    borders[0] = prev
-                    borders[1] = hop
-                    break  # hop["asn"] should not be used later
-            prev = hop
-
-        if borders[1] is None:
+        path = get_path(key, hops, trace_path, cloud_asns, stats)
+        if path is None:
             continue
 
-        separated = False
-        if (borders[0] is None) or (borders[0]["id"] + 1 != borders[1]["id"]):
-            separated = True
+        borders = path_borders(hops, path)
+        ixp_pop, separated, needed = path[2:]
+        needed_ips.extend(hops[i]["ip"] for i in needed if hops[i]["ip"] != ip_from)
+        traces_borders.append((msm_id, prb_id, timestamp, hops, ip_from, borders, ixp_pop, separated, needed))
+    locate_ips(needed_ips)
 
+    for msm_id, prb_id, timestamp, hops, ip_from, borders, ixp_pop, separated, needed in traces_borders:
         prb_loc = probe_loc[prb_id] if prb_id in probe_loc else None
         prev = None
         prev_res = None
-        for hop in hops:
+        for i, hop in enumerate(hops):
+            if i not in needed:  # its location cannot reach the row
+                prev_res = None
+                prev = hop
+                continue
             if hop["ip"] == ip_from:
                 if prb_loc is not None:
                     res = {"place": prb_loc[1], "country": prb_loc[2],
@@ -96,7 +427,7 @@ def locate_traceroute(traces, cloud_asns, cloud_pop_list, with_timestamp=False):
                 else:
                     res = None
             else:
-                res = utils.geoloc.geoLocate(hop["ip"])
+                res = ip_locs[hop["ip"]]
 
             idx = check_border(hop, borders)
             if idx == 1 and res is None and prev_res is not None and is_close(prev, hop):
@@ -113,13 +444,13 @@ def locate_traceroute(traces, cloud_asns, cloud_pop_list, with_timestamp=False):
             prev = hop
 
         locs = [None, None]
-        pop_listed = False
+        listed = False
         for i in range(0, 2):
             if borders[i] is not None and borders[i]["loc"] is not None:
                 loc = borders[i]["loc"]
                 locs[i] = (loc["lat"], loc["lng"])
-                if i == 1 and utils.in_pop_positions((loc["place"], loc["country"]), loc["lat"], loc["lng"], cloud_pop_list) is not None:
-                    pop_listed = True
+                if i == 1 and pop_listed(loc, cloud_pop_list):
+                    listed = True
 
         dist_km = None
         if (locs[0] is not None) and (locs[1] is not None):
@@ -134,67 +465,58 @@ def locate_traceroute(traces, cloud_asns, cloud_pop_list, with_timestamp=False):
         else:
             row.extend([None, None, None, None])
         row.extend([borders[1]["ip"], borders[1]["asn"], borders[1]["ttl"], borders[1]["rtts"],
-                    ixp_pop, pop_listed, dist_km, separated])
+                    ixp_pop, listed, dist_km, separated])
         colocated = False
         if (borders[0] is not None) and (borders[1] is not None):
             colocated = check_colocated(
                 separated, dist_km, borders[0]["rtts"], borders[1]["rtts"])
         row.append(colocated)
         rows.append(row)
-    print(stats)
-    return rows
+    return rows, stats
 
 
-def locate_traceroute_out(trouts, cloud_asns, cloud_pop_list):
-    global probe_loc
+def locate_traceroute_out_chunk(trouts, cloud_asns, cloud_pop_list):
+    import utils
     stats = {
         "geo_violate_event": 0,
         "colocate_event": 0,
+        "traces": 0,
+        "path_reuse": 0,
     }
     rows = []
+    # Same two passes as locate_traceroute_chunk
+    trouts_borders = []
+    needed_ips = []
     for tid, prb_id, vm_ip, dst_ip, hops in trouts:
-        vm_loc = utils.geoloc.geoLocate(vm_ip)
+        vm_loc = geoloc.geoLocate(vm_ip)
         if vm_loc is None or vm_loc["method"] != "local":
             print("Cannot geolocate VM IP %s. Need to fix geolocate_local.csv." %
                   vm_ip, file=sys.stderr)
             exit()
 
+        key = (vm_ip, dst_ip) + tuple((hop["ip"], hop["id"]) for hop in hops)
         hops = [{"id": -1, "ip": vm_ip,
                  "ttl": 0, "rtts": [0, 0, 0]}] + hops
-        for hop in hops:
-            # ensure vm ip is correctly mapped to asn
-            asn = ipasn.lookup(hop["ip"])
-            if asn is not None:
-                hop["asn"] = asn["asn"]
-                hop["asn_method"] = asn["method"]
-            else:
-                hop["asn"] = None
-                hop["asn_method"] = None
-
-        borders = [None, None]
-        prev = None
-        for hop in hops:
-            if hop["asn"] not in cloud_asns:  # `hop_ip in cloud_ixp_ips` included in ipasn.lookup
-                borders[0] = prev
-                borders[1] = hop
-                break
-            prev = hop
-
-        if borders[1] is None:
+        # `hop_ip in cloud_ixp_ips` included in ipasn.lookup
+        path = get_path(key, hops, trout_path, cloud_asns, stats)
+        if path is None:
             continue
 
-        ixp_pop = None
-        if borders[0] is not None:
-            ixp_pop = (borders[0]["asn_method"] == "ixp")
-
-        separated = False
-        if (borders[0] is None) or (borders[0]["id"] + 1 != borders[1]["id"]):
-            separated = True
+        borders = path_borders(hops, path)
+        ixp_pop, separated, needed = path[2:]
+        needed_ips.extend(hops[i]["ip"] for i in needed if hops[i]["ip"] not in (vm_ip, dst_ip))
+        trouts_borders.append((tid, prb_id, vm_ip, dst_ip, hops, vm_loc, borders, ixp_pop, separated, needed))
+    locate_ips(needed_ips)
 
+    for tid, prb_id, vm_ip, dst_ip, hops, vm_loc, borders, ixp_pop, separated, needed in trouts_borders:
         prb_loc = probe_loc[prb_id] if prb_id in probe_loc else None
         prev = None
         prev_res = None
-        for hop in hops:
+        for i, hop in enumerate(hops):
+            if i not in needed:
+                prev_res = None
+                prev = hop
+                continue
             if hop["ip"] == vm_ip:
                 res = vm_loc
             elif hop["ip"] == dst_ip:
@@ -205,7 +527,7 @@ def locate_traceroute_out(trouts, cloud_asns, cloud_pop_list):
                 else:
                     res = None
             else:
-                res = utils.geoloc.geoLocate(hop["ip"])
+                res = ip_locs[hop["ip"]]
 
             idx = check_border(hop, borders)
             if idx == 1 and res is None and prev_res is not None and is_close(prev, hop):
@@ -227,10 +549,9 @@ def locate_traceroute_out(trouts, cloud_asns, cloud_pop_list):
                 loc = borders[i]["loc"]
                 locs[i] = (loc["lat"], loc["lng"])
 
-        pop_listed = None
+        listed = None
         if locs[0] is not None:
-            pop_listed = (utils.in_pop_positions(
-                (borders[0]["loc"]["place"], borders[0]["loc"]["country"]), locs[0][0], locs[0][1], cloud_pop_list) is not None)
+            listed = pop_listed(borders[0]["loc"], cloud_pop_list)
 
         dist_km = None
         if (locs[0] is not None) and (locs[1] is not None):
@@ -243,22 +564,68 @@ def locate_traceroute_out(trouts, cloud_asns, cloud_pop_list):
         else:
             row.extend([None, None, None, None])
         row.extend([borders[1]["ip"], borders[1]["asn"], borders[1]["ttl"], borders[1]["rtts"],
-                    ixp_pop, separated, pop_listed, dist_km])
+                    ixp_pop, separated, listed, dist_km])
         colocated = False
         if (borders[0] is not None) and (borders[1] is not None):
             colocated = check_colocated(
                 separated, dist_km, borders[1]["rtts"], borders[0]["rtts"])
         row.append(colocated)
         rows.append(row)
-    print(stats)
-    return rows
-
-
-probe_loc = utils.get_probes_coordinates_city_asn(
-    "probe20240801" if args.table_tag == "20240901" else "probe20231130")
-cloud_region_loc = utils.get_cloud_region_loc()
+    return rows, stats
+
+
+def main():
+    import utils
+    from geolocate import ip_asn_org
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cloud', metavar='cloud',
+                        type=str, help="AWS, Azure, Google")
+    parser.add_argument('-t', '--table_tag', metavar='table_tag',
+                        type=str, help="20240304 or 20240901", required=True)
+    parser.add_argument('-s', '--start_time', metavar='start_time',
+                        type=str, help="eg. 2024-04-07 10:00:00-04:00, optional with --incremental")
+    parser.add_argument('-r', '--repeat', action='store_true')
+    parser.add_argument('--no_copy', action='store_true',
+                        help="insert rows by executemany instead of COPY")
+    parser.add_argument('-w', '--workers', metavar='workers', type=int, default=1,
+                        help="number of forked processes to locate borders")
+    parser.add_argument('--shm', action='store_true',
+                        help="attach the IpAsnOrg tables published by `python -m geolocate.shm publish`")
+    parser.add_argument('--stream', action='store_true',
+                        help="stream the traces in key order and commit the rows per chunk, resuming after the last committed chunk")
+    parser.add_argument('--restart', action='store_true',
+                        help="with --stream, forget the recorded positions and start over")
+    parser.add_argument('--chunk_size', metavar='chunk_size', type=int, default=1000,
+                        help="traces per chunk")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only locate the traces after the stage watermark and without border rows")
+    parser.add_argument('--call_budget', metavar='seconds', type=float,
+                        help="seconds one IP lookup may spend before its uncached network tiers are deferred")
+    parser.add_argument('--run_budget', metavar='seconds', type=float,
+                        help="seconds of network time of the run after which uncached network tiers are deferred. " +
+                        "With a budget, the network lookups run in the pipeline instead of the per-chunk prefetch, " +
+                        "and the deferred IPs of a chunk are located by one batch pass")
+    parser.add_argument('--report', metavar='report', type=str,
+                        help="append the geolocation report (hits, misses, network time per tier) to this file at exit")
+    args = parser.parse_args()
+    if args.start_time is None and not args.incremental:
+        parser.error("the following arguments are required: -s/--start_time")
+    print(' '.join(sys.argv), args)
+
+    use(ip_asn_org.IpAsnOrg(dirt=f"{utils.data_dir}", use_shm=args.shm), utils.geoloc,
+        get_probe_loc(args.table_tag))
+    geoloc.newRun(args.call_budget, args.run_budget)
+    try:
+        locate_clouds(args)
+    finally:
+        if args.report is not None:
+            dump_report(args.report)
+
+
+def locate_clouds(args):
+    import utils
 
-if __name__ == "__main__":
     # update_border()
     # update_border_out()
     # exit()
@@ -281,34 +648,68 @@ if __name__ == "__main__":
         # utils.db.insert("tr_borders_asn_city", rows)
         # continue
 
+        def locate_table(name, func, func_args, table, cols, where, ts, keys):
+            # ts: timestamp column of the traces, keys: the first columns of cols, ordering the traces
+            # for --stream and matching the rows of the output table {name}_{table_tag}
+            out_table = f"{name}_{args.table_tag}"
+            stage = f"locate_pop_{name}"
+            if args.start_time is not None:
+                where += f" and {ts}>='{args.start_time}'"
+            since = None
+            if args.incremental:
+                since = utils.db.get_watermark(stage, cloud, args.table_tag)
+                if since is not None:
+                    where += f" and {ts}>='{since}'"
+                # traces without border have no row, they are only skipped by the watermark
+                where += f" and NOT EXISTS (SELECT 1 FROM {out_table} AS o WHERE " + \
+                    " and ".join(f"o.{key.strip().split('.')[-1]}={key.strip()}" for key in keys.split(",")) + ")"
+                watermark = utils.db.query(table, f"max({ts})", where)[0][0]
+
+            if args.stream:
+                # each incremental run starts from a new watermark, so it is a new job
+                stream_locate(f"{out_table}:{cloud}:{args.start_time}:{since}", func, func_args, table, cols, where, keys,
+                              out_table, workers=args.workers, chunk_size=args.chunk_size,
+                              copy=not args.no_copy, restart=args.restart)
+            else:
+                paths.clear()
+                pop_listed_memo.clear()
+                traces = utils.db.iter_query(table, cols, where)
+                rows, stats = run_chunks(func, traces, func_args, args.workers, args.chunk_size)
+                print_stats(stats)
+                utils.db.insert(out_table, rows, copy=not args.no_copy)
+            if args.incremental:
+                utils.db.set_watermark(stage, cloud, args.table_tag, watermark)
+
         if not args.repeat:
             # traceroute in
-            traces = utils.db.query(f"sanitized_tr_{args.table_tag} as st, ripe_cloud as rc",
-                                    "st.msm_id, st.prb_id, st.timestamp, st.sanitized_hops, rc.ip_from",
-                                    "st.msm_id=rc.msm_id and st.prb_id=rc.prb_id" +
-                                    f" and st.cloud='{cloud}' and st.timestamp>='{args.start_time}'")
-            rows = locate_traceroute(traces, cloud_asns, pop_list)
-            utils.db.insert(f"tr_borders_{args.table_tag}", rows)
+            locate_table("tr_borders", locate_traceroute_chunk, (cloud_asns, pop_list, False),
+                         f"sanitized_tr_{args.table_tag} as st, ripe_cloud as rc",
+                         "st.msm_id, st.prb_id, st.timestamp, st.sanitized_hops, rc.ip_from",
+                         f"st.msm_id=rc.msm_id and st.prb_id=rc.prb_id and st.cloud='{cloud}'",
+                         "st.timestamp", "st.msm_id, st.prb_id")
 
             # traceroute out
-            trouts = utils.db.query(f"sanitized_trout_{args.table_tag}",
-                                    "trout_id,prb_id,src_ip_pub,dst_ip,sanitized_hops",
-                                    f"cloud='{cloud}' and src_ip_pub is not NULL and timestamp>='{args.start_time}'")
-            rows = locate_traceroute_out(trouts, cloud_asns, pop_list)
-            utils.db.insert(f"trout_borders_{args.table_tag}", rows)
+            locate_table("trout_borders", locate_traceroute_out_chunk, (cloud_asns, pop_list),
+                         f"sanitized_trout_{args.table_tag} as st",
+                         "st.trout_id, st.prb_id, st.src_ip_pub, st.dst_ip, st.sanitized_hops",
+                         f"st.cloud='{cloud}' and st.src_ip_pub is not NULL",
+                         "st.timestamp", "st.trout_id")
         else:
             # repeat traceroute in
-            traces = utils.db.query(f"repeat_sanitized_tr_{args.table_tag} as rst, repeat_ripe_cloud as rrc",
-                                    "rst.msm_id, rst.prb_id, rst.timestamp, sanitized_hops, rrc.ip_from",
-                                    "rst.msm_id=rrc.msm_id and rst.prb_id=rrc.prb_id and rst.timestamp=rrc.timestamp" +
-                                    f" and rst.cloud='{cloud}' and rst.timestamp>='{args.start_time}'")
-            rows = locate_traceroute(
-                traces, cloud_asns, pop_list, with_timestamp=True)
-            utils.db.insert(f"repeat_tr_borders_{args.table_tag}", rows)
+            locate_table("repeat_tr_borders", locate_traceroute_chunk, (cloud_asns, pop_list, True),
+                         f"repeat_sanitized_tr_{args.table_tag} as rst, repeat_ripe_cloud as rrc",
+                         "rst.msm_id, rst.prb_id, rst.timestamp, sanitized_hops, rrc.ip_from",
+                         "rst.msm_id=rrc.msm_id and rst.prb_id=rrc.prb_id and rst.timestamp=rrc.timestamp" +
+                         f" and rst.cloud='{cloud}'",
+                         "rst.timestamp", "rst.msm_id, rst.prb_id, rst.timestamp")
 
             # repeat traceroute out
-            trouts = utils.db.query(f"repeat_sanitized_trout_{args.table_tag}",
-                                    "trout_id,prb_id,src_ip_pub,dst_ip,sanitized_hops",
-                                    f"cloud='{cloud}' and src_ip_pub is not NULL and timestamp>='{args.start_time}'")
-            rows = locate_traceroute_out(trouts, cloud_asns, pop_list)
-            utils.db.insert(f"repeat_trout_borders_{args.table_tag}", rows)
+            locate_table("repeat_trout_borders", locate_traceroute_out_chunk, (cloud_asns, pop_list),
+                         f"repeat_sanitized_trout_{args.table_tag} as st",
+                         "st.trout_id, st.prb_id, st.src_ip_pub, st.dst_ip, st.sanitized_hops",
+                         f"st.cloud='{cloud}' and st.src_ip_pub is not NULL",
+                         "st.timestamp", "st.trout_id")
+
+
+if __name__ == "__main__":
+    main()